@@ -9,7 +9,7 @@ A script for:
 from loguru import logger
 
 from mplc import utils
-from mplc.experiment import init_experiment_from_config_file
+from mplc.experiment import estimate_experiment_from_config_file, init_experiment_from_config_file
 from mplc.utils import parse_command_line_arguments
 
 DEFAULT_CONFIG_FILE = "./config.yml"
@@ -32,6 +32,12 @@ def main():
     config_filepath = args.file if args.file else DEFAULT_CONFIG_FILE
     if not args.file:
         logger.info(f"No config file specified, using default config file: {DEFAULT_CONFIG_FILE}")
+
+    # Only estimate the cost of the experiment
+    if args.dry_run:
+        estimate_experiment_from_config_file(config_filepath)
+        return 0
+
     main_experiment = init_experiment_from_config_file(config_filepath)
 
     # Run the experiment
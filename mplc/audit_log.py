@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+An audit log of the characteristic function calls of the contributivity methods, which records the cost of each
+coalition (training time, epochs run) and the cache hits, to tune the estimators and plan the computing capacity.
+"""
+
+import json
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+DEFAULT_BUFFER_SIZE = 100
+SLOWEST_COALITIONS_COUNT = 5
+
+
+class ContributivityAuditLog:
+    """Write one JSON line per characteristic function call, with the coalition, the name of the contributivity
+    method, whether the value was found in the cache, the final score, and for the trainings the wall-clock time, the
+    number of epochs run and the id (pid) of the worker process.
+
+    The lines are buffered and appended to the file every buffer_size calls, and when the log is closed. The
+    statistics of the summary are accumulated in memory.
+    """
+
+    def __init__(self, path, method="", epoch_count=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.method = method
+        self.epoch_count = epoch_count
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+        self.cache_hits = 0
+        self.times_per_size = defaultdict(list)  # coalition size -> training times
+        self.scores_per_size = defaultdict(list)  # coalition size -> scores of the trainings
+        self.epochs_run = 0
+        self.epochs_known_count = 0  # number of trainings whose number of epochs is known
+        self.trainings_per_worker = defaultdict(int)
+        self.trainings_times = []  # (time, coalition) of each training
+
+    def record(self, coalition, score, cache_hit=False, time_sec=None, epochs=None, worker=None):
+        """Record a characteristic function call on coalition"""
+        coalition = [int(i) for i in coalition]
+        self.buffer.append({'method': self.method,
+                            'coalition': coalition,
+                            'cache_hit': cache_hit,
+                            'score': None if score is None else float(score),
+                            'time_sec': time_sec,
+                            'epochs': epochs,
+                            'worker': worker})
+        if cache_hit:
+            self.cache_hits += 1
+        else:
+            self.times_per_size[len(coalition)].append(time_sec)
+            self.scores_per_size[len(coalition)].append(float(score))
+            self.trainings_per_worker[worker] += 1
+            self.trainings_times.append((time_sec, coalition))
+            if epochs is not None:
+                self.epochs_run += epochs
+                self.epochs_known_count += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, 'a') as f:
+                f.writelines(json.dumps(entry) + '\n' for entry in self.buffer)
+            self.buffer = []
+
+    @property
+    def trainings_count(self):
+        return len(self.trainings_times)
+
+    def summary(self):
+        """Return a dict of statistics on the calls recorded: the cache hit rate, the total and the mean training time
+        per coalition size, the mean and the standard deviation of the scores per coalition size, the epochs saved by
+        early stopping, the number of trainings per worker, and the slowest coalitions"""
+        calls_count = self.cache_hits + self.trainings_count
+        sizes = sorted(self.times_per_size)
+        summary = {
+            'method': self.method,
+            'calls': calls_count,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.trainings_count,
+            'cache_hit_rate': self.cache_hits / calls_count if calls_count else None,
+            'trainings_time_sec': float(sum(time_sec for time_sec, _ in self.trainings_times if time_sec is not None)),
+            'mean_time_sec_per_size': {size: mean_or_none(self.times_per_size[size]) for size in sizes},
+            'mean_score_per_size': {size: float(np.mean(self.scores_per_size[size])) for size in sizes},
+            'score_std_per_size': {size: float(np.std(self.scores_per_size[size])) for size in sizes},
+            'epochs_run': self.epochs_run,
+            'trainings_per_worker': dict(self.trainings_per_worker),
+            'slowest_coalitions': [{'coalition': coalition, 'time_sec': time_sec} for time_sec, coalition in
+                                   sorted((entry for entry in self.trainings_times if entry[0] is not None),
+                                          key=lambda entry: -entry[0])[:SLOWEST_COALITIONS_COUNT]],
+        }
+        if self.epoch_count is not None and self.epochs_known_count:
+            summary['epochs_saved_by_early_stopping'] = self.epoch_count * self.epochs_known_count - self.epochs_run
+        return summary
+
+    def close(self):
+        """Flush the buffer, and write the summary next to the log, in a .summary.json file. Return the summary"""
+        self.flush()
+        summary = self.summary()
+        with open(self.path.with_suffix('.summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Contributivity audit log written in {self.path}: {summary['calls']} calls, "
+                    f"{summary['cache_hits']} cache hits, {summary['cache_misses']} trainings in "
+                    f"{np.round(summary['trainings_time_sec'], 1)} s.")
+        return summary
+
+
+def mean_or_none(values):
+    values = [value for value in values if value is not None]
+    return float(np.mean(values)) if values else None
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent store of the final weights of the models trained on the coalitions of partners, which enables to
+re-evaluate the coalitions (on a new test set, with a new metric...) without retraining them.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+INDEX_FILE_NAME = "index.json"
+
+
+class CoalitionModelStore:
+    """Store the final weights of the coalitions' models on disk.
+
+    The weights of a model are flattened into a single .npy file, named after the hash of its content, so identical
+    models are stored once. The files are memory-mapped when loaded. If max_bytes is set, the least recently used
+    coalitions are evicted when the size of the stored files exceeds it. The index of the store is saved in the folder,
+    so a store can be re-opened later.
+    """
+
+    def __init__(self, folder, max_bytes=None):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self.coalitions = OrderedDict()  # coalition -> digest of its weights, from the least to the most recently used
+        self.files = {}  # digest -> {'shapes': [...], 'dtype': str, 'nbytes': int}
+        index_path = self.folder / INDEX_FILE_NAME
+        if index_path.exists():
+            with open(index_path) as f:
+                index = json.load(f)
+            self.coalitions = OrderedDict((tuple(coalition), digest) for coalition, digest in index['coalitions'])
+            self.files = index['files']
+            logger.info(f"Coalition model store loaded from {self.folder}, with {len(self)} coalitions")
+
+    def __len__(self):
+        return len(self.coalitions)
+
+    def __contains__(self, coalition):
+        return self.key(coalition) in self.coalitions
+
+    @staticmethod
+    def key(coalition):
+        return tuple(int(i) for i in np.sort(coalition))
+
+    @property
+    def nbytes(self):
+        return sum(file['nbytes'] for file in self.files.values())
+
+    def save(self, coalition, weights):
+        """Store the list of weights arrays of the model trained on coalition. The weights previously stored for the
+        coalition, if any, are replaced"""
+        flat_weights = np.concatenate([np.asarray(w).ravel() for w in weights])
+        digest = hashlib.sha1(flat_weights.tobytes()).hexdigest()
+        if digest not in self.files:
+            np.save(self.folder / f'{digest}.npy', flat_weights)
+            self.files[digest] = {'shapes': [list(np.shape(w)) for w in weights],
+                                  'dtype': str(flat_weights.dtype),
+                                  'nbytes': int(flat_weights.nbytes)}
+        key = self.key(coalition)
+        previous_digest = self.coalitions.get(key)
+        self.coalitions[key] = digest
+        self.coalitions.move_to_end(key)
+        if previous_digest is not None and previous_digest != digest:
+            self.release(previous_digest)
+        self.evict()
+        self.save_index()
+
+    def load(self, coalition):
+        """Return the list of weights arrays of the model trained on coalition, memory-mapped, or None if the
+        coalition is not stored"""
+        key = self.key(coalition)
+        if key not in self.coalitions:
+            return None
+        self.coalitions.move_to_end(key)
+        digest = self.coalitions[key]
+        flat_weights = np.load(self.folder / f'{digest}.npy', mmap_mode='r')
+        weights, offset = [], 0
+        for shape in self.files[digest]['shapes']:
+            size = int(np.prod(shape))
+            weights.append(flat_weights[offset:offset + size].reshape(shape))
+            offset += size
+        return weights
+
+    def remap(self, remap):
+        """Rename the stored coalitions with the function remap: coalition -> new coalition, or None to remove the
+        coalition from the store (for instance when the partners of the scenario change)"""
+        coalitions = OrderedDict()
+        for coalition, digest in self.coalitions.items():
+            new_coalition = remap(coalition)
+            if new_coalition is not None:
+                coalitions[self.key(new_coalition)] = digest
+        self.coalitions = coalitions
+        for digest in set(self.files) - set(self.coalitions.values()):
+            (self.folder / f'{digest}.npy').unlink()
+            del self.files[digest]
+        self.save_index()
+
+    def evict(self):
+        """Remove the least recently used coalitions until the stored files fit in max_bytes. The most recent
+        coalition is always kept"""
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes and len(self.coalitions) > 1:
+            coalition, digest = self.coalitions.popitem(last=False)
+            logger.debug(f"Coalition {coalition} evicted from the coalition model store")
+            self.release(digest)
+
+    def release(self, digest):
+        """Delete the file of digest if no stored coalition references it anymore"""
+        if digest not in self.coalitions.values():
+            (self.folder / f'{digest}.npy').unlink()
+            del self.files[digest]
+
+    def save_index(self):
+        with open(self.folder / INDEX_FILE_NAME, 'w') as f:
+            json.dump({'coalitions': [[list(coalition), digest] for coalition, digest in self.coalitions.items()],
+                       'files': self.files}, f)
@@ -9,6 +9,7 @@ MAX_BATCH_SIZE = 2 ** 20
 DEFAULT_GRADIENT_UPDATES_PER_PASS_COUNT = 8
 PATIENCE = 10  # patience for early stopping
 MIN_DELTA_FOR_EARLY_STOPPING = 0
+ROUNDS_VAL_SET_SIZE = 1000  # size of the validation subset used to score each aggregation round on fast mpl
 DEFAULT_BATCH_COUNT = 20
 DEFAULT_EPOCH_COUNT = 40
 # GPU
@@ -30,7 +31,10 @@ TEST_SET_MAX_SIZE_QUICK_DEMO = 500
 # Contributivity contributivity_methods names
 CONTRIBUTIVITY_METHODS = [
     "Shapley values",
+    "Active Shapley",
+    "Owen values",
     "Independent scores",
+    "Leave-one-out",
     "TMCS",
     "ITMCS",
     "IS_lin_S",
@@ -38,12 +42,21 @@ CONTRIBUTIVITY_METHODS = [
     "AIS_Kriging_S",
     "SMCS",
     "WR_SMC",
+    "CC_Shapley",
+    "G-Shapley",
     "Federated SBS linear",
     "Federated SBS quadratic",
     "Federated SBS constant",
     "S-Model",
+    "Confident learning",
     "PVRL",
+    "KNN-Shapley",
+    "Duplicates detection",
+    "Influence functions",
+    "Gradient similarity",
 ]
+# Contributivity methods which can compute the scores of the vectors of outcomes of the coalitions
+VECTOR_OUTCOMES_METHODS = ["Shapley values", "Leave-one-out", "Independent scores", "TMCS"]
 
 # Datasets' Tags
 MNIST = "mnist"
@@ -7,17 +7,109 @@ from __future__ import print_function
 
 import bisect
 import datetime
-from itertools import combinations
+import os
+import random
+import tempfile
+from itertools import combinations, product
 from math import factorial
+from pathlib import Path
 from timeit import default_timer as timer
 
 import numpy as np
+import tensorflow as tf
+from joblib import Parallel, delayed, effective_n_jobs
 from loguru import logger
+from scipy.optimize import minimize
+from scipy.special import comb
 from scipy.stats import norm
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import ConstantKernel, RBF, WhiteKernel
 from sklearn.linear_model import LinearRegression
 
 from . import constants
-from .multi_partner_learning import basic_mpl
+from .audit_log import ContributivityAuditLog
+from .coalition_store import CoalitionModelStore
+from .corruption import NoCorruption
+from .duplicates import detect_duplicates
+from .models import EnsemblePredictionsModel
+from .multi_partner_learning import basic_mpl, fast_mpl, FAST_EQUIVALENT_APPROACHES
+from .splitter import RandomSplitter
+
+
+def select_mpl_engine(scenario, approach=None):
+    """Return the multi-partner learning approach on which the trainings of the contributivity methods are run: the
+    fast equivalent of approach (the approach of the scenario by default) if it has one, if the aggregation weights
+    are constant and if the model is a Keras model. Otherwise approach itself is returned."""
+    approach = approach or scenario._multi_partner_learning_approach
+    fast_approach = FAST_EQUIVALENT_APPROACHES.get(approach)
+    if fast_approach is None or not scenario.aggregation.is_weights_constant:
+        return approach
+    if not isinstance(scenario.dataset.generate_new_model(), tf.keras.Model):
+        return approach
+    logger.info(f"The trainings of the contributivity method run on {fast_approach.name}, the fast equivalent of "
+                f"{approach.name}")
+    return fast_approach
+
+
+def get_test_score(mpl):
+    """Return the test accuracy of a trained multi-partner learning. The fast mpl engines store all the metrics
+    evaluated on the test data in a dict, the basic ones only the accuracy"""
+    score = mpl.history.score
+    return float(score['accuracy']) if isinstance(score, dict) else score
+
+
+def fit_coalition(scenario, subset, seed=None, return_weights=False, return_outcomes=False, approach=None):
+    """Train a model on the coalition of partners whose indexes are given in subset, and return a dict with its test
+    score ('score'), its per-epoch validation accuracy ('val_accuracy_curve'), the final weights of the model
+    ('weights') if return_weights, and the vector of its outcomes on the test data ('outcomes') if return_outcomes.
+    The coalitions of several partners are trained with approach, the approach of the scenario by default.
+    The cost of the training is also returned: its wall-clock time ('time_sec'), the number of epochs run ('epochs')
+    and the pid of the process which trained it ('worker').
+
+    This function is kept at the module level so it can be sent to worker processes.
+    """
+    start = timer()
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        tf.random.set_seed(seed)
+    small_partners_list = np.array([scenario.partners_list[i] for i in subset])
+    if len(small_partners_list) > 1:
+        approach = approach or scenario._multi_partner_learning_approach
+        mpl = approach(scenario,
+                       partners_list=small_partners_list,
+                       is_early_stopping=True,
+                       save_folder=None,
+                       **scenario.mpl_kwargs
+                       )
+    else:
+        mpl = basic_mpl.SinglePartnerLearning(scenario,
+                                              partners_list=small_partners_list,
+                                              is_early_stopping=True,
+                                              save_folder=None,
+                                              **scenario.mpl_kwargs
+                                              )
+    mpl.fit()
+    result = {'score': get_test_score(mpl),
+              'val_accuracy_curve': get_val_accuracy_curve(mpl),
+              'time_sec': timer() - start,
+              'epochs': get_epochs_done(mpl),
+              'worker': os.getpid()}
+    if return_weights:
+        result['weights'] = get_mpl_model(mpl).get_weights()
+    if return_outcomes:
+        result['outcomes'] = coalition_outcomes(get_mpl_model(mpl), scenario)
+    return result
+
+
+def gradient_shapley_marginals(scenario, permutations, learning_rate=0.01, initial_weights=None):
+    """Return the marginal contributions of the partners along each permutation, computed by the single pass
+    trainings of the gradient Shapley method.
+
+    This function is kept at the module level so it can be sent to worker processes.
+    """
+    trainer = fast_mpl.FastGradientShapley(scenario, learning_rate, initial_weights)
+    return np.array([trainer.permutation_marginals(permutation) for permutation in permutations])
 
 
 class KrigingModel:
@@ -73,7 +165,22 @@ class Contributivity:
         self.computation_time_sec = 0.0
         self.first_charac_fct_calls_count = 0
         self.charac_fct_values = {(): 0}
+        self.charac_fct_samples = {}
         self.increments_values = [{} for _ in self.scenario.partners_list]
+        self.characteristic = "training"
+        self.keep_curves = False
+        self.charac_fct_curves = {}  # coalition -> list of the per-epoch validation accuracies of its trainings
+        self.epochs_scores = None  # Shapley values at each epoch, of shape (epoch_count, partners_count)
+        self.scores_convergence_epoch = None
+        self.keep_outcomes = False
+        self.charac_fct_outcomes = {}  # coalition -> list of the outcomes vectors of its trainings
+        self.outcomes_names = outcomes_names(self.scenario)
+        self.outcomes_scores = None  # contributivity scores of each outcome, of shape (partners_count, outcomes_count)
+        self.permutations_outcomes_scores = None  # outcomes scores averaged over the permutations sampled by TMCS
+        self.fast_engines = True
+        self.coalition_approach = None  # approach of the coalitions' trainings, see get_coalition_approach
+        self.audit_log = None  # ContributivityAuditLog of the characteristic function calls, if enabled
+        self.audit_summary = None
 
     def __str__(self):
         computation_time_sec = str(datetime.timedelta(seconds=self.computation_time_sec))
@@ -87,6 +194,8 @@ class Contributivity:
         output += f"Contributivity scores: {np.round(self.contributivity_scores, 3)}\n"
         output += f"Std of the contributivity scores: {np.round(self.scores_std, 3)}\n"
         output += f"Normalized contributivity scores: {np.round(self.normalized_scores, 3)}\n"
+        if self.scores_convergence_epoch is not None:
+            output += f"Shapley values per epoch converged at epoch: {self.scores_convergence_epoch}\n"
 
         return output
 
@@ -98,49 +207,305 @@ class Contributivity:
             # Characteristic_func(permut) has not been computed yet...
             # ... so we compute, store, and return characteristic_func(permut)
             self.first_charac_fct_calls_count += 1
-            small_partners_list = np.array([self.scenario.partners_list[i] for i in subset])
-            if len(small_partners_list) > 1:
-                mpl = self.scenario._multi_partner_learning_approach(self.scenario,
-                                                                     partners_list=small_partners_list,
-                                                                     is_early_stopping=True,
-                                                                     save_folder=None,
-                                                                     **self.scenario.mpl_kwargs
-                                                                     )
-            else:
-                mpl = basic_mpl.SinglePartnerLearning(self.scenario,
-                                                      partners_list=small_partners_list,
-                                                      is_early_stopping=True,
-                                                      save_folder=None,
-                                                      **self.scenario.mpl_kwargs
-                                                      )
-            mpl.fit()
-            self.charac_fct_values[tuple(subset)] = mpl.history.score
-            # we add the new increments
-            for i in range(len(self.scenario.partners_list)):
-                if i in subset:
-                    subset_without_i = np.delete(subset, np.argwhere(subset == i))
-                    if (
-                            tuple(subset_without_i) in self.charac_fct_values
-                    ):  # we store the new known increments
-                        self.increments_values[i][tuple(subset_without_i)] = (
-                                self.charac_fct_values[tuple(subset)]
-                                - self.charac_fct_values[tuple(subset_without_i)]
-                        )
-                else:
-                    subset_with_i = np.sort(np.append(subset, i))
-                    if (
-                            tuple(subset_with_i) in self.charac_fct_values
-                    ):  # we store the new known increments
-                        self.increments_values[i][tuple(subset)] = (
-                                self.charac_fct_values[tuple(subset_with_i)]
-                                - self.charac_fct_values[tuple(subset)]
-                        )
+            self.store_characteristic(subset, self.characteristic_function(subset))
+        elif self.audit_log is not None and len(subset) > 0:
+            self.audit_log.record(subset, self.charac_fct_values[tuple(subset)], cache_hit=True)
         # else we will Return the characteristic_func(permut) that was already computed
         return self.charac_fct_values[tuple(subset)]
 
+    def not_twice_characteristic_batch(self, subsets, repeats=1, n_jobs=1):
+        """Return the characteristic function values of a list of coalitions, training only the missing ones.
+
+        The missing trainings are dispatched on n_jobs worker processes when n_jobs != 1.
+        With repeats > 1, each coalition is trained repeats times with different seeds. The individual scores are
+        kept in self.charac_fct_samples, and their mean is stored as the characteristic function value.
+        """
+        subsets = [tuple(np.sort(subset)) for subset in subsets]
+        trainings_to_do = []
+        for subset in dict.fromkeys(subsets):  # remove duplicates, keep the order
+            if len(subset) == 0:
+                self.charac_fct_samples[subset] = [0] * repeats
+                continue
+            if subset not in self.charac_fct_samples:
+                self.charac_fct_samples[subset] = [self.charac_fct_values[subset]] \
+                    if subset in self.charac_fct_values else []
+            trainings_to_do += [subset] * (repeats - len(self.charac_fct_samples[subset]))
+
+        if len(trainings_to_do) > 0:
+            if repeats > 1:
+                seeds = [int(seed) for seed in np.random.randint(2 ** 31 - 1, size=len(trainings_to_do))]
+            else:
+                seeds = [None] * len(trainings_to_do)
+            if n_jobs == 1 or self.characteristic != "training":
+                scores = [self.characteristic_function(np.array(subset), seed)
+                          for subset, seed in zip(trainings_to_do, seeds)]
+            else:
+                logger.info(f"Training {len(trainings_to_do)} coalitions on {n_jobs} workers")
+                scenario = self.scenario.copy_for_workers()
+                store = self.scenario.coalition_store
+                approach = self.get_coalition_approach()
+                results = Parallel(n_jobs=n_jobs)(delayed(fit_coalition)(scenario, np.array(subset), seed,
+                                                                         return_weights=store is not None,
+                                                                         return_outcomes=self.keep_outcomes,
+                                                                         approach=approach)
+                                                  for subset, seed in zip(trainings_to_do, seeds))
+                for subset, result in zip(trainings_to_do, results):
+                    self.store_training_outputs(subset, result)
+                scores = [result['score'] for result in results]
+            for subset, score in zip(trainings_to_do, scores):
+                self.charac_fct_samples[subset].append(score)
+            for subset in dict.fromkeys(trainings_to_do):
+                if subset not in self.charac_fct_values:
+                    self.first_charac_fct_calls_count += 1
+                self.store_characteristic(np.array(subset), np.mean(self.charac_fct_samples[subset]))
+        if self.audit_log is not None:
+            trained_subsets = set(trainings_to_do)
+            for subset in subsets:
+                if len(subset) == 0:
+                    continue
+                if subset in trained_subsets:
+                    trained_subsets.remove(subset)  # the first request of a coalition trained here is its training
+                else:
+                    self.audit_log.record(subset, self.charac_fct_values[subset], cache_hit=True)
+
+        return np.array([self.charac_fct_values[subset] for subset in subsets])
+
+    def get_coalition_approach(self):
+        """Return the approach on which the coalitions are trained: the fast equivalent of the approach of the
+        scenario if self.fast_engines and if it can be used (see select_mpl_engine), the approach itself otherwise"""
+        if self.coalition_approach is None:
+            self.coalition_approach = select_mpl_engine(self.scenario) if self.fast_engines \
+                else self.scenario._multi_partner_learning_approach
+        return self.coalition_approach
+
+    def characteristic_function(self, subset, seed=None):
+        """Return the value of a coalition, according to the characteristic function selected:
+        - "training": test score of a model trained on the coalition
+        - "linear-probe": test score of a softmax head trained on the cached embeddings of the coalition's data"""
+        if self.characteristic == "training":
+            result = fit_coalition(self.scenario, subset, seed,
+                                   return_weights=self.scenario.coalition_store is not None,
+                                   return_outcomes=self.keep_outcomes,
+                                   approach=self.get_coalition_approach())
+            self.store_training_outputs(subset, result)
+            return result['score']
+        elif self.characteristic == "linear-probe":
+            start = timer()
+            score = self.linear_probe_characteristic(subset)
+            if self.audit_log is not None:
+                self.audit_log.record(subset, score, time_sec=timer() - start, worker=os.getpid())
+            return score
+        else:
+            raise ValueError(f"Characteristic function must be 'training' or 'linear-probe', not "
+                             f"{self.characteristic}")
+
+    def store_training_outputs(self, subset, result):
+        """Keep what a coalition training returns besides its score: the final weights of the model if there is a
+        coalition model store, the validation accuracy curve if self.keep_curves, and the outcomes vector if
+        self.keep_outcomes. The training is recorded in the audit log, if enabled"""
+        if self.audit_log is not None:
+            self.audit_log.record(subset, result['score'], time_sec=result['time_sec'], epochs=result['epochs'],
+                                  worker=result['worker'])
+        if 'weights' in result:
+            self.scenario.coalition_store.save(subset, result['weights'])
+        if self.keep_curves:
+            self.charac_fct_curves.setdefault(tuple(np.sort(subset)), []).append(result['val_accuracy_curve'])
+        if 'outcomes' in result:
+            self.charac_fct_outcomes.setdefault(tuple(np.sort(subset)), []).append(result['outcomes'])
+
+    def get_probe_embeddings(self):
+        """Return the embeddings of the train data of each partner and of the test data, computed by the penultimate
+        layer of the main model. They are computed once per scenario, saved as .npy files and memory-mapped."""
+        if self.scenario.probe_embeddings is None:
+            logger.info("Computing the embeddings of the linear-probe characteristic function")
+            model = get_mpl_model(self.get_main_mpl())
+            if not isinstance(model, tf.keras.Model):
+                raise ValueError("The linear-probe characteristic function only handles Keras based models")
+            if self.scenario.save_folder.exists():
+                embeddings_folder = self.scenario.save_folder / 'embeddings'
+                embeddings_folder.mkdir(exist_ok=True)
+            else:
+                embeddings_folder = Path(tempfile.mkdtemp(prefix='mplc_embeddings_'))
+
+            def cache(name, x):
+                path = embeddings_folder / f'{name}.npy'
+                np.save(path, compute_embeddings(model, x))
+                return np.load(path, mmap_mode='r')
+
+            self.scenario.probe_embeddings = {
+                'partners': [cache(f'partner_{partner.id}', partner.x_train)
+                             for partner in self.scenario.partners_list],
+                'test': cache('test', self.scenario.dataset.x_test),
+            }
+        return self.scenario.probe_embeddings['partners'], self.scenario.probe_embeddings['test']
+
+    def linear_probe_characteristic(self, subset):
+        """Test accuracy of a softmax head trained on the embeddings of the train data of the coalition"""
+        partners_embeddings, test_embeddings = self.get_probe_embeddings()
+        x_train = np.concatenate([partners_embeddings[i] for i in subset])
+        y_train = np.concatenate([labels_to_int(self.scenario.partners_list[i].y_train) for i in subset])
+        num_classes = max(2, self.scenario.dataset.num_classes)
+        return fit_linear_probe(x_train, y_train, test_embeddings, labels_to_int(self.scenario.dataset.y_test),
+                                num_classes)
+
+    def init_coalition_store(self, max_bytes=None):
+        """Create the store of the coalitions' models of the scenario, if it does not exist yet. It is saved in the
+        coalition_models subfolder of the scenario folder, and re-opened if this folder already contains one."""
+        if self.scenario.coalition_store is None:
+            if self.scenario.save_folder.exists():
+                folder = self.scenario.save_folder / 'coalition_models'
+            else:
+                folder = Path(tempfile.mkdtemp(prefix='mplc_coalition_models_'))
+            self.scenario.coalition_store = CoalitionModelStore(folder, max_bytes=max_bytes)
+        return self.scenario.coalition_store
+
+    def init_audit_log(self, method_to_compute, path=None):
+        """Open the audit log of the characteristic function calls of method_to_compute. By default it is written in
+        the scenario folder, and appended to if it already exists."""
+        if path is None:
+            if self.scenario.save_folder.exists():
+                folder = self.scenario.save_folder
+            else:
+                folder = Path(tempfile.mkdtemp(prefix='mplc_audit_log_'))
+            path = folder / 'contributivity_audit_log.jsonl'
+        self.audit_log = ContributivityAuditLog(path, method=method_to_compute, epoch_count=self.scenario.epoch_count)
+        return self.audit_log
+
+    def reevaluate_coalitions(self, x, y, coalitions=None, metric=None, batch_size=constants.DEFAULT_BATCH_SIZE,
+                              models_per_pass=8):
+        """Return a dict {coalition: score} of the scores of the models stored in the coalition store, evaluated on
+        the data (x, y), without any training. By default all the stored coalitions are evaluated, with the metric of
+        the characteristic function (accuracy). metric can be a function (y_true, y_pred) -> score.
+
+        The models of models_per_pass coalitions are loaded at once, and evaluated together on each chunk of
+        batch_size samples, so the data is read once per group of coalitions (see StackedModels)."""
+        store = self.scenario.coalition_store
+        if store is None:
+            raise ValueError("No coalition model store, the coalitions must be trained with model_store=True")
+        if coalitions is None:
+            coalitions = list(store.coalitions)
+        stored_coalitions = []
+        for coalition in coalitions:
+            if coalition in store:
+                stored_coalitions.append(store.key(coalition))
+            else:
+                logger.warning(f"Coalition {coalition} is not in the coalition model store, it is skipped")
+
+        stacked_models = {}  # number of models -> StackedModels, built once
+        labels = labels_to_int(np.asarray(y))
+        scores = {}
+        for start in range(0, len(stored_coalitions), models_per_pass):
+            group = stored_coalitions[start:start + models_per_pass]
+            if len(group) not in stacked_models:
+                stacked_models[len(group)] = StackedModels(self.scenario.dataset, len(group))
+            models = stacked_models[len(group)]
+            models.set_weights([[np.array(w) for w in store.load(coalition)] for coalition in group])
+
+            correct_counts = np.zeros(len(group))
+            predictions = [[] for _ in group]
+            for chunk_start in range(0, len(x), batch_size):
+                outputs = models.predict_on_batch(x[chunk_start:chunk_start + batch_size])
+                for k, output in enumerate(outputs):
+                    if metric is None:
+                        correct_counts[k] += np.sum(np.argmax(two_classes_probabilities(output), axis=1)
+                                                    == labels[chunk_start:chunk_start + batch_size])
+                    else:
+                        predictions[k].append(output)
+            for k, coalition in enumerate(group):
+                if metric is None:
+                    scores[coalition] = correct_counts[k] / len(x)
+                else:
+                    scores[coalition] = metric(y, np.concatenate(predictions[k]))
+        return scores
+
+    def store_characteristic(self, subset, value):
+        """Store the characteristic function value of a coalition, and the new increments it makes known"""
+
+        self.charac_fct_values[tuple(subset)] = value
+        # we add the new increments
+        for i in range(len(self.scenario.partners_list)):
+            if i in subset:
+                subset_without_i = np.delete(subset, np.argwhere(subset == i))
+                if (
+                        tuple(subset_without_i) in self.charac_fct_values
+                ):  # we store the new known increments
+                    self.increments_values[i][tuple(subset_without_i)] = (
+                            self.charac_fct_values[tuple(subset)]
+                            - self.charac_fct_values[tuple(subset_without_i)]
+                    )
+            else:
+                subset_with_i = np.sort(np.append(subset, i))
+                if (
+                        tuple(subset_with_i) in self.charac_fct_values
+                ):  # we store the new known increments
+                    self.increments_values[i][tuple(subset)] = (
+                            self.charac_fct_values[tuple(subset_with_i)]
+                            - self.charac_fct_values[tuple(subset)]
+                    )
+
+    # %% Incremental re-valuation when the partners change
+
+    def add_partner(self, x_train, y_train, x_val=None, y_val=None, x_test=None, y_test=None):
+        """Add a partner to the scenario and return its index. The cached coalitions stay valid: only the coalitions
+        containing the new partner are trained at the next refresh."""
+        self.scenario.add_partner(x_train, y_train, x_val, y_val, x_test, y_test)
+        self.increments_values.append({})
+        return len(self.scenario.partners_list) - 1
+
+    def remove_partner(self, partner_index):
+        """Remove a partner from the scenario. The cached coalitions containing it are dropped, and the others are
+        renamed with the new indexes of the partners."""
+        self.scenario.remove_partner(partner_index)
+        self.remap_coalitions(lambda coalition: None if partner_index in coalition
+                              else tuple(i - (i > partner_index) for i in coalition))
+
+    def update_partner(self, partner_index, x_train, y_train, x_val=None, y_val=None, x_test=None, y_test=None):
+        """Replace the data of a partner. Only the cached coalitions containing it are invalidated."""
+        self.scenario.update_partner_data(partner_index, x_train, y_train, x_val, y_val, x_test, y_test)
+        self.remap_coalitions(lambda coalition: None if partner_index in coalition else coalition)
+
+    def remap_coalitions(self, remap):
+        """Apply remap: coalition -> new coalition, or None to invalidate it, to all the coalitions cached (values,
+        samples, curves, outcomes and stored models), then rebuild the known increments"""
+        cached_count = len(self.charac_fct_values)
+        for cache in [self.charac_fct_values, self.charac_fct_samples, self.charac_fct_curves,
+                      self.charac_fct_outcomes]:
+            items = list(cache.items())
+            cache.clear()
+            for coalition, value in items:
+                new_coalition = remap(coalition)
+                if new_coalition is not None:
+                    cache[tuple(new_coalition)] = value
+        if self.scenario.coalition_store is not None:
+            self.scenario.coalition_store.remap(remap)
+        self.charac_fct_values[()] = 0
+
+        self.increments_values = [{} for _ in self.scenario.partners_list]
+        for coalition, value in list(self.charac_fct_values.items()):
+            self.store_characteristic(np.array(coalition, dtype=int), value)
+        self.outcomes_names = outcomes_names(self.scenario)
+        logger.info(f"{cached_count - len(self.charac_fct_values)} cached coalitions invalidated, "
+                    f"{len(self.charac_fct_values) - 1} kept")
+
+    def refresh(self, method_to_compute="Shapley values", **kwargs):
+        """Compute the contributivity scores again after a change of the partners. The cached coalitions are reused,
+        so only the new or invalidated ones are trained. kwargs are passed to compute_contributivity."""
+        calls_count = self.first_charac_fct_calls_count
+        self.compute_contributivity(method_to_compute, **kwargs)
+        logger.info(f"Contributivity refreshed with {self.first_charac_fct_calls_count - calls_count} new "
+                    f"coalition trainings")
+
     # %% Generalization of Shapley Value computation
 
-    def compute_SV(self):
+    def compute_SV(self, exchangeable_groups=None):
+        """Compute the exact Shapley values of all partners. If exchangeable_groups is given (a list of lists of
+        partners' indexes, or "auto" to detect them from the scenario configuration), the partners of a same group
+        are considered exchangeable, and only one coalition per coalition type is trained."""
+        if exchangeable_groups == "auto":
+            exchangeable_groups = self.detect_exchangeable_groups()
+        if exchangeable_groups is not None and any(len(group) > 1 for group in exchangeable_groups):
+            return self.compute_symmetric_SV(exchangeable_groups)
+
         start = timer()
         logger.info("# Launching computation of Shapley Value of all partners")
 
@@ -173,6 +538,286 @@ class Contributivity:
         end = timer()
         self.computation_time_sec = end - start
 
+    def compute_epochs_SV(self, tolerance=0.01):
+        """Compute the Shapley values of all partners at each epoch, from the validation accuracy curves kept during
+        the trainings of the coalitions, without any additional training. It needs the curves of all the coalitions.
+
+        The values at the last epoch are based on the validation accuracy, so they can differ slightly from the
+        Shapley values based on the test score. The epoch from which all the values stay within tolerance of their
+        final values tells how many epochs the coalition trainings actually need."""
+        epochs_scores = self.vector_SV(self.charac_fct_curves)
+        if epochs_scores is None:
+            logger.warning("The Shapley values per epoch are not computed")
+            return None
+        self.epochs_scores = epochs_scores.T
+        self.scores_convergence_epoch = convergence_epoch(self.epochs_scores, tolerance)
+        logger.info(f"Shapley values per epoch computed. They stay within {tolerance} of their final values from "
+                    f"epoch {self.scores_convergence_epoch} out of {len(self.epochs_scores)}")
+        return self.epochs_scores
+
+    def vector_SV(self, values_samples):
+        """Return the Shapley values of a vector-valued game, of shape (partners_count, values_count), or None if some
+        coalitions are missing. values_samples maps each coalition to the list of its value vectors, which are
+        averaged. All the components are computed at once, as a single matrix product."""
+        partners_count = len(self.scenario.partners_list)
+        coalitions = [coalition for i in range(partners_count)
+                      for coalition in combinations(range(partners_count), i + 1)]
+        missing_count = sum(coalition not in values_samples for coalition in coalitions)
+        if missing_count > 0:
+            logger.warning(f"The values of {missing_count} coalitions out of {len(coalitions)} are missing")
+            return None
+        values = np.array([np.mean(values_samples[coalition], axis=0) for coalition in coalitions])
+        return shapley_weights(partners_count, coalitions).dot(values)
+
+    def permutation_outcomes_marginals(self, permutation, evaluated):
+        """Return the marginal outcomes vectors of the partners along a permutation, of shape
+        (partners_count, outcomes_count), or None if the outcomes of an evaluated coalition are missing. evaluated tells
+        which coalitions of the permutation have been evaluated: the outcomes of the other ones, skipped by a
+        truncation, are those of the previous coalition, as their values are."""
+        marginals = np.zeros((len(permutation), len(self.outcomes_names)))
+        previous_outcomes = np.zeros(len(self.outcomes_names))
+        for j, is_evaluated in enumerate(evaluated):
+            outcomes = previous_outcomes
+            if is_evaluated:
+                coalition = tuple(np.sort(permutation[: j + 1]))
+                if coalition not in self.charac_fct_outcomes:
+                    return None
+                outcomes = np.mean(self.charac_fct_outcomes[coalition], axis=0)
+            marginals[permutation[j]] = outcomes - previous_outcomes
+            previous_outcomes = outcomes
+        return marginals
+
+    def compute_outcomes_scores(self, method="Shapley values"):
+        """Compute the contributivity scores of each outcome of the coalitions (accuracy, loss, accuracy per class,
+        and accuracy on the local test set of each partner), from the outcomes vectors kept during the trainings. The
+        method can be one of constants.VECTOR_OUTCOMES_METHODS. With "TMCS", the scores are the marginal outcomes
+        averaged over the permutations sampled by the last run of the method. The scores are stored in
+        self.outcomes_scores, of shape (partners_count, outcomes_count), with the names in self.outcomes_names."""
+        n = len(self.scenario.partners_list)
+        outcomes = {coalition: np.mean(samples, axis=0) for coalition, samples in self.charac_fct_outcomes.items()}
+        if method == "Shapley values":
+            scores = self.vector_SV(self.charac_fct_outcomes)
+        elif method == "TMCS":
+            scores = self.permutations_outcomes_scores
+        else:
+            if method == "Leave-one-out":
+                coalitions = [tuple(range(n))] + [tuple(np.delete(range(n), i)) for i in range(n)]
+            elif method == "Independent scores":
+                coalitions = [(i,) for i in range(n)]
+            else:
+                raise ValueError(f"Outcomes scores can be computed with {constants.VECTOR_OUTCOMES_METHODS}, not "
+                                 f"{method}")
+            if any(coalition not in outcomes for coalition in coalitions):
+                logger.warning("The outcomes of some coalitions are missing")
+                scores = None
+            elif method == "Leave-one-out":
+                scores = outcomes[coalitions[0]] - np.array([outcomes[coalition] for coalition in coalitions[1:]])
+            else:
+                scores = np.array([outcomes[coalition] for coalition in coalitions])
+        if scores is None:
+            logger.warning(f"The {method} of the coalitions' outcomes are not computed")
+            return None
+        self.outcomes_scores = scores
+        return self.outcomes_scores
+
+    def detect_exchangeable_groups(self):
+        """Group the partners which are exchangeable in expectation according to the scenario configuration: same
+        amount of data, randomly split, and not corrupted. The stratified splitter is excluded, as it sorts the
+        samples by label before splitting: partners with the same amount get different classes."""
+        groups = {}
+        for i, partner in enumerate(self.scenario.partners_list):
+            if isinstance(self.scenario.splitter, RandomSplitter) and isinstance(partner.corruption, NoCorruption):
+                key = self.scenario.amounts_per_partner[i]
+            else:
+                key = ('not exchangeable', i)
+            groups.setdefault(key, []).append(i)
+        groups = list(groups.values())
+        logger.info(f"Exchangeable groups of partners detected: {groups}")
+        return groups
+
+    def compute_symmetric_SV(self, exchangeable_groups):
+        """Compute the Shapley values of all partners, assuming that the partners in a same group are exchangeable.
+
+        A coalition type is the number of partners of each group in the coalition. Only one representative coalition
+        per type is trained, which needs prod(group size + 1) - 1 trainings instead of 2^n - 1. All the partners of a
+        group get the same value."""
+        start = timer()
+        logger.info("# Launching computation of Shapley Value of all partners, with exchangeable partners")
+
+        n = len(self.scenario.partners_list)
+        grouped = [i for group in exchangeable_groups for i in group]
+        if len(set(grouped)) != len(grouped) or not set(grouped).issubset(range(n)):
+            raise ValueError(f"The exchangeable groups {exchangeable_groups} must be disjoint lists of partners' "
+                             f"indexes")
+        groups = [list(group) for group in exchangeable_groups] + [[i] for i in range(n) if i not in grouped]
+        sizes = [len(group) for group in groups]
+
+        def value(coalition_type):
+            representative = [i for group, count in zip(groups, coalition_type) for i in group[:count]]
+            return self.not_twice_characteristic(np.array(representative, dtype=int))
+
+        values = {coalition_type: value(coalition_type)
+                  for coalition_type in product(*[range(size + 1) for size in sizes])}
+
+        group_values = np.zeros(len(groups))
+        for coalition_type, coalition_value in values.items():
+            coalition_size = sum(coalition_type)
+            if coalition_size == n:
+                continue
+            weight = factorial(coalition_size) * factorial(n - coalition_size - 1) / factorial(n)
+            for g, count in enumerate(coalition_type):
+                if count < sizes[g]:
+                    # number of coalitions of this type which do not contain a given partner of the group g
+                    coalitions_count = np.prod([comb(size, c, exact=True) for size, c in zip(sizes, coalition_type)]) \
+                        / comb(sizes[g], count, exact=True) * comb(sizes[g] - 1, count, exact=True)
+                    increment = values[coalition_type[:g] + (count + 1,) + coalition_type[g + 1:]] - coalition_value
+                    group_values[g] += coalitions_count * weight * increment
+
+        shapley_values = np.zeros(n)
+        for group, group_value in zip(groups, group_values):
+            shapley_values[group] = group_value
+        logger.info(f"{len(values) - 1} coalition types trained, instead of {2 ** n - 1} coalitions")
+
+        self.name = "Symmetric Shapley"
+        self.contributivity_scores = shapley_values
+        self.scores_std = np.zeros(n)
+        self.normalized_scores = shapley_values / np.sum(shapley_values)
+        end = timer()
+        self.computation_time_sec = end - start
+
+    # %% compute Owen values, for grouped partners
+    def owen_values(self, samples=None):
+        """Compute the Owen value of each partner, with the groups of partners defined by scenario.partners_groups.
+
+        The Owen value is a Shapley value at two levels: the groups are players of a game between groups, and the
+        partners of a group share the value of their group. The only coalitions trained are unions of whole groups
+        plus a part of one group. At the group level the computation is exact. Within the groups, it is exact if
+        samples is None, otherwise the within-group Shapley values are estimated with samples random permutations."""
+        start = timer()
+        logger.info("# Launching computation of Owen values of all partners")
+
+        n = len(self.scenario.partners_list)
+        if self.scenario.partners_groups is None:
+            logger.warning("No partners_groups defined in the scenario, each partner is alone in its group, "
+                           "and the Owen values are the Shapley values")
+            grouped = []
+            groups = []
+        else:
+            grouped = [i for group in self.scenario.partners_groups for i in group]
+            groups = [list(group) for group in self.scenario.partners_groups]
+        groups += [[i] for i in range(n) if i not in grouped]
+        m = len(groups)
+
+        owen_values = np.zeros(n)
+        owen_variances = np.zeros(n)
+        for g, group in enumerate(groups):
+            other_groups = [h for h in range(m) if h != g]
+            for groups_count in range(m):
+                group_weight = factorial(groups_count) * factorial(m - groups_count - 1) / factorial(m)
+                for other_coalition in combinations(other_groups, groups_count):
+                    base = [i for h in other_coalition for i in groups[h]]
+
+                    def value(subset):
+                        return self.not_twice_characteristic(np.array(base + list(subset), dtype=int))
+
+                    if samples is None:
+                        # exact Shapley values of the partners within the group
+                        size = len(group)
+                        for i in group:
+                            rest = [j for j in group if j != i]
+                            for length in range(size):
+                                weight = factorial(length) * factorial(size - length - 1) / factorial(size)
+                                for subset in combinations(rest, length):
+                                    owen_values[i] += group_weight * weight * (value(subset + (i,)) - value(subset))
+                    else:
+                        # Shapley values within the group estimated by permutation sampling
+                        marginals = {i: [] for i in group}
+                        for _ in range(samples):
+                            prefix = []
+                            previous_value = value(prefix)
+                            for i in np.random.permutation(group):
+                                prefix.append(i)
+                                current_value = value(prefix)
+                                marginals[i].append(current_value - previous_value)
+                                previous_value = current_value
+                        for i in group:
+                            owen_values[i] += group_weight * np.mean(marginals[i])
+                            owen_variances[i] += group_weight ** 2 * np.var(marginals[i]) / samples
+
+        logger.info(f"{self.first_charac_fct_calls_count} coalitions trained, instead of {2 ** n - 1} for the "
+                    f"exact Shapley values")
+        self.name = "Owen values"
+        self.contributivity_scores = owen_values
+        self.scores_std = np.sqrt(owen_variances)
+        self.normalized_scores = owen_values / np.sum(owen_values)
+        end = timer()
+        self.computation_time_sec = end - start
+
+    # %% compute Shapley values with active selection of the coalitions trained
+    def active_SV(self, sv_accuracy=0.01, alpha=0.95):
+        """Return the Shapley values computed from the coalitions trained so far, the values of the others being
+        predicted by a Gaussian process surrogate on the data volumes of the coalition's partners.
+
+        The Shapley values are linear in the values of the coalitions, so the uncertainty of the surrogate is
+        propagated exactly to them. At each step, the coalition whose training most reduces the total variance of
+        the Shapley values is trained, until the confidence interval of every Shapley value is below sv_accuracy."""
+        start = timer()
+        logger.info("# Launching computation of Shapley values with active selection of the coalitions")
+
+        n = len(self.scenario.partners_list)
+        partners_idx = np.arange(n)
+        coalitions = [c for length in range(1, n + 1) for c in combinations(partners_idx, length)]
+        weights = shapley_weights(n, coalitions)
+
+        # coordinates of the coalitions: data volume of each partner in the coalition, relatively to the total
+        volumes = np.array([partner.data_volume for partner in self.scenario.partners_list], dtype=float)
+        coordinates = np.zeros((len(coalitions), n))
+        for c, coalition in enumerate(coalitions):
+            coordinates[c, list(coalition)] = volumes[list(coalition)]
+        coordinates /= np.sum(volumes)
+
+        # initial design: the grand coalition, the partners alone, and the grand coalition without each partner
+        for i in range(n):
+            self.not_twice_characteristic(np.array([i]))
+            self.not_twice_characteristic(np.delete(partners_idx, i))
+        self.not_twice_characteristic(partners_idx)
+
+        kernel = ConstantKernel(1.0) * RBF(length_scale=0.5, length_scale_bounds=(1e-2, 1e2)) \
+            + WhiteKernel(noise_level=1e-4, noise_level_bounds=(1e-8, 1e-1))
+        q = -norm.ppf((1 - alpha) / 2, loc=0, scale=1)
+        while True:
+            known = np.array([c in self.charac_fct_values for c in coalitions])
+            values = np.array([self.charac_fct_values.get(c, 0.) for c in coalitions])
+            unknown_idx = np.flatnonzero(~known)
+            if len(unknown_idx) == 0:
+                sv_std = np.zeros(n)
+                break
+
+            # fit the surrogate on the coalitions known, and the empty coalition
+            surrogate = GaussianProcessRegressor(kernel=kernel, normalize_y=True)
+            surrogate.fit(np.vstack([np.zeros(n), coordinates[known]]), np.append(0., values[known]))
+            mean, covariance = surrogate.predict(coordinates[unknown_idx], return_cov=True)
+            values[unknown_idx] = mean
+
+            # propagate the uncertainty to the Shapley values
+            weights_unknown = weights[:, unknown_idx]
+            sv_std = np.sqrt(np.maximum(np.einsum('ij,jk,ik->i', weights_unknown, covariance, weights_unknown), 0))
+            if np.all(q * sv_std < sv_accuracy):
+                break
+
+            # train the coalition which most reduces the sum of the variances of the Shapley values
+            cross_covariance = weights_unknown.dot(covariance)
+            variance_reduction = np.sum(cross_covariance ** 2, axis=0) / np.maximum(np.diag(covariance), 1e-12)
+            self.not_twice_characteristic(np.array(coalitions[unknown_idx[np.argmax(variance_reduction)]]))
+
+        logger.info(f"{int(np.sum(known))} coalitions trained out of {len(coalitions)}")
+        self.name = "Active Shapley"
+        self.contributivity_scores = weights.dot(values)
+        self.scores_std = sv_std
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
     # %% compute independent raw scores
     def compute_independent_scores(self):
         start = timer()
@@ -194,13 +839,68 @@ class Contributivity:
         end = timer()
         self.computation_time_sec = end - start
 
+    # %% compute leave-one-out values
+    def leave_one_out(self, repeats=1, n_jobs=1):
+        """Compute the leave-one-out value of each partner, i.e. the performance of the grand coalition minus the
+        performance of the grand coalition without this partner. Only n+1 coalitions are trained."""
+        start = timer()
+
+        logger.info("# Launching computation of leave-one-out values of all partners")
+
+        n = len(self.scenario.partners_list)
+        all_partners = np.arange(n)
+        coalitions = [all_partners] + [np.delete(all_partners, i) for i in range(n)]
+
+        # Train the grand coalition and the n coalitions without one partner (in parallel if possible)
+        self.not_twice_characteristic_batch(coalitions, repeats=repeats, n_jobs=n_jobs)
+
+        # Compute the leave-one-out values for each repeat: array of shape (partners_count, repeats)
+        grand_coalition_scores = np.array(self.charac_fct_samples[tuple(all_partners)][:repeats])
+        loo_values = np.array([grand_coalition_scores
+                               - np.array(self.charac_fct_samples[tuple(coalition)][:repeats])
+                               for coalition in coalitions[1:]])
+
+        self.name = "Leave-one-out"
+        self.contributivity_scores = np.mean(loo_values, axis=1)
+        if repeats > 1:
+            self.scores_std = np.std(loo_values, axis=1) / np.sqrt(repeats - 1)
+        else:
+            self.scores_std = np.zeros(n)
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
     # %% compute Shapley values with the truncated Monte-carlo method
-    def truncated_MC(self, sv_accuracy=0.01, alpha=0.9, truncation=0.05):
+    def estimate_truncation(self, alpha=0.9, noise_repeats=3):
+        """Return a truncation threshold for the truncated Monte-Carlo methods, estimated from the noise of the
+        characteristic function: the grand coalition is evaluated noise_repeats times (the cached evaluations are
+        reused), and a remaining marginal contribution below the threshold is not statistically different from zero
+        at the level alpha."""
+        n = len(self.scenario.partners_list)
+        self.not_twice_characteristic_batch([np.arange(n)], repeats=noise_repeats)
+        noise_std = np.std(self.charac_fct_samples[tuple(range(n))], ddof=1)
+        # the remaining marginal is the difference of two noisy evaluations
+        truncation = norm.ppf(alpha, loc=0, scale=1) * np.sqrt(2) * noise_std
+        logger.info(f"Noise std of the characteristic function: {np.round(noise_std, 4)}, "
+                    f"truncation threshold: {np.round(truncation, 4)}")
+        if truncation >= abs(self.charac_fct_values[tuple(range(n))]):
+            logger.warning("The noise of the characteristic function is as large as the score of the grand coalition, "
+                           "every permutation will be truncated. Consider training the coalitions longer.")
+        return truncation
+
+    def truncated_MC(self, sv_accuracy=0.01, alpha=0.9, truncation=0.05, noise_repeats=3):
         """Return the vector of approximated Shapley value corresponding to a list of partner and
-        a characteristic function using the truncated monte-carlo method."""
+        a characteristic function using the truncated monte-carlo method.
+
+        If truncation is "adaptive", the truncation threshold is estimated from the noise of the characteristic
+        function. The number of trainings saved by the truncation, and the bias it introduces (mean value of the
+        marginal contributions ignored per permutation) are stored in self.truncation_report."""
         start = timer()
         n = len(self.scenario.partners_list)
 
+        if truncation == "adaptive" and n > 1:
+            truncation = self.estimate_truncation(alpha=alpha, noise_repeats=noise_repeats)
+
         # Characteristic function on all partners
         characteristic_all_partners = self.not_twice_characteristic(np.arange(n))
 
@@ -217,6 +917,9 @@ class Contributivity:
             t = 0
             q = norm.ppf((1 - alpha) / 2, loc=0, scale=1)
             v_max = 0
+            truncated_coalitions = set()  # coalitions skipped by the truncation, and never evaluated
+            ignored_marginals = []  # marginal contribution ignored by the truncation, for each permutation
+            outcomes_contributions = []  # marginal outcomes vectors of each permutation, if self.keep_outcomes
 
             # Check if the length of the confidence interval
             # is below the value of sv_accuracy*characteristic_all_partners
@@ -235,10 +938,13 @@ class Contributivity:
                     n + 1
                 )  # Store the characteristic function on each ensemble built with the first elements of the permutation
                 char_partnerlists[-1] = characteristic_all_partners
+                evaluated = np.ones(n, dtype=bool)  # Store which coalitions of the permutation are evaluated
                 for j in range(n):
                     # here we suppose the characteristic function is 0 for the empty set
                     if abs(characteristic_all_partners - char_partnerlists[j]) < truncation:
                         char_partnerlists[j + 1] = char_partnerlists[j]
+                        truncated_coalitions.add(tuple(np.sort(permutation[: j + 1])))
+                        evaluated[j] = False
                     else:
                         char_partnerlists[j + 1] = self.not_twice_characteristic(
                             permutation[: j + 1]
@@ -246,8 +952,24 @@ class Contributivity:
                     contributions[-1][permutation[j]] = (
                             char_partnerlists[j + 1] - char_partnerlists[j]
                     )
+                ignored_marginals.append(characteristic_all_partners - char_partnerlists[-1])
+                if self.keep_outcomes:
+                    outcomes_contributions.append(self.permutation_outcomes_marginals(permutation, evaluated))
                 v_max = np.max(np.var(contributions, axis=0))
             sv = np.mean(contributions, axis=0)
+            saved_trainings = len(truncated_coalitions.difference(self.charac_fct_values))
+            self.truncation_report = {'truncation': truncation,
+                                      'saved_trainings': saved_trainings,
+                                      'bias': np.mean(ignored_marginals)}
+            logger.info(f"Truncation threshold {np.round(truncation, 4)}: {saved_trainings} trainings saved, "
+                        f"mean marginal contribution ignored per permutation: "
+                        f"{np.round(self.truncation_report['bias'], 4)}")
+            if self.keep_outcomes:
+                if any(marginals is None for marginals in outcomes_contributions):
+                    logger.warning("The outcomes of some coalitions evaluated by TMCS are missing")
+                    self.permutations_outcomes_scores = None
+                else:
+                    self.permutations_outcomes_scores = np.mean(outcomes_contributions, axis=0)
             self.name = "TMC Shapley"
             self.contributivity_scores = sv
             self.scores_std = np.std(contributions, axis=0) / np.sqrt(t - 1)
@@ -257,11 +979,18 @@ class Contributivity:
 
     # %% compute Shapley values with the truncated Monte-carlo method with a small bias correction
 
-    def interpol_TMC(self, sv_accuracy=0.01, alpha=0.9, truncation=0.05):
+    def interpol_TMC(self, sv_accuracy=0.01, alpha=0.9, truncation=0.05, noise_repeats=3):
         """Return the vector of approximated Shapley value corresponding to a list of partner and a characteristic
-        function using the interpolated truncated monte-carlo method."""
+        function using the interpolated truncated monte-carlo method.
+
+        The truncation threshold can be "adaptive", and the truncation is reported in self.truncation_report, as for
+        the truncated Monte-Carlo method."""
         start = timer()
         n = len(self.scenario.partners_list)
+
+        if truncation == "adaptive" and n > 1:
+            truncation = self.estimate_truncation(alpha=alpha, noise_repeats=noise_repeats)
+
         # Characteristic function on all partners
         characteristic_all_partners = self.not_twice_characteristic(np.arange(n))
         if n == 1:
@@ -277,6 +1006,8 @@ class Contributivity:
             t = 0
             q = norm.ppf((1 - alpha) / 2, loc=0, scale=1)
             v_max = 0
+            truncated_coalitions = set()  # coalitions interpolated by the truncation, and never evaluated
+            ignored_marginals = []  # marginal contribution ignored by the truncation, for each permutation
             while (
                     t < 100 or t < q ** 2 * v_max / (sv_accuracy) ** 2
             ):  # Check if the length of the confidence interval
@@ -307,6 +1038,7 @@ class Contributivity:
                         size_of_S = len(self.scenario.partners_list[j].y_train)
 
                         char_partnerlists[j + 1] = char_partnerlists[j] + a * size_of_S
+                        truncated_coalitions.add(tuple(np.sort(permutation[: j + 1])))
 
                     else:
                         char_partnerlists[j + 1] = self.not_twice_characteristic(
@@ -315,8 +1047,16 @@ class Contributivity:
                     contributions[-1][permutation[j]] = (
                             char_partnerlists[j + 1] - char_partnerlists[j]
                     )
+                ignored_marginals.append(characteristic_all_partners - char_partnerlists[-1])
                 v_max = np.max(np.var(contributions, axis=0))
             sv = np.mean(contributions, axis=0)
+            saved_trainings = len(truncated_coalitions.difference(self.charac_fct_values))
+            self.truncation_report = {'truncation': truncation,
+                                      'saved_trainings': saved_trainings,
+                                      'bias': np.mean(ignored_marginals)}
+            logger.info(f"Truncation threshold {np.round(truncation, 4)}: {saved_trainings} trainings saved, "
+                        f"mean marginal contribution ignored per permutation: "
+                        f"{np.round(self.truncation_report['bias'], 4)}")
             self.name = "ITMCS"
             self.contributivity_scores = sv
             self.scores_std = np.std(contributions, axis=0) / np.sqrt(t - 1)
@@ -821,6 +1561,111 @@ class Contributivity:
             end = timer()
             self.computation_time_sec = end - start
 
+    # %% compute Shapley values with the complementary contributions method
+
+    def complementary_contribution_SV(self, sv_accuracy=0.01, alpha=0.95, min_samples=5):
+        """Return the vector of approximated Shapley values using the stratified sampling of complementary
+        contributions (Zhang et al., 2023, "Efficient sampling approaches to Shapley value approximation").
+
+        The complementary contribution of a coalition S is v(S) - v(N \\ S). The Shapley value of a partner i is the
+        mean over the sizes k of the mean complementary contribution of the coalitions of size k containing i. Each
+        sampled coalition S thus gives a sample to all the partners of S (stratum k), and its opposite to all the
+        other partners (stratum n - k)."""
+        start = timer()
+
+        n = len(self.scenario.partners_list)
+        characteristic_all_partners = self.not_twice_characteristic(np.arange(n))
+
+        if n == 1:
+            self.name = "Complementary contributions Shapley"
+            self.contributivity_scores = np.array([characteristic_all_partners])
+            self.scores_std = np.array([0])
+            self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+            end = timer()
+            self.computation_time_sec = end - start
+        else:
+            # complementary contributions sampled, per partner and per size of the coalition containing the partner
+            contributions = [[[] for _ in range(n)] for _ in range(n)]
+            q = -norm.ppf((1 - alpha) / 2, loc=0, scale=1)
+            v_max = np.Inf
+            # Check if the length of the confidence interval is below the value of sv_accuracy
+            while q * np.sqrt(v_max) > sv_accuracy:
+                size = np.random.randint(1, n + 1)
+                subset = np.sort(np.random.choice(n, size, replace=False))
+                complement = np.setdiff1d(np.arange(n), subset)
+                complementary_contribution = self.not_twice_characteristic(subset) \
+                    - self.not_twice_characteristic(complement)
+                for i in subset:
+                    contributions[i][size - 1].append(complementary_contribution)
+                for i in complement:
+                    contributions[i][n - size - 1].append(- complementary_contribution)
+
+                samples_count = np.array([[len(stratum) for stratum in partner_strata]
+                                          for partner_strata in contributions])
+                if np.min(samples_count) < min_samples:
+                    continue
+                mu = np.array([[np.mean(stratum) for stratum in partner_strata] for partner_strata in contributions])
+                sigma2 = np.array([[np.var(stratum) for stratum in partner_strata]
+                                   for partner_strata in contributions])
+                var = np.sum(sigma2 / samples_count, axis=1) / n ** 2  # variance of the estimator
+                v_max = np.max(var)
+
+            self.name = "Complementary contributions Shapley"
+            self.contributivity_scores = np.mean(mu, axis=1)
+            self.scores_std = np.sqrt(var)
+            self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+            end = timer()
+            self.computation_time_sec = end - start
+
+    # %% compute Shapley values with the gradient Shapley method, one single pass training per permutation
+
+    def gradient_shapley(self, sv_accuracy=0.01, alpha=0.95, learning_rate=0.01, permutations_count=None, n_jobs=1,
+                         min_permutations=10):
+        """Return the vector of approximated Shapley values using the gradient Shapley method (G-Shapley, Ghorbani and
+        Zou, 2019, "Data Shapley: equitable valuation of data for machine learning").
+
+        For each permutation of the partners, a model is trained in a single pass: the data of each partner in turn
+        are applied as SGD steps, and the increase of the validation accuracy is its marginal contribution. A
+        permutation thus costs about one epoch instead of n trainings. If permutations_count is None, permutations
+        are sampled until the confidence interval is below sv_accuracy. They are dispatched on n_jobs workers."""
+        start = timer()
+
+        n = len(self.scenario.partners_list)
+        initial_weights = self.scenario.dataset.generate_new_model().get_weights()
+        jobs_count = effective_n_jobs(n_jobs)
+        if jobs_count == 1:
+            trainer = fast_mpl.FastGradientShapley(self.scenario, learning_rate, initial_weights)
+        else:
+            scenario = self.scenario.copy_for_workers()
+
+        contributions = np.zeros((0, n))
+        q = -norm.ppf((1 - alpha) / 2, loc=0, scale=1)
+        v_max = np.Inf
+        while (len(contributions) < permutations_count if permutations_count is not None
+               else len(contributions) < min_permutations or q * np.sqrt(v_max) > sv_accuracy):
+            if jobs_count == 1:
+                marginals = [trainer.permutation_marginals(np.random.permutation(n))]
+            else:
+                # each worker builds its model once per round, so it is given several permutations
+                if permutations_count is not None:
+                    round_size = permutations_count - len(contributions)
+                else:
+                    round_size = jobs_count * int(np.ceil(min_permutations / jobs_count))
+                permutations = [np.random.permutation(n) for _ in range(round_size)]
+                marginals = Parallel(n_jobs=jobs_count)(
+                    delayed(gradient_shapley_marginals)(scenario, chunk, learning_rate, initial_weights)
+                    for chunk in np.array_split(permutations, jobs_count) if len(chunk) > 0)
+            contributions = np.vstack([contributions] + list(marginals))
+            v_max = np.max(np.var(contributions, axis=0)) / len(contributions)
+        logger.info(f"Gradient Shapley: {len(contributions)} permutations done")
+
+        self.name = "Gradient Shapley"
+        self.contributivity_scores = np.mean(contributions, axis=0)
+        self.scores_std = np.std(contributions, axis=0) / np.sqrt(len(contributions))
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
     # %% compute Shapley values with the without replacement stratified sampling method
 
     def without_replacment_SMC(self, sv_accuracy=0.01, alpha=0.95):
@@ -942,7 +1787,74 @@ class Contributivity:
 
     # %% compute Partner value by reinforcement learning
 
-    def PVRL(self, learning_rate):
+    def PVRL(self, learning_rate, rollouts_count=4, rollout_minibatches=None):
+        """Partner valuation by reinforcement learning, on the FastPVRL engine. The value of each partner is the
+        probability to select it for a training round, learnt with REINFORCE: the reward of a selection is the decrease
+        of the validation loss after rollout_minibatches rounds (an epoch by default) of training with the selected
+        partners only. At each update, rollouts_count selections are sampled and trained from the same model and
+        optimizers' state, on the same minibatches, and the policy gradient is averaged over them, with the mean reward
+        of the other rollouts as baseline, and scaled by the standard deviation of the rewards. The rollouts are
+        trained together, by a single compiled step per round, which skips the local steps of the partners not
+        selected. The training then goes on from the state of the first rollout."""
+        if not isinstance(self.scenario.dataset.generate_new_model(), tf.keras.Model) \
+                or self.scenario.partners_count == 1:
+            logger.info("PVRL on the fast engine needs a Keras model and several partners, the basic engine is used")
+            return self.basic_PVRL(learning_rate)
+        start = timer()
+        n = self.scenario.partners_count
+        w = np.zeros(n)
+        partner_values = 1 / (1 + np.exp(-w))
+
+        mpl = fast_mpl.FastPVRL(self.scenario,
+                                rollouts_count=rollouts_count,
+                                is_early_stopping=False,
+                                init_model_from="random_initialization",
+                                use_saved_weights=False,
+                                save_folder=None,
+                                **self.scenario.mpl_kwargs)
+        if rollout_minibatches is None:
+            rollout_minibatches = mpl.minibatch_count
+        previous_loss = mpl.val_loss()
+        for update in range(mpl.epoch_count):
+            # Sample the selections of partners / the actions, conditioned on selecting at least one partner
+            masks = np.random.binomial(1, p=partner_values, size=(rollouts_count, n))
+            for k in np.flatnonzero(masks.sum(axis=1) == 0):
+                while masks[k].sum() == 0:
+                    masks[k] = np.random.binomial(1, p=partner_values)
+
+            # Apply the rollouts from the same state and on the same minibatches / do the actions
+            losses = mpl.rollouts(masks, mpl.next_rounds(rollout_minibatches))
+            rewards = previous_loss - losses
+            if rollouts_count > 1:
+                # The advantages are scaled by the spread of the rewards, so the step size does not depend on the
+                # scale of the loss
+                advantages = rewards - (rewards.sum() - rewards) / (rollouts_count - 1)
+                advantages /= np.std(rewards) + 1e-8
+            else:
+                advantages = rewards
+
+            # Update the weights according to the REINFORCE method. The gradient of the log-probability of a mask
+            # includes the conditioning on selecting at least one partner
+            none_selected_probability = np.prod(1 - partner_values)
+            grads = masks - partner_values \
+                - none_selected_probability * partner_values / (1 - none_selected_probability)
+            w = w + learning_rate * np.mean(advantages[:, None] * grads, axis=0)
+            partner_values = 1 / (1 + np.exp(-w))
+            previous_loss = losses[0]
+            logger.info(f"PVRL update {update + 1}/{mpl.epoch_count}, rewards: {np.round(rewards, 3)}, "
+                        f"partner values: {np.round(partner_values, 3)}")
+
+        mpl.history.score = mpl.model.evaluate(mpl.test_data, return_dict=True, verbose=False)
+        logger.info(f"PVRL final model test scores: {mpl.history.score}")
+
+        self.name = "PVRL"
+        self.contributivity_scores = partner_values
+        self.scores_std = np.zeros(n)
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
+    def basic_PVRL(self, learning_rate):
         start = timer()
         w = np.zeros(self.scenario.partners_count)
         partner_values = np.exp(w) / (1.0 + np.exp(w))
@@ -1083,16 +1995,24 @@ class Contributivity:
 
         # Fetch score matrices from computation and scenario characteristics
         multi_partner_learning = self.scenario.mpl
-        score_matrix_collective_models = multi_partner_learning.history.history['mpl_model']['val_accuracy']
-        partner_score_matrix = [value['val_accuracy'] for key, value in multi_partner_learning.history.history.items()
-                                if key != 'mpl_model']
+        history = multi_partner_learning.history
+        if history.rounds_val_accuracy is not None:  # fast mpl, which scored each aggregation round
+            scores_history = history.rounds_val_accuracy
+        elif isinstance(history.history['mpl_model'].get('val_accuracy'), np.ndarray):
+            scores_history = {key: value['val_accuracy'] for key, value in history.history.items()}
+        else:
+            raise ValueError(f"The federated step by step methods need the scores of each aggregation round, which "
+                             f"{multi_partner_learning.name} did not record. With FastFedAvg or FastFedGrad, set "
+                             f"mpl_track_rounds_scores=True in the scenario")
+        score_matrix_collective_models = scores_history['mpl_model']
+        partner_score_matrix = [value for key, value in scores_history.items() if key != 'mpl_model']
         # the shape of the matrix created is (partners_count, epoch_count, minibatch_count).
         score_matrix_per_partner = np.swapaxes(np.swapaxes(partner_score_matrix, 0, 2), 0, 1)
         # We swap twice the axis to end with a matrix with shape (epoch_count, minibatch_count, partners_count)
 
         partners_count = multi_partner_learning.partners_count
-        epoch_count = multi_partner_learning.epoch_count
-        minibatch_count = multi_partner_learning.minibatch_count
+        # The fast mpl can have more aggregation rounds per epoch than minibatch_count
+        epoch_count, minibatch_count = np.shape(score_matrix_collective_models)
 
         # Calculate first and last computation round kept for contributivity measure
         first_comp_round_kept = int(np.round(epoch_count * minibatch_count * init_comp_rounds_skipped))
@@ -1115,14 +2035,19 @@ class Contributivity:
 
     def s_model(self):  # TOD refacto
         start = timer()
-        mpl = basic_mpl.FedAvgSmodel(self.scenario)
+        approach = select_mpl_engine(self.scenario, basic_mpl.FedAvgSmodel) if self.fast_engines \
+            else basic_mpl.FedAvgSmodel
+        mpl = approach(self.scenario, **self.scenario.mpl_kwargs)
         mpl.fit()
         theta_estimated = np.zeros((mpl.partners_count,
                                     mpl.dataset.num_classes,
                                     mpl.dataset.num_classes))
         for i, partnerMpl in enumerate(mpl.partners_list):
-            theta_estimated[i] = (np.exp(partnerMpl.noise_layer_weights) / np.sum(
-                np.exp(partnerMpl.noise_layer_weights), axis=2))
+            if isinstance(mpl, fast_mpl.FastFedAvgSmodel):  # the fast engine trains the noise layers in its smodels
+                noise_layer_weights = mpl.smodel_list[i].get_weights()
+            else:
+                noise_layer_weights = partnerMpl.noise_layer_weights
+            theta_estimated[i] = (np.exp(noise_layer_weights) / np.sum(np.exp(noise_layer_weights), axis=2))
         self.contributivity_scores = np.exp(- np.array([np.linalg.norm(
             theta_estimated[i] - np.identity(mpl.dataset.num_classes)
         ) for i in range(len(self.scenario.partners_list))]))
@@ -1133,71 +2058,374 @@ class Contributivity:
         end = timer()
         self.computation_time_sec = end - start
 
+    def confident_learning(self):
+        """Estimate the label noise matrix of each partner with confident learning (Northcutt et al., 2021,
+        "Confident learning: estimating uncertainty in dataset labels"), from the predicted probabilities of the main
+        model, without any additional training. The scores are exp(-||noise matrix - identity||), as for S-Model.
+
+        The predictions are made on the local validation data of the partners if val_set is 'local', as they were not
+        used for training. Otherwise they are made on the train data, and the noise is underestimated as the model
+        may have fitted the noisy labels."""
+        start = timer()
+        logger.info("# Launching the confident learning estimation of the partners' label noise")
+        model = get_mpl_model(self.get_main_mpl())
+        if self.scenario.val_set == 'local':
+            partners_data = [(partner.x_val, partner.y_val) for partner in self.scenario.partners_list]
+        else:
+            logger.warning("Confident learning uses the predictions of the main model on the data it was trained on, "
+                           "the label noise can be underestimated. Use val_set='local' to avoid it")
+            partners_data = [(partner.x_train, partner.y_train) for partner in self.scenario.partners_list]
+        probabilities = np.concatenate([predict_probabilities(model, x) for x, _ in partners_data])
+        labels = np.concatenate([labels_to_int(y) for _, y in partners_data])
+        groups = np.concatenate([np.full(len(y), i) for i, (_, y) in enumerate(partners_data)])
+        self.noise_matrices = confident_learning_noise_matrices(labels, probabilities, groups)
+
+        self.name = "Confident learning"
+        identity = np.identity(probabilities.shape[1])
+        self.contributivity_scores = np.exp(- np.array([np.linalg.norm(noise_matrix - identity)
+                                                        for noise_matrix in self.noise_matrices]))
+        self.scores_std = np.zeros(len(self.scenario.partners_list))
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
+    def get_main_mpl(self):
+        """Return the main multi-partner learning of the scenario, trained on all partners. It is trained if the
+        scenario has not been run yet."""
+        if self.scenario.mpl is None:
+            logger.info("No trained main mpl found, training one on all partners")
+            self.scenario.mpl = self.scenario._multi_partner_learning_approach(self.scenario,
+                                                                               save_folder=None,
+                                                                               **self.scenario.mpl_kwargs)
+            self.scenario.mpl.fit()
+        return self.scenario.mpl
+
+    # %% compute KNN-Shapley values, without any training
+    def knn_shapley(self, k=5, features="raw"):
+        """Compute the exact Shapley values of all the training samples for a K-nearest-neighbors classifier
+        evaluated on the test set, and sum them per partner. No model is trained when features is "raw". With
+        features="embedding", the samples are represented by the penultimate layer of the main mpl model.
+
+        The samples with a negative value are flagged, as they are likely to be mislabelled. For the corrupted
+        partners, the flagged samples are compared to the samples actually corrupted."""
+        start = timer()
+        logger.info(f"# Launching computation of KNN-Shapley values of all samples, with {features} features")
+
+        partners_list = self.scenario.partners_list
+        x_train = np.concatenate([partner.x_train for partner in partners_list])
+        y_train = np.concatenate([labels_to_int(partner.y_train) for partner in partners_list])
+        groups = np.concatenate([np.full(len(partner.y_train), i) for i, partner in enumerate(partners_list)])
+        x_test, y_test = self.scenario.dataset.x_test, labels_to_int(self.scenario.dataset.y_test)
+
+        if features == "embedding":
+            model = get_mpl_model(self.get_main_mpl())
+            x_train, x_test = compute_embeddings(model, x_train), compute_embeddings(model, x_test)
+        elif features != "raw":
+            raise ValueError(f"KNN-Shapley features must be 'raw' or 'embedding', not {features}")
+
+        values, partners_values = knn_shapley_values(x_train, y_train, x_test, y_test, k=k, groups=groups)
+
+        self.samples_values = [values[groups == i] for i in range(len(partners_list))]
+        self.flagged_samples = [np.flatnonzero(partner_values < 0) for partner_values in self.samples_values]
+        for partner, flagged in zip(partners_list, self.flagged_samples):
+            message = f"Partner #{partner.id}: {len(flagged)} samples flagged out of {partner.data_volume}"
+            if not isinstance(partner.corruption, NoCorruption):
+                corrupted = partner.corruption.corrupted_train_index
+                detected = len(np.intersect1d(flagged, corrupted))
+                message += (f", {partner.corruption.name} corruption: "
+                            f"{detected}/{len(corrupted)} corrupted samples flagged")
+            logger.info(message)
+
+        self.name = "KNN-Shapley"
+        self.contributivity_scores = np.mean(partners_values, axis=0)
+        self.scores_std = np.std(partners_values, axis=0) / np.sqrt(len(x_test))
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
+    # %% detect the duplicated samples within and across partners, without any training
+    def duplicates_detection(self, bands_count=16, band_bits=16, similarity=0.95, quantization=None):
+        """Hash the train samples of the partners with locality-sensitive hashing, and estimate the share of the
+        samples of each partner duplicated in the other partners, and within the partner, two samples being near
+        duplicates if their estimated cosine similarity is at least similarity. They are stored in
+        self.duplicates_report. The scores are the numbers of distinct samples brought by the partners, the value of a
+        sample held by several partners being shared equally between them (Shapley values of the number of distinct
+        samples of a coalition)."""
+        start = timer()
+        logger.info("# Launching the detection of the duplicated samples of the partners")
+        self.duplicates_report = detect_duplicates([partner.x_train for partner in self.scenario.partners_list],
+                                                   bands_count=bands_count,
+                                                   band_bits=band_bits,
+                                                   similarity=similarity,
+                                                   quantization=quantization)
+        logger.info(f"Share of the samples of each partner (rows) duplicated in the other partners (columns):\n"
+                    f"{np.round(self.duplicates_report['overlap'], 3)}")
+
+        self.name = "Duplicates detection"
+        self.contributivity_scores = self.duplicates_report['distinct_samples_values']
+        self.scores_std = np.zeros(len(self.contributivity_scores))
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
+    # %% compute influence function values, from the main model only
+    def influence(self, damping=0.01, cg_iterations=30, hessian_samples=5000):
+        """Approximate the leave-one-out value of each partner with influence functions (Koh & Liang, 2017).
+
+        The increase of the test loss of the main model when the samples of a partner are removed is approximated by
+        s_test . sum(grad loss(z)) / n, where n is the total number of training samples, the sum runs over the samples
+        of the partner, and s_test = (H + damping * I)^-1 grad test loss. s_test is solved by conjugate gradient, with
+        Hessian-vector products computed on a random subset of hessian_samples training samples."""
+        start = timer()
+        logger.info("# Launching computation of influence function values of all partners")
+
+        model = get_mpl_model(self.get_main_mpl())
+        if not isinstance(model, tf.keras.Model):
+            raise ValueError("The influence method only handles Keras based models")
+        loss_function = tf.keras.losses.get(model.loss)
+        params = model.trainable_variables
+
+        partners_list = self.scenario.partners_list
+        x_train = np.concatenate([partner.x_train for partner in partners_list])
+        y_train = np.concatenate([partner.y_train for partner in partners_list])
+        hessian_idx = np.random.choice(len(x_train), size=min(hessian_samples, len(x_train)), replace=False)
+        x_hessian, y_hessian = x_train[hessian_idx], y_train[hessian_idx]
+        batch_size = constants.DEFAULT_BATCH_SIZE
+
+        @tf.function
+        def batch_gradient(x, y):
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_sum(loss_function(y, model(x, training=False)))
+            return tape.gradient(loss, params)
+
+        @tf.function
+        def batch_hvp(x, y, vector):
+            with tf.GradientTape() as outer_tape:
+                with tf.GradientTape() as inner_tape:
+                    loss = tf.reduce_sum(loss_function(y, model(x, training=False)))
+                grads = inner_tape.gradient(loss, params)
+                grads_dot_vector = tf.add_n([tf.reduce_sum(g * v) for g, v in zip(grads, vector)])
+            return outer_tape.gradient(grads_dot_vector, params)
+
+        def flatten(tensors):
+            return np.concatenate([tf.reshape(t, [-1]).numpy() for t in tensors])
+
+        def unflatten(vector):
+            tensors, offset = [], 0
+            for p in params:
+                size = int(np.prod(p.shape))
+                tensors.append(tf.constant(vector[offset:offset + size].reshape(p.shape), dtype=p.dtype))
+                offset += size
+            return tensors
+
+        def summed_gradient(x, y):
+            """Sum of the gradients of the loss of the samples (x, y), computed by batches"""
+            total = np.zeros(sum(int(np.prod(p.shape)) for p in params))
+            for i in range(0, len(x), batch_size):
+                total += flatten(batch_gradient(x[i:i + batch_size], y[i:i + batch_size]))
+            return total
+
+        def hvp(vector):
+            """Product of the damped Hessian of the mean training loss with vector"""
+            vector_tensors = unflatten(vector)
+            total = np.zeros_like(vector)
+            for i in range(0, len(x_hessian), batch_size):
+                total += flatten(batch_hvp(x_hessian[i:i + batch_size], y_hessian[i:i + batch_size], vector_tensors))
+            return total / len(x_hessian) + damping * vector
+
+        x_test, y_test = self.scenario.dataset.x_test, self.scenario.dataset.y_test
+        test_gradient = summed_gradient(x_test, y_test) / len(x_test)
+        s_test = conjugate_gradient(hvp, test_gradient, max_iterations=cg_iterations)
+
+        influences = np.array([s_test.dot(summed_gradient(partner.x_train, partner.y_train))
+                               for partner in partners_list]) / len(x_train)
+
+        self.name = "Influence functions"
+        self.contributivity_scores = influences
+        self.scores_std = np.zeros(len(partners_list))
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
+    # %% compute gradient similarity scores, accumulated during a fast training
+    def gradient_similarity(self, similarity="cosine"):
+        """Score each partner with the similarity between its updates and the aggregated updates, accumulated during
+        the training of a fast mpl (FastFedAvg or FastFedGrad) with track_similarity=True.
+
+        If the main mpl of the scenario has tracked these statistics, they are used directly and no model is trained.
+        Otherwise a FastFedGrad (for gradient based approaches) or a FastFedAvg is trained once with the tracking on."""
+        start = timer()
+        logger.info("# Launching computation of gradient similarity scores of all partners")
+
+        mpl = self.scenario.mpl
+        if not isinstance(mpl, (fast_mpl.FastFedAvg, fast_mpl.FastFedGrad)) or not mpl.track_similarity:
+            if self.scenario._multi_partner_learning_approach in (basic_mpl.FederatedGradients,
+                                                                  fast_mpl.FastFedGrad):
+                approach = fast_mpl.FastFedGrad
+            else:
+                approach = fast_mpl.FastFedAvg
+            logger.info(f"The main mpl did not track the similarity statistics, training a {approach.name}")
+            mpl = approach(self.scenario, **{**self.scenario.mpl_kwargs, 'track_similarity': True})
+            mpl.fit()
+
+        cosine_similarities, cosine_std, projections = mpl.get_similarity_scores()
+        if similarity == "cosine":
+            self.contributivity_scores = cosine_similarities
+            self.scores_std = cosine_std
+        elif similarity == "projection":
+            self.contributivity_scores = projections
+            self.scores_std = np.zeros(len(projections))
+        else:
+            raise ValueError(f"Similarity must be 'cosine' or 'projection', not {similarity}")
+
+        self.name = "Gradient similarity"
+        self.normalized_scores = self.contributivity_scores / np.sum(self.contributivity_scores)
+        end = timer()
+        self.computation_time_sec = end - start
+
     def compute_contributivity(
             self,
             method_to_compute,
             sv_accuracy=0.01,
             alpha=0.95,
             truncation=0.05,
-            update=50
+            update=50,
+            repeats=1,
+            n_jobs=1,
+            characteristic="training",
+            exchangeable_groups=None,
+            owen_samples=None,
+            knn_k=5,
+            knn_features="raw",
+            influence_damping=0.01,
+            similarity="cosine",
+            model_store=False,
+            model_store_max_bytes=None,
+            epoch_curves=False,
+            vector_outcomes=False,
+            gshapley_learning_rate=0.01,
+            gshapley_permutations=None,
+            lsh_bands=16,
+            lsh_band_bits=16,
+            lsh_similarity=0.95,
+            lsh_quantization=None,
+            pvrl_rollouts=4,
+            fast_engines=True,
+            audit_log=False,
     ):
+        self.characteristic = characteristic
+        self.fast_engines = fast_engines
+        self.keep_curves = epoch_curves
+        self.keep_outcomes = vector_outcomes
+        if vector_outcomes and method_to_compute not in constants.VECTOR_OUTCOMES_METHODS:
+            raise ValueError(f"The scores of the vector outcomes can be computed with the methods "
+                             f"{constants.VECTOR_OUTCOMES_METHODS}, not {method_to_compute}")
+        if model_store:
+            self.init_coalition_store(max_bytes=model_store_max_bytes)
+        if audit_log:
+            self.init_audit_log(method_to_compute, path=None if audit_log is True else audit_log)
+
+        try:
+            if method_to_compute == "Shapley values":
+                # Contributivity 1: Baseline contributivity measurement (Shapley Value)
+                self.compute_SV(exchangeable_groups=exchangeable_groups)
+            elif method_to_compute == "Active Shapley":
+                # Contributivity 1 bis: Shapley values with a surrogate model of the coalitions not trained
+                self.active_SV(sv_accuracy=sv_accuracy, alpha=alpha)
+            elif method_to_compute == "Owen values":
+                # Contributivity 1 ter: Shapley values at the level of the partners' groups, then within the groups
+                self.owen_values(samples=owen_samples)
+            elif method_to_compute == "Independent scores":
+                # Contributivity 2: Performance scores of models trained independently on each partner
+                self.compute_independent_scores()
+            elif method_to_compute == "Leave-one-out":
+                # Contributivity 2 bis: Grand coalition versus grand coalition without each partner
+                self.leave_one_out(repeats=repeats, n_jobs=n_jobs)
+            elif method_to_compute == "TMCS":
+                # Contributivity 3: Truncated Monte Carlo Shapley
+                self.truncated_MC(
+                    sv_accuracy=sv_accuracy, alpha=alpha, truncation=truncation, noise_repeats=max(repeats, 3),
+                )
+            elif method_to_compute == "ITMCS":
+                # Contributivity 4: interpolated monte-carlo
+                self.interpol_TMC(
+                    sv_accuracy=sv_accuracy, alpha=alpha, truncation=truncation, noise_repeats=max(repeats, 3),
+                )
+            elif method_to_compute == "IS_lin_S":
+                # Contributivity 5: Importance sampling with linear interpolation model
+                self.IS_lin(sv_accuracy=sv_accuracy, alpha=alpha)
+            elif method_to_compute == "IS_reg_S":
+                # Contributivity 6: Importance sampling with regression model
+                self.IS_reg(sv_accuracy=sv_accuracy, alpha=alpha)
+            elif method_to_compute == "AIS_Kriging_S":
+                # Contributivity 7: Adaptative importance sampling with Kriging model
+                self.AIS_Kriging(sv_accuracy=sv_accuracy, alpha=alpha, update=update)
+            elif method_to_compute == "SMCS":
+                # Contributivity 8:  Stratified Monte Carlo
+                self.Stratified_MC(sv_accuracy=sv_accuracy, alpha=alpha)
+            elif method_to_compute == "WR_SMC":
+                # Contributivity 9: Without replacement Stratified Monte Carlo
+                self.without_replacment_SMC(sv_accuracy=sv_accuracy, alpha=alpha)
+            elif method_to_compute == "CC_Shapley":
+                # Contributivity 9 bis: Stratified sampling of complementary contributions
+                self.complementary_contribution_SV(sv_accuracy=sv_accuracy, alpha=alpha)
+            elif method_to_compute == "G-Shapley":
+                # Contributivity 9 ter: Shapley values with a single pass training per permutation
+                self.gradient_shapley(sv_accuracy=sv_accuracy, alpha=alpha, learning_rate=gshapley_learning_rate,
+                                      permutations_count=gshapley_permutations, n_jobs=n_jobs)
+            elif method_to_compute == "Federated SBS linear":
+                # Contributivity 10: step by step increments with linear importance increase
+                if self.scenario._multi_partner_learning_approach not in (basic_mpl.FederatedAverageLearning,
+                                                                          fast_mpl.FastFedAvg):
+                    logger.warning("Step by step linear contributivity method is only suited for federated "
+                                   "averaging learning approach")
+                self.federated_SBS_linear()
+            elif method_to_compute == "Federated SBS quadratic":
+                # Contributivity 11: step by step increments with quadratic importance increase
+                if self.scenario._multi_partner_learning_approach not in (basic_mpl.FederatedAverageLearning,
+                                                                          fast_mpl.FastFedAvg):
+                    logger.warning("Step by step quadratic contributivity method is only suited for federated "
+                                   "averaging learning approach")
+                self.federated_SBS_quadratic()
+            elif method_to_compute == "Federated SBS constant":
+                # Contributivity 12: step by step increments with constant importance
+                if self.scenario._multi_partner_learning_approach not in (basic_mpl.FederatedAverageLearning,
+                                                                          fast_mpl.FastFedAvg):
+                    logger.warning("Step by step constant contributivity method is only suited for federated "
+                                   "averaging learning approach")
+                self.federated_SBS_constant()
+            elif method_to_compute == "PVRL":
+                # Contributivity 10: Partner valuation by reinforcement learning
+                self.PVRL(learning_rate=0.2, rollouts_count=pvrl_rollouts)
+            elif method_to_compute == "S-Model":
+                self.s_model()
+            elif method_to_compute == "Confident learning":
+                # Label noise screening from the predictions of the main model, without any additional training
+                self.confident_learning()
+            elif method_to_compute == "KNN-Shapley":
+                # Training-free valuation of the samples, summed per partner
+                self.knn_shapley(k=knn_k, features=knn_features)
+            elif method_to_compute == "Duplicates detection":
+                # Training-free estimation of the duplicated samples, within and across partners
+                self.duplicates_detection(bands_count=lsh_bands, band_bits=lsh_band_bits, similarity=lsh_similarity,
+                                          quantization=lsh_quantization)
+            elif method_to_compute == "Influence functions":
+                # Approximated leave-one-out values, computed from the main model without retraining
+                self.influence(damping=influence_damping)
+            elif method_to_compute == "Gradient similarity":
+                # Similarity of the partners' updates with the aggregated ones, accumulated during a fast training
+                self.gradient_similarity(similarity=similarity)
+            else:
+                logger.warning("Unrecognized name of method, statement ignored!")
 
-        if method_to_compute == "Shapley values":
-            # Contributivity 1: Baseline contributivity measurement (Shapley Value)
-            self.compute_SV()
-        elif method_to_compute == "Independent scores":
-            # Contributivity 2: Performance scores of models trained independently on each partner
-            self.compute_independent_scores()
-        elif method_to_compute == "TMCS":
-            # Contributivity 3: Truncated Monte Carlo Shapley
-            self.truncated_MC(
-                sv_accuracy=sv_accuracy, alpha=alpha, truncation=truncation,
-            )
-        elif method_to_compute == "ITMCS":
-            # Contributivity 4: interpolated monte-carlo
-            self.interpol_TMC(
-                sv_accuracy=sv_accuracy, alpha=alpha, truncation=truncation,
-            )
-        elif method_to_compute == "IS_lin_S":
-            # Contributivity 5: Importance sampling with linear interpolation model
-            self.IS_lin(sv_accuracy=sv_accuracy, alpha=alpha)
-        elif method_to_compute == "IS_reg_S":
-            # Contributivity 6: Importance sampling with regression model
-            self.IS_reg(sv_accuracy=sv_accuracy, alpha=alpha)
-        elif method_to_compute == "AIS_Kriging_S":
-            # Contributivity 7: Adaptative importance sampling with Kriging model
-            self.AIS_Kriging(sv_accuracy=sv_accuracy, alpha=alpha, update=update)
-        elif method_to_compute == "SMCS":
-            # Contributivity 8:  Stratified Monte Carlo
-            self.Stratified_MC(sv_accuracy=sv_accuracy, alpha=alpha)
-        elif method_to_compute == "WR_SMC":
-            # Contributivity 9: Without replacement Stratified Monte Carlo
-            self.without_replacment_SMC(sv_accuracy=sv_accuracy, alpha=alpha)
-        elif method_to_compute == "Federated SBS linear":
-            # Contributivity 10: step by step increments with linear importance increase
-            if self.scenario._multi_partner_learning_approach != basic_mpl.FederatedAverageLearning:
-                logger.warning("Step by step linear contributivity method is only suited for federated "
-                               "averaging learning approach")
-            self.federated_SBS_linear()
-        elif method_to_compute == "Federated SBS quadratic":
-            # Contributivity 11: step by step increments with quadratic importance increase
-            if self.scenario._multi_partner_learning_approach != basic_mpl.FederatedAverageLearning:
-                logger.warning("Step by step quadratic contributivity method is only suited for federated "
-                               "averaging learning approach")
-            self.federated_SBS_quadratic()
-        elif method_to_compute == "Federated SBS constant":
-            # Contributivity 12: step by step increments with constant importance
-            if self.scenario._multi_partner_learning_approach != basic_mpl.FederatedAverageLearning:
-                logger.warning("Step by step constant contributivity method is only suited for federated "
-                               "averaging learning approach")
-            self.federated_SBS_constant()
-        elif method_to_compute == "PVRL":
-            # Contributivity 10: Partner valuation by reinforcement learning
-            self.PVRL(learning_rate=0.2)
-        elif method_to_compute == "S-Model":
-            self.s_model()
-        else:
-            logger.warning("Unrecognized name of method, statement ignored!")
+            if epoch_curves:
+                self.compute_epochs_SV(tolerance=sv_accuracy)
+            if vector_outcomes:
+                self.compute_outcomes_scores(method=method_to_compute)
+        finally:
+            if self.audit_log is not None:
+                self.audit_summary = self.audit_log.close()
+                self.audit_log = None
 
 
 # From: https://github.com/susobhang70/shapley_value
@@ -1253,3 +2481,271 @@ def shapley_value(partners_count, char_func_list):  # Updated by @arthurPignet
         shapley_values.append(shapley)
 
     return shapley_values  # Added by @bowni
+
+
+def labels_to_int(y):
+    """Return integer class labels from one-hot encoded or scalar labels"""
+    if y.ndim > 1 and y.shape[1] > 1:
+        return np.argmax(y, axis=1)
+    return y.reshape(-1).astype(int)
+
+
+def confident_learning_noise_matrices(labels, probabilities, groups):
+    """Return the noise matrix of each group of samples, estimated by confident learning: the element (i, j) of the
+    noise matrix of a group is the probability that a sample of true class j is labelled i.
+
+    A sample is confidently of class j if its predicted probability of j is above the mean predicted probability of j
+    over the samples labelled j (the largest such probability is kept). The counts of the pairs (label, confident
+    class) of each group are calibrated to the numbers of samples per label, then normalized per true class."""
+    num_classes = probabilities.shape[1]
+    labels_count = np.bincount(labels, minlength=num_classes)
+    thresholds = np.array([np.mean(probabilities[labels == c, c]) if labels_count[c] > 0 else np.inf
+                           for c in range(num_classes)])
+    is_above = probabilities >= thresholds
+    confident_classes = np.argmax(np.where(is_above, probabilities, -np.inf), axis=1)
+    is_confident = np.any(is_above, axis=1)
+
+    groups_count = np.max(groups) + 1
+    noise_matrices = np.zeros((groups_count, num_classes, num_classes))
+    for g in range(groups_count):
+        in_group = groups == g
+        confident_joint = np.zeros((num_classes, num_classes))
+        np.add.at(confident_joint, (labels[in_group & is_confident], confident_classes[in_group & is_confident]), 1)
+        # Calibrate the rows to the numbers of samples per label
+        rows_sum = confident_joint.sum(axis=1, keepdims=True)
+        group_labels_count = np.bincount(labels[in_group], minlength=num_classes)[:, None]
+        joint = np.divide(confident_joint * group_labels_count, rows_sum,
+                          out=np.zeros_like(confident_joint), where=rows_sum > 0)
+        # Normalize per true class. A class without any confident sample is considered noise-free
+        columns_sum = joint.sum(axis=0, keepdims=True)
+        noise_matrices[g] = np.divide(joint, columns_sum, out=np.identity(num_classes), where=columns_sum > 0)
+    return noise_matrices
+
+
+def shapley_weights(partners_count, coalitions):
+    """Return the matrix W of shape (partners_count, len(coalitions)) such that the Shapley values are W.dot(v), where
+    v holds the values of the coalitions. coalitions must list all the non-empty coalitions, whose value is v.
+    The value of the empty coalition is 0."""
+    n = partners_count
+    weights = np.zeros((n, len(coalitions)))
+    for c, coalition in enumerate(coalitions):
+        size = len(coalition)
+        in_coalition = np.zeros(n, dtype=bool)
+        in_coalition[list(coalition)] = True
+        # v(S) is added for the partners of S, and subtracted for the others
+        weights[in_coalition, c] = factorial(size - 1) * factorial(n - size) / factorial(n)
+        if size < n:
+            weights[~in_coalition, c] = - factorial(size) * factorial(n - size - 1) / factorial(n)
+    return weights
+
+
+def conjugate_gradient(matvec, b, max_iterations=30, tol=1e-5):
+    """Solve A x = b for a symmetric positive definite A, given only by the function matvec: x -> A x"""
+    x = np.zeros_like(b)
+    residual = b.copy()
+    direction = residual.copy()
+    residual_sq_norm = residual.dot(residual)
+    b_norm = np.sqrt(b.dot(b))
+    for _ in range(max_iterations):
+        if np.sqrt(residual_sq_norm) <= tol * b_norm:
+            break
+        a_direction = matvec(direction)
+        step = residual_sq_norm / direction.dot(a_direction)
+        x += step * direction
+        residual -= step * a_direction
+        new_residual_sq_norm = residual.dot(residual)
+        direction = residual + (new_residual_sq_norm / residual_sq_norm) * direction
+        residual_sq_norm = new_residual_sq_norm
+    return x
+
+
+def fit_linear_probe(x_train, y_train, x_test, y_test, num_classes, l2=1e-3, max_iterations=100):
+    """Train a L2-regularized softmax regression on (x_train, y_train) with L-BFGS, and return its accuracy on
+    (x_test, y_test). Labels are given as integers."""
+    mean, scale = x_train.mean(axis=0), x_train.std(axis=0) + 1e-8
+    x_train, x_test = (x_train - mean) / scale, (x_test - mean) / scale
+    x_train = np.hstack([x_train, np.ones((len(x_train), 1))])
+    x_test = np.hstack([x_test, np.ones((len(x_test), 1))])
+    one_hot = np.eye(num_classes)[y_train]
+    shape = (x_train.shape[1], num_classes)
+
+    def loss_and_gradient(flat_weights):
+        weights = flat_weights.reshape(shape)
+        logits = x_train.dot(weights)
+        logits -= logits.max(axis=1, keepdims=True)
+        log_probas = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+        loss = -np.sum(one_hot * log_probas) / len(x_train) + l2 / 2 * np.sum(weights ** 2)
+        gradient = x_train.T.dot(np.exp(log_probas) - one_hot) / len(x_train) + l2 * weights
+        return loss, gradient.ravel()
+
+    result = minimize(loss_and_gradient, np.zeros(np.prod(shape)), jac=True, method='L-BFGS-B',
+                      options={'maxiter': max_iterations})
+    predictions = np.argmax(x_test.dot(result.x.reshape(shape)), axis=1)
+    return np.mean(predictions == y_test)
+
+
+def get_mpl_model(mpl):
+    """Return a Keras model holding the final weights of a trained multi-partner learning"""
+    if isinstance(getattr(mpl, 'model', None), tf.keras.Model):
+        return mpl.model  # fast mpl engines, and approaches which keep their global model
+    return mpl.build_model()
+
+
+def get_epochs_done(mpl):
+    """Return the number of epochs run by a trained multi-partner learning, which is lower than its epoch_count if it
+    was early stopped"""
+    if isinstance(mpl, fast_mpl.FastFedAvg):
+        return mpl.epochs_index
+    return int(min(mpl.history.nb_epochs_done, mpl.epoch_count))
+
+
+def get_val_accuracy_curve(mpl):
+    """Return the validation accuracy of a trained multi-partner learning at the end of each of its epochs. If the
+    training was early stopped, the last value is repeated up to mpl.epoch_count."""
+    if isinstance(mpl, basic_mpl.SinglePartnerLearning):
+        curve = mpl.history.history[mpl.partner.id]['val_accuracy'][:, -1]
+        epochs_done = mpl.history.nb_epochs_done
+    elif isinstance(mpl.history.history['mpl_model']['val_accuracy'], list):
+        curve = np.array(mpl.history.history['mpl_model']['val_accuracy'])[-mpl.epoch_count:]  # fast mpl engines
+        epochs_done = len(curve)
+    else:
+        curve = mpl.history.history['mpl_model']['val_accuracy'][:, -1]
+        epochs_done = min(mpl.history.nb_epochs_done, mpl.epoch_count)
+    curve = np.array(curve[:epochs_done], dtype=float)
+    return np.concatenate([curve, np.full(mpl.epoch_count - epochs_done, curve[-1])])
+
+
+def convergence_epoch(trajectories, tolerance):
+    """Return the first epoch from which all the values of trajectories, of shape (epochs, partners_count), stay
+    within tolerance of their values at the last epoch"""
+    gaps = np.abs(trajectories - trajectories[-1]).max(axis=1)
+    not_converged = np.flatnonzero(gaps > tolerance)
+    return 0 if len(not_converged) == 0 else int(not_converged[-1] + 1)
+
+
+def outcomes_names(scenario):
+    """Return the names of the components of the outcomes vectors returned by coalition_outcomes"""
+    names = ['accuracy', 'loss'] + [f'accuracy_class_{c}' for c in range(max(2, scenario.dataset.num_classes))]
+    if scenario.test_set == 'local':
+        names += [f'accuracy_partner_{partner.id}' for partner in scenario.partners_list]
+    return names
+
+
+def predict_probabilities(model, x, batch_size=constants.DEFAULT_BATCH_SIZE):
+    """Return the predicted probabilities of each class, of shape (len(x), num_classes), for Keras, scikit-learn and
+    ensemble models"""
+    if isinstance(model, EnsemblePredictionsModel):
+        return np.mean([predict_probabilities(m, x, batch_size) for m in model.partners_model_list], axis=0)
+    if isinstance(model, tf.keras.Model):
+        probabilities = model.predict(x, batch_size=batch_size, verbose=0)
+    else:
+        probabilities = model.predict_proba(x)
+    return two_classes_probabilities(probabilities)
+
+
+def two_classes_probabilities(probabilities):
+    """Return the probabilities of the two classes, of shape (len(x), 2), if probabilities are the outputs of a binary
+    classifier with a single output, and probabilities unchanged otherwise"""
+    if probabilities.ndim == 1 or probabilities.shape[1] == 1:
+        probabilities = probabilities.reshape(-1)
+        probabilities = np.stack([1 - probabilities, probabilities], axis=1)
+    return probabilities
+
+
+class StackedModels:
+    """Several models of a dataset, evaluated together: with Keras models, they are the branches of a single model,
+    whose forward pass on a batch returns the outputs of all of them. Other models are evaluated one after another."""
+
+    def __init__(self, dataset, models_count):
+        self.models = [dataset.generate_new_model() for _ in range(models_count)]
+        self.stacked_model = None
+        if all(isinstance(model, tf.keras.Model) for model in self.models):
+            inputs = tf.keras.Input(shape=dataset.input_shape)
+            self.stacked_model = tf.keras.Model(inputs, [model(inputs) for model in self.models])
+
+    def set_weights(self, weights_list):
+        for model, weights in zip(self.models, weights_list):
+            model.set_weights(weights)
+
+    def predict_on_batch(self, x):
+        """Return the list of the outputs of the models on the batch x"""
+        if self.stacked_model is None:
+            return [model.predict_proba(x) for model in self.models]
+        outputs = self.stacked_model.predict_on_batch(x)
+        return outputs if isinstance(outputs, list) else [outputs]
+
+
+def coalition_outcomes(model, scenario):
+    """Return the vector of outcomes of a trained model, named by outcomes_names: accuracy and loss on the global test
+    data, accuracy on the test samples of each class, and accuracy on the local test set of each partner if the
+    scenario uses local test sets. The predictions are made in a single pass over all the test data."""
+    x_tests = [scenario.dataset.x_test]
+    y_tests = [scenario.dataset.y_test]
+    if scenario.test_set == 'local':
+        x_tests += [partner.x_test for partner in scenario.partners_list]
+        y_tests += [partner.y_test for partner in scenario.partners_list]
+    probabilities = predict_probabilities(model, np.concatenate(x_tests))
+    y_true = labels_to_int(np.concatenate(y_tests))
+    correct = np.argmax(probabilities, axis=1) == y_true
+    losses = - np.log(np.clip(probabilities[np.arange(len(y_true)), y_true], 1e-7, 1))
+    test_size = len(x_tests[0])
+    outcomes = [np.mean(correct[:test_size]), np.mean(losses[:test_size])]
+    for c in range(probabilities.shape[1]):
+        is_c = y_true[:test_size] == c
+        outcomes.append(np.mean(correct[:test_size][is_c]) if np.any(is_c) else np.nan)
+    bounds = np.cumsum([len(x) for x in x_tests])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        outcomes.append(np.mean(correct[start:end]))
+    return np.array(outcomes)
+
+
+def compute_embeddings(model, x, batch_size=constants.DEFAULT_BATCH_SIZE):
+    """Return the flattened outputs of the penultimate layer of model for the inputs x"""
+    embedding_model = tf.keras.Model(inputs=model.inputs, outputs=model.layers[-2].output)
+    embeddings = embedding_model.predict(x, batch_size=batch_size, verbose=0)
+    return embeddings.reshape(len(x), -1)
+
+
+def knn_shapley_values(x_train, y_train, x_test, y_test, k=5, batch_size=256, groups=None):
+    """Exact Shapley values of the training samples for the utility of a K-nearest-neighbors classifier.
+
+    Uses the closed-form recursion of Jia et al. (2019), "Efficient task-specific data valuation for nearest
+    neighbor algorithms": for each test point the training samples are sorted by distance, and the values are
+    obtained from the farthest to the nearest sample in O(N log N). Test points are processed by batches.
+
+    Labels are given as integers. Return the values of the training samples averaged over the test points,
+    and, if an array groups of group indexes (one per training sample) is provided, the sum of the values of each
+    group for each test point, as an array of shape (test points count, groups count).
+    """
+    x_train = x_train.reshape(len(x_train), -1).astype('float32')
+    x_test = x_test.reshape(len(x_test), -1).astype('float32')
+    n = len(x_train)
+    ranks = np.arange(1, n + 1)
+    # weight of the difference between the i-th and the (i+1)-th nearest samples, i = 1...n-1
+    coefs = np.minimum(k, ranks[:-1]) / (k * ranks[:-1])
+    train_sq_norms = np.sum(x_train ** 2, axis=1)
+
+    values = np.zeros(n)
+    groups_values = None
+    if groups is not None:
+        groups_values = np.zeros((len(x_test), np.max(groups) + 1))
+    for start in range(0, len(x_test), batch_size):
+        x_batch, y_batch = x_test[start:start + batch_size], y_test[start:start + batch_size]
+        # the squared norm of the test points does not change the ordering of the distances
+        distances = train_sq_norms[None, :] - 2 * x_batch.dot(x_train.T)
+        order = np.argsort(distances, axis=1, kind='stable')
+        match = (y_train[order] == y_batch[:, None]).astype('float64')
+
+        sorted_values = np.empty_like(match)
+        sorted_values[:, -1] = match[:, -1] / n
+        increments = (match[:, :-1] - match[:, 1:]) * coefs
+        sorted_values[:, :-1] = sorted_values[:, -1:] + np.cumsum(increments[:, ::-1], axis=1)[:, ::-1]
+
+        batch_values = np.empty_like(sorted_values)
+        np.put_along_axis(batch_values, order, sorted_values, axis=1)
+        values += batch_values.sum(axis=0)
+        if groups is not None:
+            for group in range(groups_values.shape[1]):
+                groups_values[start:start + len(x_batch), group] = batch_values[:, groups == group].sum(axis=1)
+
+    return values / len(x_test), groups_values
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Training-free detection of the duplicated samples, within and across partners, with locality-sensitive hashing.
+The samples are hashed in one streaming pass with random projections (SimHash): the signs of the projections of a
+sample on random hyperplanes give its binary signature, split in bands. Two samples whose signatures are equal on at
+least one band are candidates, and they are near duplicates if their full signatures are close enough, i.e. if the
+cosine similarity of the (centered) samples estimated from the signatures reaches a target similarity.
+
+The bands set the trade-off between the recall and the number of candidates. Each bit of the signatures of two samples
+of cosine similarity s is equal with probability p = 1 - arccos(s) / pi, so two samples are candidates with probability
+1 - (1 - p ** band_bits) ** bands_count. Many short bands catch slightly perturbed copies, but give more candidates to
+check. The defaults, 16 bands of 16 bits, give a probability above 0.96 from s = 0.95 on, and about 2e-4 for
+unrelated samples (s = 0), whose full signatures are then too far apart. Long bands only catch the exact copies.
+"""
+
+import numpy as np
+from loguru import logger
+
+DEFAULT_CHUNK_SIZE = 100000
+DEFAULT_BANDS_COUNT = 16
+DEFAULT_BAND_BITS = 16
+DEFAULT_SIMILARITY = 0.95
+CANDIDATES_CHUNK_SIZE = 4096  # number of signatures whose candidates are checked at once
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def random_hyperplanes(input_dim, bands_count=DEFAULT_BANDS_COUNT, band_bits=DEFAULT_BAND_BITS, seed=0):
+    """Return the random hyperplanes, of shape (input_dim, bands_count * band_bits), of the SimHash signatures"""
+    if band_bits > 64:
+        raise ValueError(f"A band is stored as a 64 bits integer, band_bits cannot exceed 64, not {band_bits}")
+    return np.random.RandomState(seed).randn(input_dim, bands_count * band_bits).astype(np.float32)
+
+
+def lsh_codes(x, hyperplanes, band_bits=DEFAULT_BAND_BITS, center=None, quantization=None,
+              chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return the SimHash signatures of the samples x, as an array of shape (len(x), bands_count) of uint64, each
+    integer holding the band_bits bits of a band. x is processed by chunks of chunk_size samples, so it can be a
+    memory-mapped array. If quantization is set, the features are rounded to multiples of it before the projection,
+    and center is subtracted from the (quantized) features."""
+    bands_count = hyperplanes.shape[1] // band_bits
+    powers = (np.uint64(1) << np.arange(band_bits, dtype=np.uint64))
+    codes = np.empty((len(x), bands_count), dtype=np.uint64)
+    for start in range(0, len(x), chunk_size):
+        features = np.asarray(x[start:start + chunk_size], dtype=np.float32).reshape(-1, hyperplanes.shape[0])
+        if quantization is not None:
+            features = np.round(features / quantization) * quantization
+        if center is not None:
+            features = features - center
+        bits = (features.dot(hyperplanes) > 0).reshape(len(features), bands_count, band_bits)
+        codes[start:start + chunk_size] = bits.astype(np.uint64).dot(powers)
+    return codes
+
+
+def max_hamming_distance(total_bits, similarity):
+    """Return the largest number of different bits between two signatures of total_bits bits, for which the cosine
+    similarity estimated from the signatures reaches similarity"""
+    return int(np.floor(total_bits * np.arccos(similarity) / np.pi))
+
+
+def hamming_distances(codes, other_codes):
+    """Return the number of different bits between the signatures of codes and other_codes, row by row"""
+    return POPCOUNT[np.bitwise_xor(codes, other_codes).view(np.uint8)].sum(axis=1)
+
+
+def near_duplicates_mask(codes, reference_codes, max_distance, same_samples=False):
+    """Return the boolean mask of the signatures of codes which have a near duplicate in reference_codes: equal on at
+    least one band, and with at most max_distance different bits. The signatures must be unique within codes and
+    within reference_codes. If same_samples, codes and reference_codes are the same, and a signature is not its own
+    near duplicate."""
+    mask = np.zeros(len(codes), dtype=bool)
+    for band in range(codes.shape[1]):
+        order = np.argsort(reference_codes[:, band], kind='stable')
+        sorted_band = reference_codes[order, band]
+        for start in range(0, len(codes), CANDIDATES_CHUNK_SIZE):
+            queries = start + np.flatnonzero(~mask[start:start + CANDIDATES_CHUNK_SIZE])
+            first = np.searchsorted(sorted_band, codes[queries, band], side='left')
+            counts = np.searchsorted(sorted_band, codes[queries, band], side='right') - first
+            # the candidates of each query are the references of the same bucket of the band
+            candidates_queries = np.repeat(queries, counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidates = order[np.repeat(first, counts) + offsets]
+            if same_samples:
+                is_other = candidates_queries != candidates
+                candidates_queries, candidates = candidates_queries[is_other], candidates[is_other]
+            is_close = hamming_distances(codes[candidates_queries], reference_codes[candidates]) <= max_distance
+            mask[candidates_queries[is_close]] = True
+    return mask
+
+
+def duplicates_masks(partners_codes, max_distance):
+    """Return the overlap masks of the partners: the element (i, j) is the boolean mask of the samples of partner i
+    which have a near duplicate in the samples of partner j, or within the other samples of partner i if i == j.
+    The near duplicates are searched among the distinct signatures only, so the buckets of copies stay small."""
+    uniques = [np.unique(codes, axis=0, return_inverse=True, return_counts=True) for codes in partners_codes]
+    masks = {}
+    for i, (unique_codes, inverse, counts) in enumerate(uniques):
+        inverse = inverse.reshape(-1)
+        for j, (reference_codes, _, _) in enumerate(uniques):
+            unique_mask = near_duplicates_mask(unique_codes, reference_codes, max_distance, same_samples=i == j)
+            if i == j:  # the samples whose signature is repeated are duplicates too
+                unique_mask |= counts > 1
+            masks[i, j] = unique_mask[inverse]
+    return masks
+
+
+def distinct_samples_values(partners_codes):
+    """Return the Shapley values of the game whose value of a coalition is its number of distinct samples. The value
+    of a distinct sample is shared equally between the partners which hold it, whatever the number of copies each
+    of them holds. Two samples are identical if their full signatures are equal."""
+    # Mix the bands into a single 64 bits key per sample (the overflow of the multiplications is intended)
+    bands_count = partners_codes[0].shape[1]
+    multipliers = np.random.RandomState(0).randint(1, 2 ** 62, size=bands_count, dtype=np.int64).astype(np.uint64)
+    multipliers |= np.uint64(1)
+    with np.errstate(over='ignore'):
+        keys = [np.bitwise_xor.reduce(codes * multipliers, axis=1) for codes in partners_codes]
+    partners_items = [np.unique(partner_keys) for partner_keys in keys]
+    all_items, holders_count = np.unique(np.concatenate(partners_items), return_counts=True)
+    return np.array([np.sum(1 / holders_count[np.searchsorted(all_items, items)]) for items in partners_items])
+
+
+def detect_duplicates(partners_x, bands_count=DEFAULT_BANDS_COUNT, band_bits=DEFAULT_BAND_BITS,
+                      similarity=DEFAULT_SIMILARITY, quantization=None, chunk_size=DEFAULT_CHUNK_SIZE, seed=0):
+    """Hash the samples of each partner, and return a dict with the following entries. Two samples are near
+    duplicates if the cosine similarity estimated from their signatures is at least similarity.
+    - 'overlap': matrix whose element (i, j) is the share of the samples of partner i which have a near duplicate in
+      the samples of partner j (its diagonal is 1)
+    - 'redundancy': share of the samples of each partner which have a near duplicate in its own samples
+    - 'distinct_samples_values': number of distinct samples brought by each partner, see distinct_samples_values
+    """
+    input_dim = int(np.prod(np.shape(partners_x[0])[1:]))
+    hyperplanes = random_hyperplanes(input_dim, bands_count, band_bits, seed)
+
+    # The hyperplanes pass through a rough estimate of the mean sample, computed on the first chunk of each partner
+    first_chunks = [np.asarray(x[:chunk_size], dtype=np.float32).reshape(-1, input_dim) for x in partners_x]
+    if quantization is not None:
+        first_chunks = [np.round(chunk / quantization) * quantization for chunk in first_chunks]
+    center = np.mean(np.concatenate(first_chunks), axis=0)
+
+    partners_codes = [lsh_codes(x, hyperplanes, band_bits, center, quantization, chunk_size) for x in partners_x]
+    partners_count = len(partners_codes)
+    masks = duplicates_masks(partners_codes, max_hamming_distance(bands_count * band_bits, similarity))
+    overlap = np.eye(partners_count)
+    for i in range(partners_count):
+        for j in range(partners_count):
+            if i != j:
+                overlap[i, j] = np.mean(masks[i, j])
+    redundancy = np.array([np.mean(masks[i, i]) for i in range(partners_count)])
+    logger.info(f"Duplicates detection on {sum(len(codes) for codes in partners_codes)} samples: "
+                f"redundancy within partners {np.round(redundancy, 3)}")
+    return {'overlap': overlap,
+            'redundancy': redundancy,
+            'distinct_samples_values': distinct_samples_values(partners_codes)}
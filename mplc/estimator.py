@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Estimation of the cost of the scenarios of an experiment before running them (dry run): number of coalition trainings
+of each contributivity method, projected wall-clock time and memory.
+"""
+
+from math import ceil
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from scipy.special import comb
+from scipy.stats import norm
+
+from .contributivity import select_mpl_engine
+
+# Methods which train all the coalitions, or an upper bound of the coalitions they can train
+EXHAUSTIVE_METHODS = ["Shapley values", "Owen values", "Active Shapley"]
+# Methods which sample permutations of the partners, with their minimum number of permutations
+PERMUTATIONS_METHODS = {"TMCS": 100, "ITMCS": 100}
+# Methods which sample increments (a coalition with and without a partner), with their minimum number of iterations
+# (an iteration samples an increment per partner). SMCS and WR_SMC sample each stratum of each partner 20 times
+INCREMENTS_METHODS = {"IS_lin_S": 100, "IS_reg_S": 100, "AIS_Kriging_S": 100, "CC_Shapley": 1,
+                      "SMCS": lambda n: 21 * n, "WR_SMC": lambda n: 21 * n}
+# Methods which train no coalition model, besides the main training of the scenario
+NO_TRAINING_METHODS = ["Federated SBS linear", "Federated SBS quadratic", "Federated SBS constant",
+                       "Confident learning", "KNN-Shapley", "Duplicates detection", "Influence functions",
+                       "Gradient similarity"]
+# Methods whose coalitions can be trained on several worker processes
+PARALLEL_METHODS = ["Shapley values", "Owen values", "Leave-one-out", "Independent scores", "G-Shapley"]
+# Methods whose coalitions are trained contrib_repeats times
+REPEATED_METHODS = ["Shapley values", "Owen values", "Leave-one-out", "Independent scores"]
+
+# Number of copies of the model weights held in memory per partner (weights and optimizer states)
+MODEL_COPIES_PER_PARTNER = 3
+
+
+def marginals_variance_prior(partners_count, grand_coalition_score=1.):
+    """Prior of the variance of the marginal contributions, used by the stopping rules of the samplers: the value of
+    the grand coalition is assumed to be brought by the first partner of a random permutation"""
+    return grand_coalition_score ** 2 * (1 / partners_count) * (1 - 1 / partners_count)
+
+
+def stopping_rule_iterations(partners_count, sv_accuracy=0.01, alpha=0.95, min_iterations=100):
+    """Expected number of iterations of a sampler, stopped when the confidence interval of every Shapley value is
+    below sv_accuracy"""
+    q = norm.ppf((1 + alpha) / 2)
+    return max(min_iterations, int(ceil(q ** 2 * marginals_variance_prior(partners_count) / sv_accuracy ** 2)))
+
+
+def expected_distinct_coalitions(partners_count, draws_per_size):
+    """Return the expected number of distinct coalitions of each size 1...partners_count, when draws_per_size
+    coalitions of each size are drawn uniformly (the values are cached, so a coalition is trained once)"""
+    sizes = np.arange(1, partners_count + 1)
+    coalitions_count = comb(partners_count, sizes)
+    return coalitions_count * (1 - (1 - 1 / coalitions_count) ** draws_per_size)
+
+
+def expected_trainings(method, partners_count, sv_accuracy=0.01, alpha=0.95, repeats=1, epoch_count=1,
+                       gshapley_permutations=None, pvrl_rollouts=4):
+    """Return the expected number of trainings of method, as an array whose element k-1 is the number of trainings
+    of coalitions of k partners. It is exact for the exhaustive methods, the leave-one-out and the independent
+    scores, and estimated from the stopping rules for the samplers (truncation is not taken into account). The
+    G-Shapley and PVRL costs are expressed in trainings of the grand coalition."""
+    n = partners_count
+    trainings = np.zeros(n)
+    if method in EXHAUSTIVE_METHODS:
+        trainings = comb(n, np.arange(1, n + 1))
+    elif method == "Leave-one-out":
+        trainings[n - 1] = 1
+        if n > 1:
+            trainings[n - 2] = n
+    elif method == "Independent scores":
+        trainings[0] = n
+    elif method in PERMUTATIONS_METHODS:
+        # a permutation draws one coalition of each size
+        permutations = stopping_rule_iterations(n, sv_accuracy, alpha, PERMUTATIONS_METHODS[method])
+        trainings = expected_distinct_coalitions(n, permutations)
+    elif method in INCREMENTS_METHODS:
+        min_iterations = INCREMENTS_METHODS[method]
+        min_iterations = min_iterations(n) if callable(min_iterations) else min_iterations
+        # an iteration draws an increment per partner, i.e. about 2 coalitions of each size
+        iterations = stopping_rule_iterations(n, sv_accuracy, alpha, min_iterations)
+        trainings = expected_distinct_coalitions(n, 2 * iterations)
+    elif method == "G-Shapley":
+        # a permutation costs a single pass over the data, i.e. one epoch of the grand coalition
+        permutations = gshapley_permutations or stopping_rule_iterations(n, sv_accuracy, alpha, 10)
+        trainings[n - 1] = permutations / epoch_count
+    elif method == "PVRL":
+        trainings[n - 1] = pvrl_rollouts
+    elif method == "S-Model":
+        trainings[n - 1] = 1
+    elif method not in NO_TRAINING_METHODS:
+        raise ValueError(f"Unknown contributivity method {method}")
+    if method in REPEATED_METHODS:
+        trainings = trainings * repeats
+    return trainings
+
+
+def calibrate_training_time(scenario, approach):
+    """Return the overhead of a training of approach on all the partners of scenario (model building, graph tracing)
+    and the wall-clock time of one of its epochs, measured with trainings of one and two epochs"""
+    times = []
+    for epoch_count in [1, 2]:
+        start = timer()
+        mpl = approach(scenario, epoch_count=epoch_count, is_early_stopping=False, save_folder=None,
+                       **scenario.mpl_kwargs)
+        mpl.fit()
+        times.append(timer() - start)
+    epoch_time = max(times[1] - times[0], 0)
+    return max(times[0] - epoch_time, 0), epoch_time
+
+
+def scenario_memory_bytes(scenario):
+    """Estimate the memory needed by a training: the data of the scenario, and the model weights and optimizer states
+    of the partners and of the global model"""
+    dataset = scenario.dataset
+    data_bytes = sum(np.asarray(array).nbytes for array in
+                     [dataset.x_train, dataset.y_train, dataset.x_val, dataset.y_val, dataset.x_test, dataset.y_test])
+    model = dataset.generate_new_model()
+    model_bytes = sum(np.asarray(w).nbytes for w in model.get_weights()) if hasattr(model, 'get_weights') else 0
+    return data_bytes + model_bytes * MODEL_COPIES_PER_PARTNER * (scenario.partners_count + 1)
+
+
+def estimate_scenario_cost(scenario, training_times=None, calibrate=True):
+    """Return a dict with the expected number of trainings of each contributivity method of scenario, and the
+    projected wall-clock time and memory of a run of the scenario.
+
+    The time of a training of k partners out of n is estimated as its overhead plus epoch_count * k / n times the
+    time of an epoch on all the partners, both measured once per dataset and approach (training_times is the cache
+    of these measures). Early stopping is not taken into account. If calibrate is False, no time is projected."""
+    training_times = {} if training_times is None else training_times
+    contrib_kwargs = scenario.contributivity_kwargs
+    n = scenario.partners_count
+    coalition_approach = select_mpl_engine(scenario) if contrib_kwargs.get('fast_engines', True) \
+        else scenario._multi_partner_learning_approach
+
+    # (overhead, epoch time) of a training of each approach, np.nan if not calibrated
+    times = {approach: (np.nan, np.nan) for approach in [scenario._multi_partner_learning_approach,
+                                                         coalition_approach]}
+    if calibrate:
+        for approach in times:
+            key = (scenario.dataset.name, scenario.dataset_proportion, approach.name, n, scenario.minibatch_count,
+                   scenario.gradient_updates_per_pass_count)
+            if key not in training_times:
+                logger.info(f"Calibration of the training time of {approach.name} on {scenario.dataset.name}")
+                training_times[key] = calibrate_training_time(scenario, approach)
+            times[approach] = training_times[key]
+
+    # Time of a training of a coalition of each size
+    overhead, epoch_time = times[coalition_approach]
+    coalition_times = overhead + epoch_time * scenario.epoch_count * np.arange(1, n + 1) / n
+    n_jobs = contrib_kwargs.get('n_jobs', 1)
+    linear_probe = contrib_kwargs.get('characteristic', 'training') == 'linear-probe'
+
+    trainings_per_method = {}
+    overhead, epoch_time = times[scenario._multi_partner_learning_approach]
+    time_sec = overhead + epoch_time * scenario.epoch_count  # main training
+    for method in scenario.contributivity_methods:
+        trainings = expected_trainings(method, n,
+                                       sv_accuracy=contrib_kwargs.get('sv_accuracy', 0.01),
+                                       alpha=contrib_kwargs.get('alpha', 0.95),
+                                       repeats=contrib_kwargs.get('repeats', 1),
+                                       epoch_count=scenario.epoch_count,
+                                       gshapley_permutations=contrib_kwargs.get('gshapley_permutations'),
+                                       pvrl_rollouts=contrib_kwargs.get('pvrl_rollouts', 4))
+        trainings_per_method[method] = float(np.sum(trainings))
+        if linear_probe and method not in ["PVRL", "S-Model", "G-Shapley"]:
+            continue  # the coalitions are valued by a linear probe on cached embeddings, in a fraction of a second
+        workers = n_jobs if method in PARALLEL_METHODS and n_jobs > 0 else 1
+        time_sec += np.dot(trainings, coalition_times) / workers
+
+    return {'scenario_name': scenario.scenario_name,
+            'dataset': scenario.dataset.name,
+            'approach': scenario._multi_partner_learning_approach.name,
+            'coalition_approach': coalition_approach.name,
+            'partners_count': n,
+            'epoch_count': scenario.epoch_count,
+            'trainings_per_method': trainings_per_method,
+            'trainings': float(sum(trainings_per_method.values())),
+            'projected_time_sec': time_sec,
+            'memory_bytes': scenario_memory_bytes(scenario) * max(n_jobs, 1)}
+
+
+def estimate_experiment_cost(scenarios_list, nb_repeats=1, calibrate=True):
+    """Return a DataFrame with the cost of each scenario (see estimate_scenario_cost), and log the total projected
+    time of the experiment, with its nb_repeats repeats"""
+    training_times = {}
+    costs = pd.DataFrame([estimate_scenario_cost(scenario, training_times, calibrate)
+                          for scenario in scenarios_list])
+    for _, cost in costs.iterrows():
+        logger.info(f"{cost['scenario_name']} ({cost['dataset']}, {cost['approach']}, {cost['partners_count']} "
+                    f"partners): {np.round(cost['trainings'], 1)} trainings "
+                    f"{ {method: np.round(t, 1) for method, t in cost['trainings_per_method'].items()} }, "
+                    f"{np.round(cost['projected_time_sec'] / 3600, 2)} h, "
+                    f"{np.round(cost['memory_bytes'] / 2 ** 20)} MB")
+    total_time_sec = costs['projected_time_sec'].sum() * nb_repeats
+    logger.info(f"{len(costs)} scenarios, {nb_repeats} repeats: {np.round(costs['trainings'].sum() * nb_repeats)} "
+                f"trainings, projected time {np.round(total_time_sec / 3600, 2)} h, "
+                f"peak memory {np.round(costs['memory_bytes'].max() / 2 ** 20)} MB")
+    return costs
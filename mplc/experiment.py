@@ -16,6 +16,7 @@ from loguru import logger
 
 from . import scenario as scenario_module
 from . import utils, constants
+from .estimator import estimate_experiment_cost
 from .utils import get_scenario_params_list, load_cfg
 
 DEFAULT_CONFIG_FILE = "../config.yml"
@@ -214,3 +215,20 @@ def init_experiment_from_config_file(path_to_config_file):
     logger.info("All scenarios created , successfully validated and added to the experiment")
 
     return experiment
+
+
+def estimate_experiment_from_config_file(path_to_config_file, calibrate=True):
+    """
+    Estimate the cost of the experiment described by a config file, without running it (dry run): number of
+    coalition trainings of each contributivity method, projected wall-clock time and memory per scenario and in total.
+    If calibrate, a training of one and of two epochs per dataset and approach measures its time. No experiment folder
+    is created.
+    """
+    logger.debug(f"Estimating the cost of the experiment with config file at path {path_to_config_file}")
+
+    config = load_cfg(path_to_config_file)
+    scenario_params_list = get_scenario_params_list(config["scenario_params_list"])
+    scenarios_list = [scenario_module.Scenario(**scenario_params, scenario_id=scenario_params_idx + 1)
+                      for scenario_params_idx, scenario_params in enumerate(scenario_params_list)]
+
+    return estimate_experiment_cost(scenarios_list, nb_repeats=config["n_repeats"], calibrate=calibrate)
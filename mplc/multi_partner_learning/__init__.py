@@ -23,3 +23,10 @@ FAST_TF_MPL_APPROACHES = {
 
 MULTI_PARTNER_LEARNING_APPROACHES = BASIC_MPL_APPROACHES.copy()
 MULTI_PARTNER_LEARNING_APPROACHES.update(FAST_TF_MPL_APPROACHES)
+
+# Fast equivalents of the basic approaches, on which the trainings of the contributivity methods can be run
+FAST_EQUIVALENT_APPROACHES = {
+    basic_mpl.FederatedAverageLearning: fast_mpl.FastFedAvg,
+    basic_mpl.FederatedGradients: fast_mpl.FastFedGrad,
+    basic_mpl.FedAvgSmodel: fast_mpl.FastFedAvgSmodel,
+}
@@ -15,10 +15,10 @@ import tensorflow as tf
 from loguru import logger
 from sklearn.metrics import confusion_matrix
 from tensorflow.keras import Input, Model
-from tensorflow.keras.backend import clear_session
 from tensorflow.keras.callbacks import EarlyStopping
 
-from .utils import History
+from .utils import History, ParameterArena, init_optimizer_state, reset_optimizer_state, compile_step, \
+    run_compiled_step
 from ..utils import project_onto_the_simplex
 from .. import constants
 from ..models import NoiseAdaptationChannel, EnsemblePredictionsModel
@@ -33,7 +33,9 @@ ALLOWED_PARAMETERS = ('partners_list',
                       'is_save_data',
                       'save_folder',
                       'init_model_from',
-                      'use_saved_weights')
+                      'use_saved_weights',
+                      'use_keras_fit',
+                      'is_partners_validation')
 
 
 class MultiPartnerLearning(ABC):
@@ -61,6 +63,11 @@ class MultiPartnerLearning(ABC):
         # Attributes to store results
         self.save_folder = scenario.save_folder
 
+        # Attributes related to the local trainings of the partners
+        self.use_keras_fit = False
+        self.is_partners_validation = True
+        self.compiled_steps = {}  # id of a pooled model -> its compiled train and test steps
+
         # Erase the default parameters (which mostly come from the scenario) if some parameters have been specified
         self.__dict__.update((k, v) for k, v in kwargs.items() if k in ALLOWED_PARAMETERS)
 
@@ -70,9 +77,10 @@ class MultiPartnerLearning(ABC):
         self.dataset_name = self.dataset.name
         self.generate_new_model = self.dataset.generate_new_model
 
-        # Initialize the model
+        # Initialize the model, which is the first model of the pool of compiled models
         model = self.init_model()
         self.model_weights = model.get_weights()
+        self.models_pool = {0: (model, init_optimizer_state(model))}
         self.metrics_names = self.dataset.model_metrics_names
 
         # Initialize iterators
@@ -88,6 +96,14 @@ class MultiPartnerLearning(ABC):
             f"## Preparation of model's training on partners with ids: {['#' + str(p.id) for p in partners_list]}")
         self.partners_list = [PartnerMpl(partner, self) for partner in self.partners_list]
 
+        # Store the partners' model weights as the rows of a parameter arena (unless the weights of the model are not
+        # known before its first training)
+        self.parameter_arena = None
+        if self.model_weights is not None:
+            self.parameter_arena = ParameterArena(self.model_weights, self.partners_count)
+            for row, partner in enumerate(self.partners_list):
+                partner.arena_row = row
+
         # Attributes related to the aggregation approach
         self.aggregator = self.init_aggregation_function(scenario.aggregation)
 
@@ -114,14 +130,73 @@ class MultiPartnerLearning(ABC):
     def init_aggregation_function(self, aggregator):
         return aggregator(self)
 
+    def average_partners_weights(self, partners_list, aggregation_weights):
+        """Return the average of the model weights of the partners passed as arguments, weighted by
+        aggregation_weights"""
+        if self.parameter_arena is not None:
+            return self.parameter_arena.average(aggregation_weights, [partner.arena_row for partner in partners_list])
+        weights_per_layer = zip(*[partner.model_weights for partner in partners_list])
+        return [np.average(np.array(weights_for_layer), axis=0, weights=aggregation_weights)
+                for weights_for_layer in weights_per_layer]
+
     def build_model(self):
         return self.build_model_from_weights(self.model_weights)
 
-    def build_model_from_weights(self, new_weights):
-        """Generate a new model initialized with weights passed as arguments"""
-        new_model = self.generate_new_model()
-        new_model.set_weights(new_weights)
-        return new_model
+    def build_model_from_weights(self, new_weights, slot=0):
+        """Return a compiled model initialized with weights passed as arguments.
+
+        The models are pooled: the model of a slot is generated and compiled once, and reused by the next calls on this
+        slot, which load the new weights in it and reset its optimizer to its initial state, as a new model would be.
+        A model must not be used after another call on its slot, models used at the same time need distinct slots.
+        """
+        if slot not in self.models_pool:
+            new_model = self.generate_new_model()
+            self.models_pool[slot] = (new_model, init_optimizer_state(new_model))
+        model, optimizer_state = self.models_pool[slot]
+        model.set_weights(new_weights)
+        reset_optimizer_state(model, optimizer_state)
+        return model
+
+    def partner_validation_data(self, partner):
+        if self.val_set == 'global':
+            return self.val_data
+        elif self.val_set == 'local':
+            return partner.x_val, partner.y_val
+        else:
+            raise ValueError("validation set should be 'local' or 'global', not {self.val_set}")
+
+    def get_compiled_steps(self, model, x, y):
+        """Return the train and test steps of a pooled model, compiled with tf.function at the first call"""
+        if id(model) not in self.compiled_steps:
+            self.compiled_steps[id(model)] = (compile_step(model.train_step, x, y), compile_step(model.test_step, x, y))
+        return self.compiled_steps[id(model)]
+
+    def fit_local_model(self, model, x_train, y_train, batch_size, validation_data):
+        """Train model for a pass over (x_train, y_train), and return its history as Keras' fit() would.
+
+        The gradient steps are done by the train step of the model, compiled once per pooled model, on the successive
+        slices of the data (already shuffled by split_minibatches), which saves the setup of fit() for the few gradient
+        steps of a minibatch. Keras' fit() is used instead if use_keras_fit is set, and for non-Keras models.
+        The validation pass is skipped if is_partners_validation is False, unless the aggregation needs its scores.
+        """
+        if not isinstance(model, tf.keras.Model):
+            return model.fit(x_train, y_train, batch_size=batch_size, validation_data=validation_data).history
+        if not self.is_partners_validation and self.aggregator.is_weights_constant:
+            validation_data = None
+
+        if self.use_keras_fit:
+            history = model.fit(x_train, y_train, batch_size=batch_size, verbose=0,
+                                validation_data=validation_data).history
+        else:
+            train_step, test_step = self.get_compiled_steps(model, x_train, y_train)
+            history = run_compiled_step(train_step, model, x_train, y_train, batch_size)
+            if validation_data is not None:
+                val_history = run_compiled_step(test_step, model, *validation_data, constants.DEFAULT_BATCH_SIZE)
+                history.update({'val_' + key: value for key, value in val_history.items()})
+
+        for key in self.history.metrics:
+            history.setdefault(key, [np.nan])
+        return history
 
     def init_model(self):
         new_model = self.generate_new_model()
@@ -301,10 +376,8 @@ class SinglePartnerLearning(MultiPartnerLearning):
 
         # Set if early stopping if needed
         cb = []
-        es = None
         if self.is_early_stopping:
-            es = EarlyStopping(monitor='val_loss', mode='min', verbose=0, patience=constants.PATIENCE)
-            cb.append(es)
+            cb.append(EarlyStopping(monitor='val_loss', mode='min', verbose=0, patience=constants.PATIENCE))
 
         # Train model
         logger.info("   Training model...")
@@ -329,11 +402,16 @@ class SinglePartnerLearning(MultiPartnerLearning):
             raise ValueError("validation set should be 'local' or 'global', not {self.val_set}")
 
         self.model_weights = model.get_weights()
-        self.log_partner_perf(self.partner.id, 0, history.history)
+        # Log the metrics of each epoch done, at the last minibatch index as the multi-partner approaches do
+        epochs_done = len(history.history['val_accuracy'])
+        self.minibatch_index = self.minibatch_count - 1
+        for self.epoch_index in range(epochs_done):
+            self.log_partner_perf(self.partner.id, 0, {key: value[:self.epoch_index + 1]
+                                                       for key, value in history.history.items()})
         del self.history.history['mpl_model']
         # Evaluate trained model on test data
         self.eval_and_log_final_model_test_perf()
-        self.history.nb_epochs_done = (es.stopped_epoch + 1) if es.stopped_epoch != 0 else self.epoch_count
+        self.history.nb_epochs_done = epochs_done
 
         end = timer()
         self.learning_computation_time = end - start
@@ -355,9 +433,6 @@ class FederatedAverageLearning(MultiPartnerLearning):
             raise ValueError('Only one partner is provided. Please use the dedicated SinglePartnerLearning class')
 
     def fit_epoch(self):
-        # Clear Keras' old models
-        clear_session()
-
         # Split the train dataset in mini-batches
         self.split_in_minibatches()
 
@@ -391,23 +466,14 @@ class FederatedAverageLearning(MultiPartnerLearning):
             partner_model = partner.build_model()
 
             # Train on partner local data set
-            if self.val_set == 'global':
-                history = partner_model.fit(partner.minibatched_x_train[self.minibatch_index],
-                                            partner.minibatched_y_train[self.minibatch_index],
-                                            batch_size=partner.batch_size,
-                                            verbose=0,
-                                            validation_data=self.val_data)
-            elif self.val_set == 'local':
-                history = partner_model.fit(partner.minibatched_x_train[self.minibatch_index],
-                                            partner.minibatched_y_train[self.minibatch_index],
-                                            batch_size=partner.batch_size,
-                                            verbose=0,
-                                            validation_data=(partner.x_val, partner.y_val))
-            else:
-                raise ValueError("validation set should be 'local' or 'global', not {self.val_set}")
+            history = self.fit_local_model(partner_model,
+                                           partner.minibatched_x_train[self.minibatch_index],
+                                           partner.minibatched_y_train[self.minibatch_index],
+                                           partner.batch_size,
+                                           self.partner_validation_data(partner))
 
             # Log results of the round
-            self.log_partner_perf(partner.id, partner_index, history.history)
+            self.log_partner_perf(partner.id, partner_index, history)
 
             # Update the partner's model in the models' list
             partner.model_weights = partner_model.get_weights()
@@ -508,19 +574,16 @@ class DistributionallyRobustFederatedAveragingLearning(MultiPartnerLearning):
         # Iterate over partners for training
         for partner_index, partner in enumerate(self.active_partners_list):
             partner_model = partner.build_model()
+            train_step, _ = self.get_compiled_steps(partner_model, partner.x_train, partner.y_train)
             # loop through each partner's minibatch
             minibatched_x_y = self.partners_training_data[partner.id][self.minibatch_index]
             for idx, batch_x_y in enumerate(minibatched_x_y):
-                with tf.GradientTape() as tape:
-                    p_pred = partner_model(batch_x_y[0])
-                    loss = partner_model.compiled_loss(batch_x_y[1], p_pred)
-
-                partner_model.optimizer.minimize(loss, partner_model.trainable_weights, tape=tape)
+                train_step(batch_x_y)
 
                 self.local_steps_index += 1
                 if self.local_steps_index == self.local_steps_index_t:
                     # save model weights for each partner at local step t
-                    self.model_weights_at_index_t.append(partner.model_weights)
+                    self.model_weights_at_index_t.append([np.copy(w) for w in partner.model_weights])
 
             partner.model_weights = partner_model.get_weights()
             self.local_steps_index = 0
@@ -616,23 +679,10 @@ class DistributionallyRobustFederatedAveragingLearning(MultiPartnerLearning):
                         f"{percentages} "
                         f"during the training")
 
-    @staticmethod
-    def aggregate_model_weights(partners_list):
-        """ This method is identical to the one in the aggregator class with few modifications.
-         I couldn't use the original aggregator method since it operates on the entire list of partners and
-         DRFA requires model aggregation over a subset of partners list only
-        """
-        aggregation_weights = np.ones(len(partners_list), dtype='float32')
-        weights_per_layer = list(zip(*[partner.model_weights for partner in partners_list]))
-        new_weights = list()
-
-        for weights_for_layer in weights_per_layer:
-            avg_weights_for_layer = np.average(
-                np.array(weights_for_layer), axis=0, weights=aggregation_weights
-            )
-            new_weights.append(avg_weights_for_layer)
-
-        return new_weights
+    def aggregate_model_weights(self, partners_list):
+        """Uniform average of the models of a subset of the partners, as DRFA aggregates the active partners' models
+        whatever the aggregation approach of the scenario"""
+        return self.average_partners_weights(partners_list, np.ones(len(partners_list), dtype='float32'))
 
 
 class SequentialLearning(MultiPartnerLearning):  # seq-pure
@@ -644,9 +694,6 @@ class SequentialLearning(MultiPartnerLearning):  # seq-pure
             raise ValueError('Only one partner is provided. Please use the dedicated SinglePartnerLearning class')
 
     def fit_epoch(self):
-        # Clear Keras' old models
-        clear_session()
-
         # Split the train dataset in mini-batches
         self.split_in_minibatches()
 
@@ -661,10 +708,10 @@ class SequentialLearning(MultiPartnerLearning):  # seq-pure
 
         logger.debug("Start new seq collaborative round ...")
 
-        model_for_round = self.build_model()
-
         # Evaluate and store accuracy of mini-batch start model
         self.eval_and_log_model_val_perf()
+
+        model_for_round = self.build_model()
         # Iterate over partners for training each individual model
         shuffled_indexes = np.random.permutation(self.partners_count)
         logger.debug(f"(seq) Shuffled order for this seqavg collaborative round: {shuffled_indexes}")
@@ -672,23 +719,14 @@ class SequentialLearning(MultiPartnerLearning):  # seq-pure
             partner = self.partners_list[partner_index]
 
             # Train on partner local data set
-            if self.val_set == 'global':
-                history = model_for_round.fit(partner.minibatched_x_train[self.minibatch_index],
-                                              partner.minibatched_y_train[self.minibatch_index],
-                                              batch_size=partner.batch_size,
-                                              verbose=0,
-                                              validation_data=self.val_data)
-            elif self.val_set == 'local':
-                history = model_for_round.fit(partner.minibatched_x_train[self.minibatch_index],
-                                              partner.minibatched_y_train[self.minibatch_index],
-                                              batch_size=partner.batch_size,
-                                              verbose=0,
-                                              validation_data=(partner.x_val, partner.y_val))
-            else:
-                raise ValueError("validation set should be 'local' or 'global', not {self.val_set}")
+            history = self.fit_local_model(model_for_round,
+                                           partner.minibatched_x_train[self.minibatch_index],
+                                           partner.minibatched_y_train[self.minibatch_index],
+                                           partner.batch_size,
+                                           self.partner_validation_data(partner))
 
             # Log results
-            self.log_partner_perf(partner.id, idx, history.history)
+            self.log_partner_perf(partner.id, idx, history)
 
             # Save the partner's model in the models' list
             partner.model_weights = model_for_round.get_weights()
@@ -706,9 +744,6 @@ class SequentialWithFinalAggLearning(SequentialLearning):
             raise ValueError('Only one partner is provided. Please use the dedicated SinglePartnerLearning class')
 
     def fit_epoch(self):
-        # Clear Keras' old models
-        clear_session()
-
         # Split the train dataset in mini-batches
         self.split_in_minibatches()
 
@@ -732,9 +767,6 @@ class SequentialAverageLearning(SequentialLearning):
             raise ValueError('Only one partner is provided. Please use the dedicated SinglePartnerLearning class')
 
     def fit_epoch(self):
-        # Clear Keras' old models
-        clear_session()
-
         # Split the train dataset in mini-batches
         self.split_in_minibatches()
 
@@ -756,6 +788,7 @@ class FedAvgSmodel(FederatedAverageLearning):
         super(FedAvgSmodel, self).__init__(scenario, **kwargs)
         self.pretrain_epochs = pretrain_epochs
         self.epsilon = epsilon
+        self.smodels_pool = {}  # slot -> s-model wrapping the pooled model of the slot, and its optimizer state
         if pretrain_epochs > 0:
             self.pretrain_mpl = FederatedAverageLearning(scenario=scenario,
                                                          epoch_count=self.pretrain_epochs,
@@ -773,11 +806,33 @@ class FedAvgSmodel(FederatedAverageLearning):
                 p.noise_layer_weights = [np.log(confusion.T + 1e-8)]
             self.model_weights[:-1] = self.pretrain_mpl.model_weights[:-1]
         else:
+            num_classes = self.dataset.num_classes
             for p in self.partners_list:
-                confusion = np.identity(10) * (1 - self.epsilon) + (self.epsilon / 10)
+                confusion = np.identity(num_classes) * (1 - self.epsilon) + (self.epsilon / num_classes)
                 p.noise_layer_weights = [np.log(confusion + 1e-8)]
         super(FedAvgSmodel, self).fit()
 
+    def build_smodel(self, partner, slot=0):
+        """Return the pooled model of slot with the partner's model weights, and the s-model which wraps it with a
+        noise adaptation layer holding the partner's noise layer weights. The s-model of a slot is built and compiled
+        once, and its optimizer is reset at each call, as the pooled models are."""
+        partner_model = self.build_model_from_weights(partner.model_weights, slot)
+        if slot not in self.smodels_pool:
+            model_input = Input(shape=self.dataset.input_shape)
+            outputs = NoiseAdaptationChannel(name='s-model')(partner_model(model_input))
+            smodel = Model(inputs=model_input, outputs=outputs, name=f"s_model_{slot}")
+            # The optimizer of the pooled partner's model cannot be extended to the s-model layer, use a new one
+            smodel.compile(
+                loss=partner_model.loss,
+                optimizer=partner_model.optimizer.from_config(partner_model.optimizer.get_config()),
+                metrics='accuracy',
+            )
+            self.smodels_pool[slot] = (smodel, init_optimizer_state(smodel))
+        smodel, optimizer_state = self.smodels_pool[slot]
+        smodel.get_layer('s-model').set_weights(partner.noise_layer_weights)
+        reset_optimizer_state(smodel, optimizer_state)
+        return partner_model, smodel
+
     def fit_minibatch(self):
         """Proceed to a collaborative round with a S-Model federated averaging approach"""
 
@@ -795,34 +850,21 @@ class FedAvgSmodel(FederatedAverageLearning):
 
         # Iterate over partners for training each individual model
         for partner_index, partner in enumerate(self.partners_list):
-            # Reference the partner's model
-            partner_model = partner.build_model()
-            x_batch = partner.minibatched_x_train[self.minibatch_index]
-            y_batch = partner.minibatched_y_train[self.minibatch_index]
-
-            model_input = Input(shape=self.dataset.input_shape)
-            x = partner_model(model_input)
-            outputs = NoiseAdaptationChannel(weights=partner.noise_layer_weights, name='s-model')(x)
-            full_model = Model(inputs=model_input, outputs=outputs, name=f"full_model_partner_{partner_index}")
-
-            full_model.compile(
-                loss=partner_model.loss,
-                optimizer=partner_model.optimizer,
-                metrics='accuracy',
-            )
+            # Reference the partner's model, and its s-model
+            partner_model, smodel = self.build_smodel(partner)
 
             # Train on partner local data set
-            history = full_model.fit(x_batch,
-                                     y_batch,
-                                     batch_size=partner.batch_size,
-                                     verbose=0,
-                                     validation_data=self.val_data)
+            history = self.fit_local_model(smodel,
+                                           partner.minibatched_x_train[self.minibatch_index],
+                                           partner.minibatched_y_train[self.minibatch_index],
+                                           partner.batch_size,
+                                           self.val_data)
 
             # Log results of the round
-            self.log_partner_perf(partner.id, partner_index, history.history)
+            self.log_partner_perf(partner.id, partner_index, history)
 
             # Update the partner's model in the models' list
-            partner.noise_layer_weights = full_model.get_layer('s-model').get_weights()
+            partner.noise_layer_weights = smodel.get_layer('s-model').get_weights()
             partner.model_weights = partner_model.get_weights()
 
         logger.debug("End of S-Model collaborative round.")
@@ -833,7 +875,8 @@ class FederatedGradients(MultiPartnerLearning):
         super(FederatedGradients, self).__init__(scenario, **kwargs)
         if self.partners_count == 1:
             raise ValueError('Only one partner is provided. Please use the dedicated SinglePartnerLearning class')
-        self.model = self.build_model()
+        # The global model and its optimizer are kept along the training, out of the pool slot of the evaluations
+        self.model = self.build_model_from_weights(self.model_weights, slot='global')
 
     def fit_epoch(self):
         # Split the train dataset in mini-batches
@@ -910,13 +953,11 @@ class EnsemblePredictions(MultiPartnerLearning):
         logger.info("Init EnsemblePredictionsModel model")
 
     def build_model(self):
-        partner_model_list = [partner.build_model() for partner in self.partners_list]
+        partner_model_list = [self.build_model_from_weights(partner.model_weights, slot=partner_index)
+                              for partner_index, partner in enumerate(self.partners_list)]
         return EnsemblePredictionsModel(partner_model_list)
 
     def fit_epoch(self):
-        # Clear Keras' old models
-        clear_session()
-
         self.eval_and_log_model_val_perf()
 
         for partner_index, partner in enumerate(self.partners_list):
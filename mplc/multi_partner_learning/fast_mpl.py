@@ -7,7 +7,7 @@ from loguru import logger
 from sklearn.metrics import confusion_matrix
 
 from .basic_mpl import ALLOWED_PARAMETERS
-from .utils import History
+from .utils import History, build_optimizer, copy_optimizer_state, optimizer_variables
 from .. import constants
 from ..models import NoiseAdaptationChannel
 from ..partner import Partner, PartnerMpl
@@ -43,7 +43,8 @@ class FastFedAvg:
 
     name = 'FastFedAvg'
 
-    def __init__(self, scenario, **kwargs):
+    def __init__(self, scenario, track_similarity=False, track_rounds_scores=False,
+                 rounds_val_set_size=constants.ROUNDS_VAL_SET_SIZE, **kwargs):
         # Attributes related to the data and the model
         self.dataset = scenario.dataset
         self.partners_list = scenario.partners_list
@@ -127,6 +128,19 @@ class FastFedAvg:
         # tf.function variables
         self.init_specific_tf_variable()
 
+        # If track_similarity, the similarity between the update of each partner and the aggregated update is
+        # accumulated during the training. Only FastFedAvg and FastFedGrad fill these statistics.
+        self.track_similarity = track_similarity
+        if self.track_similarity:
+            self.init_similarity_tf_variable()
+
+        # If track_rounds_scores, the validation accuracy of each partner's model and of the aggregated model is
+        # computed at each aggregation round, inside the tf.function, on a fixed subset of the validation set.
+        # Only FastFedAvg and FastFedGrad fill these scores, which are used by the federated step by step methods.
+        self.track_rounds_scores = track_rounds_scores
+        if self.track_rounds_scores:
+            self.init_rounds_scores_tf_variable(rounds_val_set_size)
+
         self.learning_computation_time = 0
         self.timer = 0
         self.epoch_timer = 0
@@ -149,6 +163,87 @@ class FastFedAvg:
         self.partners_optimizers = [self.model.optimizer.from_config(self.model.optimizer.get_config()) for _ in
                                     self.partners_list]
 
+    def init_similarity_tf_variable(self):
+        # generate tf Variables in which we accumulate, for each partner, the cosine similarity and the scalar
+        # projection of its update onto the aggregated update, over all the aggregation rounds
+        self.model_stateholder = [tf.Variable(initial_value=w.read_value()) for w in self.model.trainable_weights]
+        self.cosine_similarity_sum = tf.Variable(tf.zeros(self.partners_count))
+        self.cosine_similarity_sq_sum = tf.Variable(tf.zeros(self.partners_count))
+        self.projection_sum = tf.Variable(tf.zeros(self.partners_count))
+        self.similarity_rounds_count = tf.Variable(0.)
+
+    def accumulate_similarity(self, partners_updates, aggregated_update):
+        """Accumulate the similarity statistics of one aggregation round. To be called inside the tf.function"""
+        epsilon = 1e-12
+        aggregated_norm = tf.sqrt(tf.add_n([tf.reduce_sum(tf.square(u)) for u in aggregated_update]))
+        dots = tf.stack([tf.add_n([tf.reduce_sum(u * a) for u, a in zip(partner_update, aggregated_update)])
+                         for partner_update in partners_updates])
+        norms = tf.stack([tf.sqrt(tf.add_n([tf.reduce_sum(tf.square(u)) for u in partner_update]))
+                          for partner_update in partners_updates])
+        cosine_similarities = dots / (norms * aggregated_norm + epsilon)
+        self.cosine_similarity_sum.assign_add(cosine_similarities)
+        self.cosine_similarity_sq_sum.assign_add(tf.square(cosine_similarities))
+        self.projection_sum.assign_add(dots / (aggregated_norm + epsilon))
+        self.similarity_rounds_count.assign_add(1.)
+
+    def rounds_per_epoch(self):
+        """Number of aggregation rounds per epoch: the partners' datasets are zipped, so the smallest one sets it"""
+        return min(int(np.ceil((len(p.y_train) // p.batch_size) / self.gradient_updates_per_pass_count))
+                   for p in self.partners_list)
+
+    def init_rounds_scores_tf_variable(self, rounds_val_set_size):
+        # generate tf Variables in which we store the validation accuracy of each partner's model and of the
+        # aggregated model, for each aggregation round. The rounds not played (early stopping) stay at NaN
+        rounds_count = self.epoch_count * self.rounds_per_epoch()
+        self.rounds_x_val = tf.constant(self.dataset.x_val[:rounds_val_set_size])
+        self.rounds_y_val = tf.constant(self.dataset.y_val[:rounds_val_set_size])
+        self.rounds_stateholder = [tf.Variable(initial_value=w.read_value()) for w in self.model.trainable_weights]
+        self.rounds_partners_scores = tf.Variable(tf.fill((rounds_count, self.partners_count), np.nan))
+        self.rounds_model_scores = tf.Variable(tf.fill((rounds_count,), np.nan))
+        self.round_index = tf.Variable(0)
+
+    def rounds_val_accuracy(self, model):
+        """Return the accuracy of the current weights of model on the validation subset. To be called inside the
+        tf.function"""
+        y_pred = model(self.rounds_x_val)
+        if y_pred.shape[-1] == 1:  # single output with a sigmoid
+            predictions = tf.cast(tf.reshape(y_pred, [-1]) > 0.5, tf.int64)
+            labels = tf.cast(tf.reshape(self.rounds_y_val, [-1]) > 0.5, tf.int64)
+        else:
+            predictions = tf.argmax(y_pred, axis=-1)
+            labels = tf.argmax(self.rounds_y_val, axis=-1)
+        return tf.reduce_mean(tf.cast(tf.equal(predictions, labels), tf.float32))
+
+    def record_round_scores(self, partners_scores, model_score):
+        """Write the scores of the current aggregation round, partners_scores being a tensor of shape
+        (partners_count,). To be called inside the tf.function"""
+        if self.round_index < self.rounds_model_scores.shape[0]:
+            self.rounds_partners_scores[self.round_index].assign(partners_scores)
+            self.rounds_model_scores[self.round_index].assign(model_score)
+        self.round_index.assign_add(1)
+
+    def log_rounds_scores(self):
+        """Store the scores of the aggregation rounds in the history, as matrices of shape
+        (epoch_count, rounds_per_epoch)"""
+        shape = (self.epoch_count, self.rounds_per_epoch())
+        partners_scores = self.rounds_partners_scores.numpy()
+        self.history.rounds_val_accuracy = {partner.id: partners_scores[:, i].reshape(shape)
+                                            for i, partner in enumerate(self.partners_list)}
+        self.history.rounds_val_accuracy['mpl_model'] = self.rounds_model_scores.numpy().reshape(shape)
+
+    def get_similarity_scores(self):
+        """Return the mean over the aggregation rounds of the cosine similarity between each partner's update and
+        the aggregated update, its standard error, and the mean scalar projection of each partner's update onto the
+        aggregated update"""
+        rounds_count = float(self.similarity_rounds_count.numpy()) if self.track_similarity else 0.
+        if rounds_count == 0:
+            raise ValueError(f"No similarity statistics were accumulated by {self.name}. It must be fitted with "
+                             f"track_similarity=True, which is supported by FastFedAvg and FastFedGrad only")
+        cosine_mean = self.cosine_similarity_sum.numpy() / rounds_count
+        cosine_var = np.maximum(self.cosine_similarity_sq_sum.numpy() / rounds_count - cosine_mean ** 2, 0)
+        projection_mean = self.projection_sum.numpy() / rounds_count
+        return cosine_mean, np.sqrt(cosine_var / rounds_count), projection_mean
+
     def init_aggregation_function(self, aggregator):
         return aggregator(self)
 
@@ -200,11 +295,16 @@ class FastFedAvg:
                 return True
         return False
 
-    def fit(self):
+    def build_fit_minibatch(self):
 
         # TF function definition
         @tf.function
         def fit_minibatch(model, partners_minibatches, partners_optimizers, partners_weights, aggregation_weights):
+            if self.track_similarity:  # store the global weights, to compute the updates
+                for model_w, old_w in zip(model.trainable_weights, self.model_stateholder):
+                    old_w.assign(model_w.read_value())
+            partners_scores = []
+
             for p_id, minibatch in enumerate(partners_minibatches):  # minibatch == (x,y)
                 # minibatch[0] in a tensor of shape=(number of batch, batch size, img).
                 # We cannot iterate on tensors, so we convert this tensor to a list of
@@ -227,15 +327,31 @@ class FastFedAvg:
                 for model_w, partner_w in zip(model.trainable_weights,
                                               partners_weights[p_id]):  # update the partner's weights
                     partner_w.assign(model_w.read_value())
+                if self.track_rounds_scores:  # score the partner's model, before the aggregation
+                    partners_scores.append(self.rounds_val_accuracy(model))
             # at the end of the minibatch, aggregate all the local weights
             for i, weights_per_layer in enumerate(zip(*partners_weights)):
                 model.trainable_weights[i].assign(tf.tensordot(weights_per_layer, aggregation_weights, [0, 0]))
 
+            if self.track_rounds_scores:
+                self.record_round_scores(tf.stack(partners_scores), self.rounds_val_accuracy(model))
+
+            if self.track_similarity:
+                self.accumulate_similarity(
+                    [[w - old_w for w, old_w in zip(partner_weights, self.model_stateholder)]
+                     for partner_weights in partners_weights],
+                    [w - old_w for w, old_w in zip(model.trainable_weights, self.model_stateholder)])
+
             # inform the partners with the new weights
             for p_id in range(len(partners_minibatches)):
                 for new_w, partner_w in zip(model.trainable_weights, partners_weights[p_id]):
                     partner_w.assign(new_w.read_value())
 
+        return fit_minibatch
+
+    def fit(self):
+        fit_minibatch = self.build_fit_minibatch()
+
         # Execution
         self.timer = time.time()
         for e in range(self.epoch_count):
@@ -254,6 +370,8 @@ class FastFedAvg:
                 break
 
         self.log_end_training()
+        if self.track_rounds_scores:
+            self.log_rounds_scores()
 
 
 class FastFedAvgSmodel(FastFedAvg):
@@ -379,8 +497,9 @@ class FastFedAvgSmodel(FastFedAvg):
                                              normalize='pred')
                 p.noise_layer_weights = [np.log(confusion.T + 1e-8)]
         else:
+            num_classes = self.dataset.num_classes
             for p in self.partners_list:
-                confusion = np.identity(10) * (1 - self.epsilon) + (self.epsilon / 10)
+                confusion = np.identity(num_classes) * (1 - self.epsilon) + (self.epsilon / num_classes)
                 p.noise_layer_weights = [np.log(confusion + 1e-8)]
 
         for p, smodel in zip(self.partners_list, self.smodel_list):
@@ -427,6 +546,23 @@ class FastFedGrad(FastFedAvg):
             p.train_data = p.train_data.prefetch(1)
         self.train_dataset = [p.train_data for p in self.partners_list]
 
+    def rounds_per_epoch(self):
+        """Number of aggregation rounds per epoch: the gradients are aggregated after each local batch"""
+        return min(len(p.y_train) // p.batch_size for p in self.partners_list)
+
+    def partner_step_val_accuracy(self, model, partner_grad):
+        """Return the validation accuracy of the global model moved by a plain gradient step along the gradient of
+        a partner, with the learning rate of the global optimizer. The optimizer state is not modified. To be
+        called inside the tf.function"""
+        learning_rate = tf.cast(model.optimizer.learning_rate, tf.float32)
+        for model_w, old_w, grad in zip(model.trainable_weights, self.rounds_stateholder, partner_grad):
+            old_w.assign(model_w.read_value())
+            model_w.assign_sub(learning_rate * grad)
+        score = self.rounds_val_accuracy(model)
+        for model_w, old_w in zip(model.trainable_weights, self.rounds_stateholder):
+            model_w.assign(old_w.read_value())
+        return score
+
     def init_specific_tf_variable(self):
         # generate tf Variables in which we will store the model weights
         self.partners_grads = [[tf.Variable(initial_value=w.read_value()) for w in self.model.trainable_weights]
@@ -439,6 +575,7 @@ class FastFedGrad(FastFedAvg):
         # TF function definition
         @tf.function
         def fit_epoch(model, train_dataset, partners_grads, global_grad, aggregation_weights):
+            partners_scores = tf.zeros(self.partners_count)  # the loop variables must be defined before the loop
             for minibatch in zip(*train_dataset):
                 for p_id, (x_partner_batch, y_partner_batch) in enumerate(minibatch):
                     with tf.GradientTape() as tape:
@@ -451,7 +588,14 @@ class FastFedGrad(FastFedAvg):
 
                 for i, grads_per_layer in enumerate(zip(*partners_grads)):
                     global_grad[i].assign(tf.tensordot(grads_per_layer, aggregation_weights, [0, 0]))
+                if self.track_similarity:
+                    self.accumulate_similarity(partners_grads, global_grad)
+                if self.track_rounds_scores:
+                    partners_scores = tf.stack([self.partner_step_val_accuracy(model, partner_grad)
+                                                for partner_grad in partners_grads])
                 model.optimizer.apply_gradients(zip(global_grad, model.trainable_weights))
+                if self.track_rounds_scores:
+                    self.record_round_scores(partners_scores, self.rounds_val_accuracy(model))
 
         # Execution
         self.timer = time.time()
@@ -466,6 +610,8 @@ class FastFedGrad(FastFedAvg):
                 break
 
         self.log_end_training()
+        if self.track_rounds_scores:
+            self.log_rounds_scores()
 
 
 class FastGradSmodel(FastFedGrad):
@@ -552,8 +698,9 @@ class FastGradSmodel(FastFedGrad):
                                              normalize='pred')
                 p.noise_layer_weights = [np.log(confusion.T + 1e-8)]
         else:
+            num_classes = self.dataset.num_classes
             for p in self.partners_list:
-                confusion = np.identity(10) * (1 - self.epsilon) + (self.epsilon / 10)
+                confusion = np.identity(num_classes) * (1 - self.epsilon) + (self.epsilon / num_classes)
                 p.noise_layer_weights = [np.log(confusion + 1e-8)]
 
         for p, smodel in zip(self.partners_list, self.smodel_list):
@@ -669,3 +816,214 @@ class FastFedGDO(FastFedAvg):
                 break
 
         self.log_end_training()
+
+
+class FastPVRL(FastFedAvg):
+    """ This class defines the FastFedAvg engine used by the PVRL contributivity method. Several rollouts, each one
+    with its own selection of partners given by a mask, are trained from the same state (the model weights and the
+    partners' optimizers) and on the same rounds of minibatches. The weights of the rollouts are stacked on a leading
+    rollout axis, and a single compiled step trains all of them for a round: the local steps of the partners not
+    selected by a rollout are skipped, and the local models of each rollout are aggregated with its masked aggregation
+    weights. So the partners list and the compiled step are never rebuilt when the selections change."""
+
+    name = 'FastPVRL'
+
+    def __init__(self, scenario, rollouts_count=1, **kwargs):
+        super(FastPVRL, self).__init__(scenario, **kwargs)
+        self.base_aggregation_weights = self.aggregation_weights.numpy()
+        self.rounds_iterator = iter(())
+        # Create the variables of the partners' optimizers now, so that their state can be saved before any rollout
+        for optimizer in self.partners_optimizers:
+            build_optimizer(optimizer, self.model.trainable_weights)
+        self.init_rollouts_tf_variable(rollouts_count)
+        self.fit_rollouts_minibatch = self.build_fit_rollouts_minibatch()
+
+    def init_rollouts_tf_variable(self, rollouts_count):
+        # generate tf Variables in which we store the weights of the model of each rollout, and of the local models of
+        # its partners, stacked on a leading rollout axis, and the optimizers of the partners of each rollout
+        self.rollouts_count = rollouts_count
+        self.rollouts_weights = [tf.Variable(tf.zeros((rollouts_count,) + tuple(w.shape), dtype=w.dtype))
+                                 for w in self.model.trainable_weights]
+        self.rollouts_partners_weights = [
+            tf.Variable(tf.zeros((rollouts_count, self.partners_count) + tuple(w.shape), dtype=w.dtype))
+            for w in self.model.trainable_weights]
+        self.rollouts_optimizers = [[self.model.optimizer.from_config(self.model.optimizer.get_config())
+                                     for _ in self.partners_list] for _ in range(rollouts_count)]
+        for rollout_optimizers in self.rollouts_optimizers:
+            for optimizer in rollout_optimizers:
+                build_optimizer(optimizer, self.model.trainable_weights)
+
+    def build_fit_rollouts_minibatch(self):
+
+        # TF function definition
+        @tf.function
+        def fit_rollouts_minibatch(model, partners_minibatches, aggregation_weights, rollouts_optimizers,
+                                   rollouts_weights, rollouts_partners_weights):
+            # aggregation_weights has a shape (rollouts, partners_count), the weights of the partners not selected are 0
+            rollouts = len(rollouts_optimizers)
+            for r, partners_optimizers in enumerate(rollouts_optimizers):
+                for p_id, minibatch in enumerate(partners_minibatches):  # minibatch == (x,y)
+                    if aggregation_weights[r, p_id] > 0:  # the local steps of the partners not selected are skipped
+                        for model_w, rollout_w in zip(model.trainable_weights, rollouts_weights):
+                            model_w.assign(rollout_w[r])  # set the model weights to the rollout's ones
+
+                        # iterate over batches in a graph loop, so the step is traced once per rollout and partner
+                        for batch_index in tf.range(tf.shape(minibatch[0])[0]):
+                            with tf.GradientTape() as tape:
+                                y_pred = model(minibatch[0][batch_index])
+                                loss = model.compiled_loss(minibatch[1][batch_index], y_pred)
+                            partners_optimizers[p_id].minimize(loss, model.trainable_weights,
+                                                               tape=tape)  # perform local optimization
+
+                        for model_w, partners_w in zip(model.trainable_weights, rollouts_partners_weights):
+                            partners_w[r, p_id].assign(model_w.read_value())  # update the partner's weights
+
+            # at the end of the minibatch, aggregate the local weights of all the rollouts at once
+            for rollout_w, partners_w in zip(rollouts_weights, rollouts_partners_weights):
+                weights_shape = tuple(aggregation_weights.shape) + (1,) * (len(rollout_w.shape) - 1)
+                rollout_w[:rollouts].assign(
+                    tf.reduce_sum(tf.reshape(aggregation_weights, weights_shape) * partners_w[:rollouts], axis=1))
+
+        return fit_rollouts_minibatch
+
+    def next_round(self):
+        """Return the next minibatch of each partner, starting a new pass over the data when the current one ends"""
+        try:
+            return next(self.rounds_iterator)
+        except StopIteration:
+            self.rounds_iterator = iter(zip(*self.train_dataset))
+            return next(self.rounds_iterator)
+
+    def next_rounds(self, rounds_count):
+        """Return the next rounds_count rounds of minibatches, which can be replayed by several rollouts"""
+        return [self.next_round() for _ in range(rounds_count)]
+
+    def val_loss(self):
+        return self.model.evaluate(self.val_data, return_dict=True, verbose=False)['loss']
+
+    def rollouts(self, masks, rounds):
+        """Train a rollout per binary mask over the partners, from the current state and on the rounds of
+        minibatches, with the partners selected by the mask only, and return their validation losses. The engine then
+        goes on from the state of the first rollout."""
+        masks = np.atleast_2d(masks)
+        if len(masks) > self.rollouts_count:
+            raise ValueError(f"This engine runs at most {self.rollouts_count} rollouts at once, not {len(masks)}")
+        weights = self.base_aggregation_weights * masks
+        aggregation_weights = tf.constant(weights / np.sum(weights, axis=1, keepdims=True), dtype=tf.float32)
+        rollouts_optimizers = self.rollouts_optimizers[:len(masks)]
+
+        # All the rollouts start from the current state
+        for rollout_w, model_w in zip(self.rollouts_weights, self.model.trainable_weights):
+            rollout_w.assign(tf.repeat(model_w[None], self.rollouts_count, axis=0))
+        for rollout_optimizers in rollouts_optimizers:
+            for optimizer, partner_optimizer in zip(rollout_optimizers, self.partners_optimizers):
+                copy_optimizer_state(partner_optimizer, optimizer)
+
+        for partners_minibatches in rounds:
+            self.fit_rollouts_minibatch(self.model,
+                                        partners_minibatches,
+                                        aggregation_weights,
+                                        rollouts_optimizers,
+                                        self.rollouts_weights,
+                                        self.rollouts_partners_weights)
+
+        losses = np.zeros(len(masks))
+        for r in reversed(range(len(masks))):  # the model ends with the weights of the first rollout
+            for model_w, rollout_w in zip(self.model.trainable_weights, self.rollouts_weights):
+                model_w.assign(rollout_w[r])
+            losses[r] = self.val_loss()
+        for partner_weights in self.partners_weights:
+            for model_w, partner_w in zip(self.model.trainable_weights, partner_weights):
+                partner_w.assign(model_w.read_value())
+        for partner_optimizer, optimizer in zip(self.partners_optimizers, rollouts_optimizers[0]):
+            copy_optimizer_state(optimizer, partner_optimizer)
+        return losses
+
+    def rollout(self, mask, rounds):
+        """Train the current model on the rounds of minibatches with the partners selected by the mask, and return
+        its validation loss"""
+        return self.rollouts([mask], rounds)[0]
+
+    def get_state(self):
+        """Return the weights of the model, and the values of the variables of the partners' optimizers"""
+        return (self.model.get_weights(),
+                [[variable.numpy() for variable in optimizer_variables(optimizer)]
+                 for optimizer in self.partners_optimizers])
+
+    def set_state(self, state):
+        """Restore a state returned by get_state: the weights of the model and of the partners' local models, and the
+        variables of the partners' optimizers"""
+        model_weights, optimizers_state = state
+        self.model.set_weights(model_weights)
+        for partner_weights in self.partners_weights:
+            for model_w, partner_w in zip(self.model.trainable_weights, partner_weights):
+                partner_w.assign(model_w.read_value())
+        for optimizer, optimizer_state in zip(self.partners_optimizers, optimizers_state):
+            for variable, value in zip(optimizer_variables(optimizer), optimizer_state):
+                variable.assign(value)
+
+
+class FastGradientShapley:
+    """ This class is not a multi_partner_learning method, but the single pass training used by the gradient Shapley
+    (G-Shapley) contributivity method. Starting from the same initial weights, the data of the partners are applied
+    as SGD steps, one partner after the other following a permutation, and the validation accuracy is measured after
+    each partner. The increase of the accuracy is the marginal contribution of the partner in this permutation.
+    As with the other fast methods, the model is built once, and the training step is a tf.function."""
+
+    name = 'FastGradientShapley'
+
+    def __init__(self, scenario, learning_rate=0.01, initial_weights=None):
+        self.dataset = scenario.dataset
+        self.partners_list = scenario.partners_list
+        self.learning_rate = learning_rate
+
+        self.model = self.dataset.generate_new_model()
+        if not isinstance(self.model, tf.keras.Model):
+            raise Exception("The gradient Shapley method only handles Keras based model.")
+        if initial_weights is not None:
+            self.model.set_weights(initial_weights)
+        self.initial_weights = self.model.get_weights()
+
+        # Convert the datasets into tf ones. Each partner's data are seen once per permutation
+        self.train_dataset = []
+        for p in self.partners_list:
+            train_data = tf.data.Dataset.from_tensor_slices((p.x_train, p.y_train))
+            train_data = train_data.shuffle(len(p.y_train), reshuffle_each_iteration=True)
+            self.train_dataset.append(train_data.batch(p.batch_size).prefetch(1))
+
+        self.val_data = tf.data.Dataset.from_tensor_slices((self.dataset.x_val, self.dataset.y_val))
+        self.val_data = self.val_data.batch(constants.DEFAULT_BATCH_SIZE).prefetch(1)
+
+        self.train_step = self.build_train_step()
+
+    def build_train_step(self):
+        model = self.model
+        learning_rate = tf.constant(self.learning_rate, dtype=tf.float32)
+
+        # TF function definition
+        @tf.function(experimental_relax_shapes=True)
+        def train_step(x, y):
+            with tf.GradientTape() as tape:
+                y_pred = model(x, training=True)
+                loss = model.compiled_loss(y, y_pred)
+            gradients = tape.gradient(loss, model.trainable_weights)
+            for w, grad in zip(model.trainable_weights, gradients):  # plain SGD step
+                w.assign_sub(learning_rate * grad)
+
+        return train_step
+
+    def evaluate(self):
+        return self.model.evaluate(self.val_data, return_dict=True, verbose=False)['accuracy']
+
+    def permutation_marginals(self, permutation):
+        """Return the marginal contributions of the partners along a single pass on the permutation"""
+        self.model.set_weights(self.initial_weights)
+        marginals = np.zeros(len(self.partners_list))
+        score = self.evaluate()
+        for partner_index in permutation:
+            for x, y in self.train_dataset[partner_index]:
+                self.train_step(x, y)
+            new_score = self.evaluate()
+            marginals[partner_index] = new_score - score
+            score = new_score
+        return marginals
@@ -21,6 +21,7 @@ class History:
         self.save_folder = mpl.save_folder
         self.nb_epochs_done = 0
         self.score = None  # Final score evaluated on the test dataset at the end of the training
+        self.rounds_val_accuracy = None  # Scores of each aggregation round, filled by the fast mpl if tracked
         self.metrics = ['val_accuracy', 'val_loss', 'loss', 'accuracy']
         temp_dict = {key: np.nan * np.zeros((mpl.epoch_count, mpl.minibatch_count)) for key in self.metrics}
         self.history = {partner.id: deepcopy(temp_dict) for partner in mpl.partners_list}
@@ -110,6 +111,101 @@ class History:
         plt.close()
 
 
+#####################################
+#
+# Models pool
+#
+#####################################
+
+def optimizer_variables(optimizer):
+    variables = optimizer.variables
+    return variables() if callable(variables) else variables  # a method on the optimizers prior to TF 2.11
+
+
+def build_optimizer(optimizer, variables):
+    """Create the variables of optimizer (iterations, slots) for the training of variables"""
+    if hasattr(optimizer, '_create_all_weights'):  # OptimizerV2, prior to TF 2.11
+        optimizer._create_all_weights(variables)
+    else:
+        optimizer.build(variables)
+
+
+def init_optimizer_state(model):
+    """Create the variables of the optimizer of a compiled model (iterations, slots) and return their initial values,
+    or None if the model has no optimizer"""
+    optimizer = getattr(model, 'optimizer', None)
+    if optimizer is None:
+        return None
+    build_optimizer(optimizer, model.trainable_variables)
+    return [variable.numpy() for variable in optimizer_variables(optimizer)]
+
+
+def reset_optimizer_state(model, optimizer_state):
+    """Reset the variables of the optimizer of model to the values returned by init_optimizer_state"""
+    if optimizer_state is not None:
+        for variable, value in zip(optimizer_variables(model.optimizer), optimizer_state):
+            variable.assign(value)
+
+
+def copy_optimizer_state(source, target):
+    """Assign the values of the variables of the optimizer source to the ones of the optimizer target, both built for
+    the same variables"""
+    for source_variable, target_variable in zip(optimizer_variables(source), optimizer_variables(target)):
+        target_variable.assign(source_variable.read_value())
+
+
+def compile_step(step, x, y):
+    """Compile step (the train_step or the test_step of a Keras model) with tf.function, for batches of any size of
+    the dtypes and the shapes of the samples x and the labels y"""
+    return tf.function(step, input_signature=[(tf.TensorSpec((None,) + x.shape[1:], x.dtype),
+                                               tf.TensorSpec((None,) + y.shape[1:], y.dtype))])
+
+
+def run_compiled_step(step, model, x, y, batch_size):
+    """Run the compiled step of model on the successive batches of (x, y), and return the values of the loss and the
+    metrics of model over the pass, as in the history of Keras' fit()"""
+    model.reset_metrics()
+    for start in range(0, len(x), batch_size):
+        step((x[start:start + batch_size], y[start:start + batch_size]))
+    return {metric.name: [float(metric.result())] for metric in model.metrics}
+
+
+#####################################
+#
+# Parameter arena
+#
+#####################################
+
+class ParameterArena:
+    """Store the model weights of several partners as the rows of a single contiguous float32 buffer, of shape
+    (rows_count, number of parameters of the model). Each row is exposed as a list of per-layer views, so the weights of
+    a partner are updated in place, and an average of the models of several partners is a single matrix product.
+    """
+
+    def __init__(self, weights_template, rows_count):
+        self.shapes = [np.shape(weights) for weights in weights_template]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.cumsum([0] + self.sizes)
+        self.buffer = np.zeros((rows_count, self.offsets[-1]), dtype='float32')
+        self.rows = [self.split(row) for row in self.buffer]
+
+    def split(self, vector):
+        """Return the list of the per-layer views of a flat vector of weights"""
+        return [vector[start:end].reshape(shape) for start, end, shape in
+                zip(self.offsets[:-1], self.offsets[1:], self.shapes)]
+
+    def write(self, row, weights):
+        for view, weights_for_layer in zip(self.rows[row], weights):
+            view[...] = weights_for_layer
+
+    def average(self, aggregation_weights, rows):
+        """Return the average of the weights stored in the rows passed as arguments, weighted by aggregation_weights,
+        as a list of per-layer arrays"""
+        rows_weights = np.zeros(len(self.buffer), dtype='float32')
+        rows_weights[rows] = aggregation_weights
+        return self.split(rows_weights.dot(self.buffer) / np.sum(rows_weights))
+
+
 #####################################
 #
 # Aggregators
@@ -143,17 +239,11 @@ class Aggregator(ABC):
 
     def aggregate_model_weights(self, partial_partners_list=None):
         """Aggregate model weights from the list or partial list of partner's models, with a weighted average"""
-
-        weights_per_layer = list(zip(*[partner.model_weights for partner in self.mpl.partners_list]))
-        new_weights = list()
-
-        for weights_for_layer in weights_per_layer:
-            avg_weights_for_layer = np.average(
-                np.array(weights_for_layer), axis=0, weights=self.aggregation_weights
-            )
-            new_weights.append(avg_weights_for_layer)
-
-        return new_weights
+        if partial_partners_list is None:
+            return self.mpl.average_partners_weights(self.mpl.partners_list, self.aggregation_weights)
+        partners_weights = dict(zip(self.mpl.partners_list, self.aggregation_weights))
+        return self.mpl.average_partners_weights(partial_partners_list,
+                                                 [partners_weights[partner] for partner in partial_partners_list])
 
     def aggregate_gradients(self):
         assert isinstance(self.aggregation_weights, list), 'Aggregation weights must be a list.'
@@ -190,13 +280,13 @@ class ScoresAggregator(Aggregator):
         last_scores = [partner.last_round_score for partner in self.mpl.partners_list]
         self.aggregation_weights = list((last_scores / np.sum(last_scores)).astype('float32'))
 
-    def aggregate_model_weights(self):
+    def aggregate_model_weights(self, partial_partners_list=None):
         self.prepare_aggregation_weights()
-        super(ScoresAggregator, self).aggregate_model_weights()
+        return super(ScoresAggregator, self).aggregate_model_weights(partial_partners_list)
 
     def aggregate_gradients(self):
         self.prepare_aggregation_weights()
-        super(ScoresAggregator, self).aggregate_gradients()
+        return super(ScoresAggregator, self).aggregate_gradients()
 
 
 # Supported _aggregation weights approaches
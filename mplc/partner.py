@@ -86,11 +86,25 @@ class PartnerMpl:
         self.batch_size = partner_parent.batch_size
         self.minibatch_count = mpl.minibatch_count
         self.partner_parent = partner_parent
-        self.model_weights = None
+        self.arena_row = None  # row of the partner's model weights in the parameter arena of the mpl, if any
+        self._model_weights = None
 
         self.minibatched_x_train = np.nan * np.zeros(self.minibatch_count)
         self.minibatched_y_train = np.nan * np.zeros(self.minibatch_count)
 
+    @property
+    def model_weights(self):
+        if self.arena_row is None:
+            return self._model_weights
+        return self.mpl.parameter_arena.rows[self.arena_row]
+
+    @model_weights.setter
+    def model_weights(self, weights):
+        if self.arena_row is None:
+            self._model_weights = weights
+        else:
+            self.mpl.parameter_arena.write(self.arena_row, weights)
+
     @property
     def y_train(self):
         return self.partner_parent.y_train
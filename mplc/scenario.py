@@ -7,6 +7,7 @@ import datetime
 import os
 import re
 import uuid
+from copy import copy
 from pathlib import Path
 
 import numpy as np
@@ -33,6 +34,7 @@ class Scenario:
             dataset_proportion=1,
             samples_split_option='random',
             corruption_parameters=None,
+            partners_groups=None,
             init_model_from="random_initialization",
             multi_partner_learning_approach="fedavg",
             aggregation="data-volume",
@@ -65,6 +67,9 @@ class Scenario:
         :param corruption_parameters: list of Corruption object, or its string identifier, one for each partner.
                                       Enable to artificially corrupt partner's data.
                                       For instance: [Permutation(proportion=0.2), 'random', 'not-corrupted']
+        :param partners_groups: None (default), or list of groups of partners' indexes, for instance the subsidiaries
+                                of a same company: [[0, 1], [2, 3, 4]]. Used by the Owen value contributivity method.
+                                The partners not listed are alone in their group.
         :param init_model_from: None (default) or path
         :param multi_partner_learning_approach: 'fedavg' (default), 'seq-pure', 'seq-with-final-agg' or 'seqavg'
                                                 Define the multi-partner learning approach
@@ -77,7 +82,9 @@ class Scenario:
         :param is_quick_demo: boolean. Useful for debugging
         :param save_path: path where to save the scenario outputs (relative to current working directory)
         :param scenario_id: str
-        :param **kwargs:
+        :param **kwargs: parameters prefixed with 'mpl_' are passed to the multi-partner learning approach, and
+                         parameters prefixed with 'contrib_' are passed to the contributivity methods.
+                         For instance: contrib_n_jobs=4, contrib_repeats=3
         """
 
         # ---------------------------------------------------------------------
@@ -102,6 +109,7 @@ class Scenario:
             "active_partners_count",
             "amounts_per_partner",
             "corruption_parameters",
+            "partners_groups",
             "samples_split_option",
             "samples_split_configuration"
         ]  # Partners related
@@ -119,7 +127,9 @@ class Scenario:
                          "repeat_count",
                          ]
 
-        unrecognised_parameters = [x for x in kwargs.keys() if (x not in params_known and not x.startswith('mpl_'))]
+        unrecognised_parameters = [x for x in kwargs.keys() if (x not in params_known
+                                                                and not x.startswith('mpl_')
+                                                                and not x.startswith('contrib_'))]
         if len(unrecognised_parameters) > 0:
             for x in unrecognised_parameters:
                 logger.debug(f"Unrecognised parameter: {x}")
@@ -225,11 +235,24 @@ class Scenario:
         else:
             self.corruption_parameters = [NoCorruption() for _ in range(self.partners_count)]  # default
 
+        # To configure the groups of partners (for instance subsidiaries of a same company)
+        self.partners_groups = partners_groups
+        if self.partners_groups is not None:
+            grouped_partners = [i for group in self.partners_groups for i in group]
+            if len(set(grouped_partners)) != len(grouped_partners):
+                raise ValueError(f"A partner cannot belong to several groups, check partners_groups: "
+                                 f"{self.partners_groups}")
+            if not set(grouped_partners).issubset(range(self.partners_count)):
+                raise ValueError(f"The partners_groups {self.partners_groups} must contain partners' indexes, "
+                                 f"between 0 and {self.partners_count - 1}")
+
         # ---------------------------------------------------
         #  Configuration of the distributed learning approach
         # ---------------------------------------------------
 
         self.mpl = None
+        self.probe_embeddings = None  # cached embeddings of the linear-probe characteristic function
+        self.coalition_store = None  # store of the coalitions' models, see coalition_store.CoalitionModelStore
 
         # Multi-partner learning approach
         self.multi_partner_learning_approach = multi_partner_learning_approach
@@ -371,9 +394,12 @@ class Scenario:
         # -------------------------------------------------------------------
 
         self.mpl_kwargs = {}
+        self.contributivity_kwargs = {}
         for key, value in kwargs.items():
             if key.startswith('mpl_'):
-                self.mpl_kwargs[key.replace('mpl_', '')] = value
+                self.mpl_kwargs[key.replace('mpl_', '', 1)] = value
+            elif key.startswith('contrib_'):
+                self.contributivity_kwargs[key.replace('contrib_', '', 1)] = value
 
         # -----------------------
         # Provision the scenario
@@ -421,6 +447,8 @@ class Scenario:
         for key in ['partners_list',
                     '_multi_partner_learning_approach',
                     'mpl',
+                    'probe_embeddings',
+                    'coalition_store',
                     'aggregation',
                     'use_saved_weights',
                     'contributivity_list',
@@ -428,6 +456,8 @@ class Scenario:
                     'short_scenario_name',
                     'save_folder',
                     'splitter',
+                    'mpl_kwargs',
+                    'contributivity_kwargs',
                     ]:
             del params[key]
         if 'is_quick_demo' in kwargs and kwargs['is_quick_demo'] != self.is_quick_demo:
@@ -435,11 +465,22 @@ class Scenario:
         params['save_path'] = self.save_folder.parents[0]
         params['samples_split_option'] = self.splitter.copy()
         params['aggregation'] = self.aggregation.name
+        params.update({f'mpl_{key}': value for key, value in self.mpl_kwargs.items()})
+        params.update({f'contrib_{key}': value for key, value in self.contributivity_kwargs.items()})
 
         params.update(kwargs)
 
         return Scenario(**params)
 
+    def copy_for_workers(self):
+        """Return a shallow copy of the scenario, stripped of the trained objects, which can be sent to worker
+        processes (for instance to train several coalitions in parallel)"""
+        scenario = copy(self)
+        scenario.mpl = None
+        scenario.contributivity_list = []
+        scenario.coalition_store = None
+        return scenario
+
     def log_scenario_description(self):
         """Log the description of the scenario configured"""
 
@@ -478,6 +519,52 @@ class Scenario:
             raise Exception('Partners have already been initialized')
         self.partners_list = [Partner(i, corruption=self.corruption_parameters[i]) for i in range(self.partners_count)]
 
+    def add_partner(self, x_train, y_train, x_val=None, y_val=None, x_test=None, y_test=None):
+        """Add a partner with the given data to an initialized scenario, and return it. Its index is the last one
+        of partners_list. Validation and test data are required if the scenario uses local validation or test sets."""
+        partner = Partner(max(p.id for p in self.partners_list) + 1)
+        if self.val_set == 'local' and x_val is None:
+            raise ValueError("The scenario uses local validation sets, x_val and y_val must be provided")
+        if self.test_set == 'local' and x_test is None:
+            raise ValueError("The scenario uses local test sets, x_test and y_test must be provided")
+        self.partners_list.append(partner)
+        self.corruption_parameters.append(partner.corruption)
+        self.partners_count += 1
+        if self.partners_groups is not None:
+            self.partners_groups = self.partners_groups + [[self.partners_count - 1]]
+        self.update_partner_data(self.partners_count - 1, x_train, y_train, x_val, y_val, x_test, y_test)
+        logger.info(f"Partner #{partner.id} added to the scenario, with {len(y_train)} train samples")
+        return partner
+
+    def remove_partner(self, partner_index):
+        """Remove the partner at partner_index from an initialized scenario, and return it. The indexes of the
+        following partners are shifted by one."""
+        partner = self.partners_list.pop(partner_index)
+        del self.corruption_parameters[partner_index]
+        self.partners_count -= 1
+        if self.partners_groups is not None:
+            groups = [[i - (i > partner_index) for i in group if i != partner_index] for group in self.partners_groups]
+            self.partners_groups = [group for group in groups if len(group) > 0]
+        self.update_partners_amounts()
+        logger.info(f"Partner #{partner.id} removed from the scenario")
+        return partner
+
+    def update_partner_data(self, partner_index, x_train, y_train, x_val=None, y_val=None, x_test=None, y_test=None):
+        """Replace the train data of the partner at partner_index, and its validation and test data if given"""
+        partner = self.partners_list[partner_index]
+        partner.x_train, partner.y_train = x_train, y_train
+        if x_val is not None:
+            partner.x_val, partner.y_val = x_val, y_val
+        if x_test is not None:
+            partner.x_test, partner.y_test = x_test, y_test
+        self.update_partners_amounts()
+
+    def update_partners_amounts(self):
+        """Update the amounts of the partners to their share of the train data, after a change of the partners"""
+        self.amounts_per_partner = [p.final_nb_samples / self.nb_samples_used for p in self.partners_list]
+        self.probe_embeddings = None
+        self.compute_batch_sizes()
+
     def split_data(self):
         self.splitter.split(self.partners_list, self.dataset)
         return 0
@@ -638,7 +725,7 @@ class Scenario:
         for method in self.contributivity_methods:
             logger.info(f"{method}")
             contrib = contributivity.Contributivity(scenario=self)
-            contrib.compute_contributivity(method)
+            contrib.compute_contributivity(method, **self.contributivity_kwargs)
             self.append_contributivity(contrib)
             logger.info(f"Evaluating contributivity with {method}: {contrib}")
 
@@ -123,6 +123,8 @@ def parse_command_line_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--file", help="input config file")
     parser.add_argument("-v", "--verbose", help="verbose output", action="store_true")
+    parser.add_argument("--dry-run", help="estimate the cost of the experiment without running it",
+                        action="store_true")
     args = parser.parse_args()
 
     return args
@@ -41,17 +41,35 @@ This enables to parameterize unit tests - the tests are run by GitHub Actions ea
 # Test architecture
 # https://docs.pytest.org/en/latest/goodpractices.html#test-discovery
 
+import itertools
+import math
+from types import SimpleNamespace
+
 import numpy as np
 import pytest
+import tensorflow as tf
 from ruamel.yaml import YAML
+from tensorflow.keras import Sequential
+from tensorflow.keras.layers import Dense
+from tensorflow.keras.utils import to_categorical
 
 from mplc import utils
-from mplc.contributivity import Contributivity
-from mplc.corruption import Permutation, PermutationCircular, Randomize, Redundancy, RandomizeUniform, Duplication
-from mplc.dataset import Mnist, Cifar10, Titanic, Imdb, Esc50
+from mplc.audit_log import ContributivityAuditLog
+from mplc.coalition_store import CoalitionModelStore
+from mplc.contributivity import Contributivity, coalition_outcomes, confident_learning_noise_matrices, \
+    convergence_epoch, get_test_score, gradient_shapley_marginals, knn_shapley_values, outcomes_names, \
+    select_mpl_engine, shapley_value, shapley_weights
+from mplc.corruption import NoCorruption, Permutation, PermutationCircular, Randomize, Redundancy, RandomizeUniform, \
+    Duplication
+from mplc.dataset import Dataset, Mnist, Cifar10, Titanic, Imdb, Esc50
+from mplc.duplicates import detect_duplicates
+from mplc.estimator import expected_trainings
 from mplc.experiment import Experiment
-from mplc.multi_partner_learning.basic_mpl import FederatedAverageLearning
-from mplc.multi_partner_learning.utils import UniformAggregator
+from mplc.multi_partner_learning.basic_mpl import FedAvgSmodel, FederatedAverageLearning
+from mplc.multi_partner_learning.fast_mpl import FastFedAvg, FastFedAvgSmodel, FastFedGrad, FastGradientShapley, \
+    FastPVRL
+from mplc.multi_partner_learning.utils import ParameterArena, UniformAggregator, compile_step, \
+    init_optimizer_state, reset_optimizer_state, run_compiled_step
 from mplc.partner import Partner
 from mplc.scenario import Scenario
 # create_Mpl uses create_Dataset and create_Contributivity uses create_Scenario
@@ -65,6 +83,71 @@ from mplc.splitter import FlexibleSplitter, AdvancedSplitter, RandomSplitter, St
 ######
 
 
+class SyntheticDataset(Dataset):
+    """A small dataset of gaussian clusters with a small dense model, to run the trainings quickly"""
+
+    def __init__(self, samples_count=600, input_dim=8, num_classes=3, seed=0):
+        rng = np.random.RandomState(seed)
+        centers = rng.normal(size=(num_classes, input_dim)) * 2
+        y = rng.randint(num_classes, size=samples_count + 150)
+        x = (centers[y] + rng.normal(size=(len(y), input_dim))).astype('float32')
+        y = to_categorical(y, num_classes)
+        super(SyntheticDataset, self).__init__('synthetic', (input_dim,), num_classes,
+                                               x[:samples_count], y[:samples_count],
+                                               x[samples_count:], y[samples_count:])
+
+    def generate_new_model(self):
+        model = Sequential([Dense(16, activation='relu', input_shape=self.input_shape),
+                            Dense(self.num_classes, activation='softmax')])
+        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+        return model
+
+
+def synthetic_scenario(save_path, partners_count=3, **kwargs):
+    params = dict(dataset=SyntheticDataset(), epoch_count=2, minibatch_count=2, save_path=save_path)
+    params.update(kwargs)
+    return Scenario(partners_count, [1 / partners_count] * partners_count, **params)
+
+
+class AdditiveGameContributivity(Contributivity):
+    """Contributivity whose characteristic function is a noisy additive game, instead of the trainings of the
+    coalitions"""
+
+    def __init__(self, partners_values, noise_std=0.01, partners_groups=None):
+        partners_list = [SimpleNamespace(id=i, y_train=np.zeros(10)) for i in range(len(partners_values))]
+        scenario = SimpleNamespace(partners_list=partners_list, dataset=SimpleNamespace(num_classes=2),
+                                   test_set='global', coalition_store=None, epoch_count=1,
+                                   partners_groups=partners_groups)
+        super(AdditiveGameContributivity, self).__init__(scenario)
+        self.partners_values = np.array(partners_values)
+        self.noise_std = noise_std
+        self.rng = np.random.RandomState(0)
+
+    def characteristic_function(self, subset, seed=None):
+        value = np.sum(self.partners_values[list(subset)]) + self.rng.normal(scale=self.noise_std)
+        if self.keep_outcomes:  # outcomes vector named by outcomes_names: accuracy, loss, accuracy per class
+            self.charac_fct_outcomes.setdefault(tuple(np.sort(subset)), []).append(
+                np.array([value, -value, value, 2 * value]))
+        return value
+
+
+class DataVolumeGameContributivity(Contributivity):
+    """Contributivity whose value of a coalition is its number of train samples (in thousands), instead of the score
+    of a model trained on it. The amounts of the partners are stored as the weights of the coalition's model"""
+
+    def __init__(self, scenario):
+        super(DataVolumeGameContributivity, self).__init__(scenario)
+        self.trained_coalitions = []
+
+    def characteristic_function(self, subset, seed=None):
+        coalition = tuple(int(i) for i in np.sort(subset))
+        self.trained_coalitions.append(coalition)
+        amounts = np.array([len(self.scenario.partners_list[i].y_train) for i in coalition], dtype='float32')
+        if self.scenario.coalition_store is not None:
+            self.scenario.coalition_store.save(coalition, [amounts])
+        return np.sum(amounts) / 1000
+
+
 @pytest.fixture(scope="class", params=(Mnist, Cifar10, Titanic, Imdb, Esc50))
 def create_all_datasets(request):
     return request.param()
@@ -228,12 +311,443 @@ class Test_Mpl:
         mpl = create_MultiPartnerLearning
         assert type(mpl) == FederatedAverageLearning
 
+    def test_parameter_arena(self):
+        partners_weights = [[np.random.rand(3, 2).astype('float32'), np.random.rand(2).astype('float32')]
+                            for _ in range(3)]
+        arena = ParameterArena(partners_weights[0], rows_count=3)
+        for row, weights in enumerate(partners_weights):
+            arena.write(row, weights)
+        assert arena.buffer.shape == (3, 8)
+        assert all(np.array_equal(view, w) for view, w in zip(arena.rows[1], partners_weights[1]))
+
+        aggregation_weights = [0.2, 0.5, 0.3]
+        for average, weights_for_layer in zip(arena.average(aggregation_weights, [0, 1, 2]), zip(*partners_weights)):
+            assert np.allclose(average, np.average(np.array(weights_for_layer), axis=0, weights=aggregation_weights))
+        for average, weights_for_layer in zip(arena.average([1, 1], [2, 0]), zip(*partners_weights)):
+            assert np.allclose(average, (weights_for_layer[0] + weights_for_layer[2]) / 2)
+
+        arena.rows[0][1][:] = 0  # the rows are views on the buffer
+        assert np.all(arena.buffer[0, 6:] == 0)
+
+    def test_select_mpl_engine(self, tmp_path):
+        scenario = synthetic_scenario(tmp_path, multi_partner_learning_approach='fedavg')
+        assert select_mpl_engine(scenario) is FastFedAvg
+        assert select_mpl_engine(scenario, FedAvgSmodel) is FastFedAvgSmodel
+        # The fast engines need constant aggregation weights
+        scenario = synthetic_scenario(tmp_path, multi_partner_learning_approach='fedavg', aggregation='local-score')
+        assert select_mpl_engine(scenario) is FederatedAverageLearning
+
+        # The fast engines store all the test metrics in a dict, the basic ones only the accuracy
+        assert get_test_score(SimpleNamespace(history=SimpleNamespace(score={'loss': 1.2, 'accuracy': 0.6}))) == 0.6
+        assert get_test_score(SimpleNamespace(history=SimpleNamespace(score=0.7))) == 0.7
+
+    @pytest.mark.parametrize("approach", [FastFedAvg, FastFedGrad])
+    def test_rounds_val_accuracy(self, tmp_path, approach):
+        scenario = synthetic_scenario(tmp_path)
+        scenario.mpl = approach(scenario, track_rounds_scores=True, is_early_stopping=False, save_folder=None)
+        scenario.mpl.fit()
+        rounds_val_accuracy = scenario.mpl.history.rounds_val_accuracy
+        assert set(rounds_val_accuracy) == {0, 1, 2, 'mpl_model'}
+        for scores in rounds_val_accuracy.values():
+            assert scores.shape == (scenario.epoch_count, scenario.mpl.rounds_per_epoch())
+            assert np.all((scores >= 0) & (scores <= 1))
+
+        relative_perf_matrix = Contributivity(scenario).compute_relative_perf_matrix()
+        rounds_count = scenario.epoch_count * scenario.mpl.rounds_per_epoch()
+        assert relative_perf_matrix.shape == (round(0.9 * rounds_count) - round(0.1 * rounds_count), 3)
+
+    def test_compiled_steps(self):
+        model = Sequential([Dense(3, activation='softmax', input_shape=(4,))])
+        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+        initial_weights = model.get_weights()
+        optimizer_state = init_optimizer_state(model)
+        x = np.random.rand(10, 4).astype('float32')
+        y = np.eye(3, dtype='float32')[np.random.randint(3, size=10)]
+
+        train_history = run_compiled_step(compile_step(model.train_step, x, y), model, x, y, batch_size=4)
+        assert set(train_history) == {'loss', 'accuracy'}
+        assert not all(np.array_equal(w, w_init) for w, w_init in zip(model.get_weights(), initial_weights))
+        test_history = run_compiled_step(compile_step(model.test_step, x, y), model, x, y, batch_size=3)
+        assert np.allclose(test_history['loss'], model.evaluate(x, y, verbose=0)[0])
+
+        # A pooled model, reset with the initial weights and optimizer state, trains as a new one
+        model.set_weights(initial_weights)
+        reset_optimizer_state(model, optimizer_state)
+        assert np.allclose(run_compiled_step(compile_step(model.train_step, x, y), model, x, y, 4)['loss'],
+                           train_history['loss'])
+
 
 class Test_Contributivity:
     def test_Contributivity(self, create_Contributivity):
         contri = create_Contributivity
         assert type(contri) == Contributivity
 
+    def test_coalition_model_store(self, tmp_path):
+        weights = [np.random.rand(3, 2).astype('float32'), np.random.rand(2).astype('float32')]
+        store = CoalitionModelStore(tmp_path, max_bytes=2 * 8 * 4)
+        store.save([1, 0], weights)
+        store.save((2,), weights)  # identical weights are stored once
+        assert len(store) == 2 and store.nbytes == 8 * 4
+        assert all(np.array_equal(w, w_stored) for w, w_stored in zip(weights, store.load((0, 1))))
+
+        store.save((2,), [w + 1 for w in weights])
+        store.save((1,), [w + 2 for w in weights])  # exceeds max_bytes, the least recently used is evicted
+        assert (0, 1) not in store and (2,) in store and (1,) in store
+
+        reopened_store = CoalitionModelStore(tmp_path)
+        assert list(reopened_store.coalitions) == [(2,), (1,)]
+        assert np.array_equal(reopened_store.load((1,))[1], weights[1] + 2)
+
+        reopened_store.remap(lambda coalition: None if 1 in coalition else tuple(i - 1 for i in coalition))
+        assert list(reopened_store.coalitions) == [(1,)] and len(reopened_store.files) == 1
+        assert np.array_equal(reopened_store.load((1,))[1], weights[1] + 1)
+
+    def test_coalition_model_store_resave(self, tmp_path):
+        weights = [np.random.rand(3, 2).astype('float32'), np.random.rand(2).astype('float32')]
+        store = CoalitionModelStore(tmp_path, max_bytes=2 * 8 * 4)
+        store.save((0,), weights)
+        store.save((1,), [w + 1 for w in weights])
+        for i in range(3):  # a retrained coalition replaces its previous weights, whose file is deleted
+            store.save((0,), [w + 2 + i for w in weights])
+        assert len(store.files) == 2 and store.nbytes == 2 * 8 * 4
+        assert len(list(tmp_path.glob('*.npy'))) == 2
+        assert (1,) in store  # the stale weights do not make the store evict the live coalitions
+        assert np.array_equal(store.load((0,))[1], weights[1] + 2 + 2)
+
+    def test_incremental_partners(self, tmp_path):
+        def coalitions(partners_count):
+            return sorted(c for length in range(1, partners_count + 1)
+                          for c in itertools.combinations(range(partners_count), length))
+
+        def amounts():
+            return np.array([len(partner.y_train) for partner in scenario.partners_list]) / 1000
+
+        scenario = synthetic_scenario(tmp_path)
+        scenario.coalition_store = CoalitionModelStore(tmp_path / 'store')
+        contri = DataVolumeGameContributivity(scenario)
+        contri.compute_contributivity("Shapley values")
+        contri.not_twice_characteristic_batch(coalitions(3))  # keep the samples of the coalitions too
+        assert len(contri.trained_coalitions) == 7
+
+        # Adding a partner keeps the cached coalitions, the refresh trains the ones containing it only
+        x, y = scenario.dataset.x_train[:50], scenario.dataset.y_train[:50]
+        assert contri.add_partner(x, y) == 3
+        contri.trained_coalitions = []
+        contri.refresh("Shapley values")
+        assert sorted(contri.trained_coalitions) == [c for c in coalitions(4) if 3 in c]
+        assert np.allclose(contri.contributivity_scores, amounts())
+
+        # Updating a partner invalidates the coalitions containing it only
+        contri.update_partner(1, x[:20], y[:20])
+        kept_coalitions = {(), (0,), (2,), (3,), (0, 2), (0, 3), (2, 3), (0, 2, 3)}
+        assert set(contri.charac_fct_values) == kept_coalitions
+        assert set(contri.charac_fct_samples) == kept_coalitions & set(coalitions(3))
+        assert set(scenario.coalition_store.coalitions) == kept_coalitions - {()}
+        contri.trained_coalitions = []
+        contri.refresh("Shapley values")
+        assert sorted(contri.trained_coalitions) == [c for c in coalitions(4) if 1 in c]
+        assert np.allclose(contri.contributivity_scores, amounts())
+
+        # Removing a partner drops its coalitions, and shifts the indexes of the following partners
+        contri.remove_partner(0)
+        assert set(contri.charac_fct_values) == {()} | set(coalitions(3))
+        assert np.isclose(contri.charac_fct_values[(0, 2)], (20 + 50) / 1000)  # formerly the coalition (1, 3)
+        assert np.array_equal(scenario.coalition_store.load((0, 2))[0], [20, 50])
+        assert set(contri.charac_fct_samples) == {(1,)}  # formerly (2,)
+        contri.trained_coalitions = []
+        contri.refresh("Shapley values")
+        assert contri.trained_coalitions == []
+        assert np.allclose(contri.contributivity_scores, amounts())
+
+    @pytest.mark.parametrize("method", ["TMCS", "ITMCS"])
+    def test_adaptive_truncation(self, method):
+        np.random.seed(0)
+        contri = AdditiveGameContributivity([0.5, 0.3, 0.2] + [0.0] * 5)
+        contri.compute_contributivity(method, sv_accuracy=0.05, truncation="adaptive")
+        assert 0 < contri.truncation_report['truncation'] < 0.1
+        assert contri.truncation_report['saved_trainings'] > 0
+        assert np.allclose(contri.contributivity_scores, [0.5, 0.3, 0.2] + [0.0] * 5, atol=0.05)
+
+    def test_complementary_contribution_SV(self):
+        np.random.seed(0)
+        contri = AdditiveGameContributivity([0.4, 0.25, 0.15, 0.1, 0.1])
+        contri.compute_SV()
+        exact_values = contri.contributivity_scores
+        contri.compute_contributivity("CC_Shapley", sv_accuracy=0.01)
+        assert np.allclose(contri.contributivity_scores, exact_values, atol=0.02)
+
+    def test_symmetric_SV(self):
+        partners_values, groups = [0.3, 0.3, 0.1, 0.1, 0.2], [[0, 1], [2, 3]]
+        contri = AdditiveGameContributivity(partners_values, noise_std=0)
+        contri.compute_SV()
+        assert contri.first_charac_fct_calls_count == 2 ** 5 - 1
+        exact_values = contri.contributivity_scores
+
+        contri = AdditiveGameContributivity(partners_values, noise_std=0)
+        contri.compute_SV(exchangeable_groups=groups)
+        assert np.allclose(contri.contributivity_scores, exact_values)
+        assert contri.first_charac_fct_calls_count == 3 * 3 * 2 - 1  # one coalition per coalition type
+        for invalid_groups in [[[0, 1], [1, 2]], [[0, 5]]]:
+            with pytest.raises(ValueError):
+                contri.compute_symmetric_SV(invalid_groups)
+
+    def test_owen_values(self):
+        # With groups of a single partner, the Owen values are the Shapley values
+        contri = AdditiveGameContributivity([0.4, 0.3, 0.2, 0.1])
+        contri.compute_SV()
+        shapley_values = contri.contributivity_scores
+        contri.owen_values()
+        assert np.allclose(contri.contributivity_scores, shapley_values)
+
+        # On an additive game, the Owen values are the partners' values, exactly or by sampling the permutations
+        partners_values, groups = [0.3, 0.1, 0.25, 0.15, 0.2], [[0, 1], [2, 3, 4]]
+        contri = AdditiveGameContributivity(partners_values, noise_std=0, partners_groups=groups)
+        contri.owen_values()
+        assert np.allclose(contri.contributivity_scores, partners_values)
+        np.random.seed(0)
+        contri = AdditiveGameContributivity(partners_values, partners_groups=groups)
+        contri.owen_values(samples=50)
+        assert np.allclose(contri.contributivity_scores, partners_values, atol=0.03)
+
+    def test_influence(self, tmp_path):
+        np.random.seed(0)
+        scenario = synthetic_scenario(tmp_path, epoch_count=4,
+                                      corruption_parameters=[NoCorruption(), NoCorruption(), PermutationCircular()])
+        contri = Contributivity(scenario)
+        contri.compute_contributivity("Influence functions")
+        assert contri.contributivity_scores.shape == (3,)
+        assert np.all(np.isfinite(contri.contributivity_scores))
+        # The partner whose labels are permuted ranks below the clean partners
+        assert np.argmin(contri.contributivity_scores) == 2
+
+    @pytest.mark.parametrize("approach", [FastFedAvg, FastFedGrad])
+    def test_gradient_similarity(self, tmp_path, approach):
+        scenario = synthetic_scenario(tmp_path)
+        contri = Contributivity(scenario)
+        if approach is FastFedAvg:  # without a main mpl which tracked the similarity, a FastFedAvg is trained
+            contri.compute_contributivity("Gradient similarity")
+            assert contri.contributivity_scores.shape == (3,) and np.all(np.isfinite(contri.contributivity_scores))
+
+        scenario.mpl = approach(scenario, track_similarity=True, is_early_stopping=False, save_folder=None)
+        scenario.mpl.fit()
+        contri.compute_contributivity("Gradient similarity")
+        assert contri.contributivity_scores.shape == contri.scores_std.shape == (3,)
+        assert np.all(np.isfinite(contri.contributivity_scores)) and np.all(np.abs(contri.contributivity_scores) <= 1)
+        contri.gradient_similarity(similarity="projection")
+        assert contri.contributivity_scores.shape == (3,) and np.all(np.isfinite(contri.contributivity_scores))
+        with pytest.raises(ValueError):
+            contri.gradient_similarity(similarity="euclidean")
+
+    def test_reevaluate_coalitions(self, tmp_path):
+        scenario = synthetic_scenario(tmp_path)
+        scenario.coalition_store = CoalitionModelStore(tmp_path / 'store')
+        models = [scenario.dataset.generate_new_model() for _ in range(3)]
+        for i, model in enumerate(models):
+            scenario.coalition_store.save((i,), model.get_weights())
+        x, y = scenario.dataset.x_test, scenario.dataset.y_test
+        contri = Contributivity(scenario)
+
+        scores = contri.reevaluate_coalitions(x, y, batch_size=64, models_per_pass=2)
+        for i, model in enumerate(models):
+            assert np.isclose(scores[(i,)], model.evaluate(x, y, verbose=0)[1])
+        losses = contri.reevaluate_coalitions(x, y, coalitions=[(2,), (0, 1)], models_per_pass=2,
+                                              metric=lambda y_true, y_pred: np.mean(np.abs(y_true - y_pred)))
+        assert list(losses) == [(2,)]
+        assert np.isclose(losses[(2,)], np.mean(np.abs(y - models[2].predict(x, verbose=0))), atol=1e-6)
+
+    def test_pvrl_rollouts(self, tmp_path):
+        scenario = synthetic_scenario(tmp_path)
+        mpl = FastPVRL(scenario, rollouts_count=3, is_early_stopping=False, save_folder=None)
+        start_state = mpl.get_state()
+        rounds = mpl.next_rounds(2)
+        masks = np.array([[1, 0, 1], [0, 1, 0], [1, 1, 1]])
+        losses = mpl.rollouts(masks, rounds)
+        weights, optimizers_state = mpl.get_state()
+        # The engine goes on from the first rollout, in which the partner not selected made no local step
+        assert [optimizer.iterations.numpy() > 0 for optimizer in mpl.partners_optimizers] == [True, False, True]
+
+        # The batched rollouts give the same losses as the rollouts replayed one by one from the same state
+        sequential_losses = []
+        for mask in masks:
+            mpl.set_state(start_state)
+            sequential_losses.append(mpl.rollout(mask, rounds))
+        assert np.allclose(losses, sequential_losses, rtol=1e-5)
+        mpl.set_state(start_state)
+        mpl.rollout(masks[0], rounds)
+        replayed_weights, replayed_optimizers_state = mpl.get_state()
+        assert all(np.allclose(w, w_replayed) for w, w_replayed in zip(weights, replayed_weights))
+        assert all(np.allclose(v, v_replayed)
+                   for state, replayed_state in zip(optimizers_state, replayed_optimizers_state)
+                   for v, v_replayed in zip(state, replayed_state))
+
+        # and as the FastFedAvg step, which trains all the partners, with the masked aggregation weights
+        mpl.set_state(start_state)
+        fit_minibatch = mpl.build_fit_minibatch()
+        aggregation_weights = mpl.base_aggregation_weights * masks[1]
+        for partners_minibatches in rounds:
+            fit_minibatch(mpl.model, partners_minibatches, mpl.partners_optimizers, mpl.partners_weights,
+                          tf.constant(aggregation_weights / aggregation_weights.sum(), dtype=tf.float32))
+        assert np.isclose(mpl.val_loss(), losses[1], rtol=1e-5)
+
+        contri = Contributivity(scenario)
+        contri.PVRL(learning_rate=0.2, rollouts_count=2)
+        assert contri.contributivity_scores.shape == (3,)
+        assert np.all((contri.contributivity_scores > 0) & (contri.contributivity_scores < 1))
+
+    def test_coalition_outcomes(self, tmp_path):
+        scenario = synthetic_scenario(tmp_path)
+        x, y = scenario.dataset.x_test, scenario.dataset.y_test
+        model = scenario.dataset.generate_new_model()
+        model.fit(scenario.dataset.x_train, scenario.dataset.y_train, epochs=2, verbose=0)
+        outcomes = coalition_outcomes(model, scenario)
+        assert len(outcomes) == len(outcomes_names(scenario)) == 2 + 3
+        loss, accuracy = model.evaluate(x, y, verbose=0)
+        assert np.isclose(outcomes[0], accuracy) and np.isclose(outcomes[1], loss, atol=1e-4)
+        correct = np.argmax(model.predict(x, verbose=0), axis=1) == np.argmax(y, axis=1)
+        assert np.allclose(outcomes[2:], [np.mean(correct[np.argmax(y, axis=1) == c]) for c in range(3)])
+
+    @pytest.mark.parametrize("method", ["Shapley values", "TMCS"])
+    def test_vector_outcomes(self, method):
+        np.random.seed(0)
+        contri = AdditiveGameContributivity([0.5, 0.3, 0.2])
+        contri.compute_contributivity(method, vector_outcomes=True)
+        assert contri.outcomes_scores.shape == (3, len(contri.outcomes_names))
+        assert np.allclose(contri.outcomes_scores[:, 0], contri.contributivity_scores)
+        assert np.allclose(contri.outcomes_scores[:, 1:], contri.contributivity_scores[:, None] * [-1, 1, 2])
+
+        contri = AdditiveGameContributivity([0.5, 0.3, 0.2])
+        with pytest.raises(ValueError):
+            contri.compute_contributivity("ITMCS", vector_outcomes=True)
+        assert contri.first_charac_fct_calls_count == 0
+
+    def test_gradient_shapley_marginals(self, tmp_path):
+        scenario = synthetic_scenario(tmp_path)
+        trainer = FastGradientShapley(scenario, learning_rate=0.05)
+        initial_accuracy = trainer.evaluate()
+        marginals = trainer.permutation_marginals([2, 0, 1])
+        assert marginals.shape == (3,)
+        # The marginal contributions along a permutation add up to the accuracy gained by the whole pass
+        assert np.isclose(marginals.sum(), trainer.evaluate() - initial_accuracy, atol=1e-6)
+        assert gradient_shapley_marginals(scenario, [[0, 1, 2], [1, 2, 0]], learning_rate=0.05).shape == (2, 3)
+
+    def test_shapley_weights(self):
+        partners_count = 4
+        coalitions = [c for length in range(1, partners_count + 1)
+                      for c in itertools.combinations(range(partners_count), length)]
+        values = np.random.rand(len(coalitions))
+        weights = shapley_weights(partners_count, coalitions)
+        assert np.allclose(weights.dot(values), shapley_value(partners_count, values))
+
+    def test_convergence_epoch(self):
+        trajectories = np.array([[0., 0.], [0.5, 0.1], [0.3, 0.3], [0.32, 0.29], [0.3, 0.3]])
+        assert convergence_epoch(trajectories, tolerance=0.05) == 2
+        assert convergence_epoch(trajectories, tolerance=0.001) == 4
+        assert convergence_epoch(trajectories, tolerance=1.) == 0
+
+    def test_contributivity_audit_log(self, tmp_path):
+        audit_log = ContributivityAuditLog(tmp_path / 'audit.jsonl', method='TMCS', epoch_count=10, buffer_size=3)
+        audit_log.record((0, 1), 0.8, time_sec=2., epochs=10, worker=1)
+        audit_log.record((0,), 0.6, time_sec=1., epochs=4, worker=2)
+        audit_log.record((0, 1), 0.8, cache_hit=True)
+        assert len((tmp_path / 'audit.jsonl').read_text().splitlines()) == 3  # the buffer is full
+        audit_log.record((1,), 0.4, time_sec=3., epochs=6, worker=1)
+        summary = audit_log.close()
+        assert len((tmp_path / 'audit.jsonl').read_text().splitlines()) == 4
+        assert (tmp_path / 'audit.summary.json').exists()
+        assert summary['calls'] == 4 and summary['cache_hits'] == 1
+        assert summary['mean_time_sec_per_size'] == {1: 2., 2: 2.}
+        assert summary['epochs_saved_by_early_stopping'] == 30 - 20
+        assert summary['trainings_per_worker'] == {1: 2, 2: 1}
+        assert summary['slowest_coalitions'][0] == {'coalition': [1], 'time_sec': 3.}
+
+    def test_audit_log_cache_hits(self, tmp_path):
+        contri = AdditiveGameContributivity([0.5, 0.3, 0.2])
+        contri.not_twice_characteristic_batch([(0,), (0, 1)])
+        contri.init_audit_log("Shapley values", tmp_path / 'audit.jsonl')
+        contri.not_twice_characteristic_batch([(0,), (0,), (), (0, 1), (2,)])
+        summary = contri.audit_log.summary()
+        assert summary['cache_hits'] == 3  # each request of a cached coalition, the empty coalition excepted
+
+        def failing_method(**kwargs):
+            contri.not_twice_characteristic((0,))
+            raise RuntimeError("training failed")
+
+        contri.truncated_MC = failing_method
+        with pytest.raises(RuntimeError):
+            contri.compute_contributivity("TMCS", audit_log=tmp_path / 'failed.jsonl')
+        assert contri.audit_log is None
+        assert len((tmp_path / 'failed.jsonl').read_text().splitlines()) == 1
+
+    def test_expected_trainings(self):
+        assert np.allclose(expected_trainings("Shapley values", 4, repeats=2), [8, 12, 8, 2])
+        assert np.allclose(expected_trainings("Leave-one-out", 4), [0, 0, 4, 1])
+        assert np.allclose(expected_trainings("Independent scores", 4), [4, 0, 0, 0])
+        assert np.sum(expected_trainings("KNN-Shapley", 4)) == 0
+        # With many permutations, the samplers end up training all the coalitions
+        assert np.allclose(expected_trainings("TMCS", 4, sv_accuracy=0.001), [4, 6, 4, 1])
+        assert np.sum(expected_trainings("TMCS", 12)) < np.sum(expected_trainings("Shapley values", 12))
+
+    def test_detect_duplicates(self):
+        rng = np.random.RandomState(0)
+        partners_x = [rng.rand(200, 5, 5), rng.rand(100, 5, 5)]
+        partners_x[1][:50] = partners_x[0][:50]  # partner 1 copies 50 samples of partner 0
+        partners_x[0][150:] = partners_x[0][100]  # partner 0 repeats a sample 50 times
+        report = detect_duplicates(partners_x, chunk_size=64)
+        assert np.allclose(report['overlap'], [[1, 0.25], [0.5, 1]])
+        assert np.allclose(report['redundancy'], [51 / 200, 0])
+        assert np.allclose(report['distinct_samples_values'], [100 + 25, 50 + 25])
+
+        # Slightly perturbed copies are near duplicates, unlike the unrelated samples
+        partners_x.append(np.concatenate([partners_x[0][:80] + rng.normal(scale=0.01, size=(80, 5, 5)),
+                                          rng.rand(120, 5, 5)]))
+        report = detect_duplicates(partners_x, chunk_size=64)
+        assert np.isclose(report['overlap'][2, 0], 80 / 200) and np.isclose(report['overlap'][0, 2], 80 / 200)
+        assert np.isclose(report['overlap'][2, 1], 50 / 200) and np.isclose(report['overlap'][1, 2], 50 / 100)
+        assert report['redundancy'][2] == 0
+        # while long bands only catch the exact copies
+        report = detect_duplicates(partners_x, bands_count=4, band_bits=64, similarity=1, chunk_size=64)
+        assert report['overlap'][2, 0] < 0.1 and np.isclose(report['overlap'][1, 0], 0.5)
+
+    def test_confident_learning_noise_matrices(self):
+        rng = np.random.RandomState(0)
+        true_labels = rng.randint(3, size=600)
+        probabilities = np.full((600, 3), 0.1)
+        probabilities[np.arange(600), true_labels] = 0.8
+        labels = true_labels.copy()
+        groups = np.repeat([0, 1], 300)
+        flipped = np.flatnonzero((groups == 1) & (true_labels == 0))[::2]  # half of the class 0 of group 1
+        labels[flipped] = 1
+        noise_matrices = confident_learning_noise_matrices(labels, probabilities, groups)
+        assert np.allclose(noise_matrices[0], np.identity(3))
+        assert np.isclose(noise_matrices[1][1, 0], len(flipped) / np.sum((groups == 1) & (true_labels == 0)))
+        assert np.allclose(noise_matrices[1].sum(axis=0), 1)
+
+    def test_knn_shapley_values(self):
+        rng = np.random.RandomState(0)
+        x_train, y_train = rng.rand(7, 3), rng.randint(2, size=7)
+        x_test, y_test = rng.rand(4, 3), rng.randint(2, size=4)
+        k = 3
+
+        def utility(subset, x, y):
+            if len(subset) == 0:
+                return 0
+            nearest = np.argsort(np.linalg.norm(x_train[list(subset)] - x, axis=1))[:k]
+            return np.sum(y_train[list(subset)][nearest] == y) / k
+
+        # brute force Shapley values, averaged over the test points
+        expected = np.zeros(len(x_train))
+        for x, y in zip(x_test, y_test):
+            for permutation in itertools.permutations(range(len(x_train))):
+                for i, sample in enumerate(permutation):
+                    expected[sample] += utility(permutation[:i + 1], x, y) - utility(permutation[:i], x, y)
+        expected /= len(x_test) * math.factorial(len(x_train))
+
+        groups = np.array([0, 0, 1, 1, 1, 2, 2])
+        values, groups_values = knn_shapley_values(x_train, y_train, x_test, y_test, k=k, batch_size=3,
+                                                   groups=groups)
+        assert np.allclose(values, expected)
+        assert np.allclose(groups_values.mean(axis=0), [expected[groups == g].sum() for g in range(3)])
+
 
 ######
 #